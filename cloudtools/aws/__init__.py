@@ -4,13 +4,15 @@ import time
 import calendar
 import iso8601
 import json
-from redo import retrier
+import threading
 from boto.ec2 import connect_to_region
+from boto.ec2.instance import Reservation
 from boto.vpc import VPCConnection
 from boto.s3.connection import S3Connection
-from boto.exception import BotoServerError
 from repoze.lru import lru_cache
 from fabric.api import run
+from ..cache import namespace
+from . import ratelimit, waiter
 
 log = logging.getLogger(__name__)
 AMI_CONFIGS_DIR = os.path.join(os.path.dirname(__file__), "../../ami_configs")
@@ -20,12 +22,18 @@ DEFAULT_REGIONS = ['us-east-1', 'us-west-2']
 # Number of seconds from an instance's launch time for it to be considered
 # 'fresh'
 FRESH_INSTANCE_DELAY = 20 * 60
+# Every instance state but "terminated"
+LIVE_INSTANCE_STATES = ["pending", "running", "shutting-down", "stopping",
+                        "stopped"]
+# Number of instances to fetch per DescribeInstances call
+INSTANCE_PAGE_SIZE = 1000
 
 
 @lru_cache(10)
 def get_aws_connection(region):
-    """Connect to an EC2 region. Caches connection objects"""
-    return connect_to_region(region)
+    """Connect to an EC2 region. Caches connection objects. Calls are rate
+    limited and retried, see cloudtools.aws.ratelimit"""
+    return ratelimit.install(connect_to_region(region), region)
 
 
 @lru_cache(10)
@@ -37,43 +45,29 @@ def get_s3_connection():
 @lru_cache(10)
 def get_vpc(region):
     conn = get_aws_connection(region)
-    return VPCConnection(region=conn.region)
+    return ratelimit.install(VPCConnection(region=conn.region), region)
 
 
 def wait_for_status(obj, attr_name, attr_value, update_method):
+    """Blocks until obj.attr_name is attr_value. Waits share one polling
+    loop, see cloudtools.aws.waiter"""
     log.debug("waiting for %s availability", obj)
-    while True:
-        try:
-            getattr(obj, update_method)()
-            if getattr(obj, attr_name) == attr_value:
-                break
-            else:
-                time.sleep(1)
-        except:
-            log.exception('hit error waiting')
-            time.sleep(10)
+    return waiter.wait_for(obj, attr_name, attr_value, update_method).result()
 
 
 def attach_and_wait_for_volume(volume, aws_dev_name, internal_dev_name,
                                instance_id):
     """Attach a volume to an instance and wait until it is available"""
     wait_for_status(volume, "status", "available", "update")
+    volume.attach(instance_id, aws_dev_name)
+    wait_for_status(volume, "status", "in-use", "update")
     while True:
         try:
-            volume.attach(instance_id, aws_dev_name)
-            break
-        except:
-            log.debug('hit error waiting for volume to be attached')
-            time.sleep(10)
-    while True:
-        try:
-            volume.update()
-            if volume.status == 'in-use':
-                if run('ls %s' % internal_dev_name).succeeded:
-                    break
-        except:
+            if run('ls %s' % internal_dev_name).succeeded:
+                break
+        except Exception:
             log.debug('hit error waiting for volume to be attached')
-            time.sleep(10)
+        time.sleep(10)
 
 
 def mount_device(device, mount_point):
@@ -102,6 +96,59 @@ def aws_time_to_datetime(t):
     return iso8601.parse_date(t)
 
 
+def instance_filters(state=None, tags=None, lifecycle=None):
+    """Translates instance predicates into DescribeInstances filters.
+
+    `state` and tag values can be single values or lists of accepted values.
+    Only spot instances can be selected by lifecycle on the server side, so
+    lifecycle="ondemand" adds no filter.
+    """
+    filters = {}
+    if state:
+        filters["instance-state-name"] = state
+    for tag, value in (tags or {}).iteritems():
+        filters["tag:%s" % tag] = value
+    if lifecycle == "spot":
+        filters["instance-lifecycle"] = "spot"
+    return filters
+
+
+def iter_instances(region, state=None, tags=None, lifecycle=None,
+                   filters=None, page_size=INSTANCE_PAGE_SIZE):
+    """Yields instances in `region` matching the given predicates (see
+    instance_filters), plus any extra raw EC2 `filters`. Results are fetched
+    one page at a time, as they are consumed."""
+    conn = get_aws_connection(region)
+    all_filters = instance_filters(state=state, tags=tags,
+                                   lifecycle=lifecycle)
+    all_filters.update(filters or {})
+    params = {"MaxResults": page_size}
+    if all_filters:
+        conn.build_filter_params(params, all_filters)
+    while True:
+        reservations = conn.get_list("DescribeInstances", params,
+                                     [("item", Reservation)], verb="POST")
+        for r in reservations:
+            for i in r.instances:
+                if lifecycle == "ondemand" and i.spot_instance_request_id:
+                    continue
+                yield i
+        if not reservations.next_token:
+            break
+        params["NextToken"] = reservations.next_token
+
+
+def query_instances(regions, **kwargs):
+    """Returns a list of instances matching the iter_instances predicates in
+    all `regions`, queried in parallel"""
+    instances_by_region = region_map(
+        lambda region: list(iter_instances(region, **kwargs)), regions)
+    retval = []
+    for region in regions:
+        retval.extend(instances_by_region[region])
+    return retval
+
+
 def aws_get_running_instances(instances, moz_instance_type):
     retval = []
     for i in instances:
@@ -116,28 +163,78 @@ def aws_get_running_instances(instances, moz_instance_type):
     return retval
 
 
-_aws_instances_cache = {}
+_aws_instances_cache = namespace("instances", maxsize=20)
+
+
+def region_map(func, regions, ignore_errors=False):
+    """Calls func(region) for every region in parallel, using one thread per
+    region. Returns a dictionary keyed by region.
+
+    A failure in one region doesn't affect the others. Failed regions are
+    logged and left out of the result if `ignore_errors` is set, otherwise
+    the first error is re-raised once all regions are done."""
+    results = {}
+    errors = []
+
+    def run(region):
+        try:
+            results[region] = func(region)
+        except Exception, e:
+            log.error("%s failed in %s", getattr(func, "__name__", func),
+                      region, exc_info=True)
+            errors.append(e)
+
+    regions = list(regions)
+    if len(regions) == 1:
+        run(regions[0])
+    else:
+        threads = [threading.Thread(target=run, args=(region,))
+                   for region in regions]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    if errors and not ignore_errors:
+        raise errors[0]
+    return results
 
 
 def aws_get_all_instances(regions):
     """
-    Returns a list of all instances in the given regions
+    Returns a list of all non-terminated instances in the given regions
     """
     log.debug("fetching all instances for %s", regions)
-    retval = []
+    instances_by_region = {}
     for region in regions:
-        if region in _aws_instances_cache:
+        region_instances = _aws_instances_cache.get(region)
+        if region_instances is not None:
             log.debug("aws_get_all_instances - cache hit for %s", region)
-            retval.extend(_aws_instances_cache[region])
-        else:
-            conn = get_aws_connection(region)
-            region_instances = conn.get_only_instances()
-            log.debug("aws_get_running_instances - caching %s", region)
-            _aws_instances_cache[region] = region_instances
-            retval.extend(region_instances)
+            instances_by_region[region] = region_instances
+
+    def fetch(region):
+        region_instances = list(iter_instances(region,
+                                               state=LIVE_INSTANCE_STATES))
+        log.debug("aws_get_running_instances - caching %s", region)
+        _aws_instances_cache.put(region, region_instances)
+        return region_instances
+
+    instances_by_region.update(region_map(
+        fetch, [r for r in regions if r not in instances_by_region]))
+    retval = []
+    for region in regions:
+        retval.extend(instances_by_region[region])
     return retval
 
 
+def invalidate_instances_cache(regions=None):
+    """Forget cached instance lists for `regions` (all regions by default)"""
+    if regions is None:
+        _aws_instances_cache.clear()
+        return
+    for region in regions:
+        _aws_instances_cache.invalidate(region)
+
+
 @lru_cache(10)
 def get_user_data_tmpl(moz_instance_type):
     user_data_tmpl = os.path.join(INSTANCE_CONFIGS_DIR,
@@ -272,20 +369,3 @@ def get_region_dns_atom(region):
         "us-west-2": "usw2",
     }
     return mapping.get(region)
-
-
-def retry_aws_request(callable, *args, **kwargs):
-    """Calls callable(*args, **kwargs), and sleeps/retries on
-    RequestLimitExceeded errors"""
-    for _ in retrier():
-        try:
-            return callable(*args, **kwargs)
-        except BotoServerError, e:
-            if e.code == 'RequestLimitExceeded':
-                # Try again
-                log.debug("Got RequestLimitExceeded; retrying", exc_info=True)
-                continue
-            # Otherwise re-raise
-            raise
-    else:
-        raise Exception("Exceeded retries")
@@ -2,11 +2,15 @@ import time
 import logging
 import xml.dom.minidom
 import os
+from collections import defaultdict
 from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
+from boto.ec2.image import Image
 from fabric.api import run, put, cd
 
 from . import AMI_CONFIGS_DIR, wait_for_status, get_aws_connection, \
-    get_s3_connection
+    get_s3_connection, region_map, waiter
+from .tags import add_tags
+from .. import cache
 
 log = logging.getLogger(__name__)
 
@@ -59,45 +63,129 @@ def volume_to_ami(volume, ami_name, arch, virtualization_type,
         virtualization_type=virtualization_type,
     )
     log.info('Waiting...')
-    while True:
-        try:
-            ami = volume.connection.get_image(ami_id)
-            ami.add_tag('Name', ami_name)
-            ami.add_tag('moz-created', int(time.time()))
-            for tag, value in tags.iteritems():
-                ami.add_tag(tag, value)
-            log.info('AMI created')
-            log.info('ID: {id}, name: {name}'.format(id=ami.id, name=ami.name))
-            break
-        except:
-            log.info('Wating for AMI')
-            time.sleep(10)
+    ami = Image(volume.connection)
+    ami.id = ami_id
     wait_for_status(ami, "state", "available", "update")
+    all_tags = {"Name": ami_name, "moz-created": int(time.time())}
+    all_tags.update(tags)
+    volume.connection.create_tags([ami.id], all_tags)
+    ami.tags.update(all_tags)
+    get_ami_catalog.cache.invalidate((volume.connection.region.name,))
+    log.info('AMI created')
+    log.info('ID: {id}, name: {name}'.format(id=ami.id, name=ami.name))
     return ami
 
 
-def copy_ami(source_ami, region_to_copy):
+def _tag_copy(source_ami, new_ami, region):
+    if source_ami.tags:
+        # New copies aren't always visible to CreateTags right away; the tag
+        # queue retries until they are
+        add_tags(region, [new_ami.id], source_ami.tags).result()
+        new_ami.tags.update(source_ami.tags)
+    log.info('AMI created')
+    log.info('ID: {id}, name: {name}'.format(id=new_ami.id,
+                                             name=new_ami.name))
+
+
+def start_ami_copy(source_ami, region_to_copy):
+    """Starts copying `source_ami` to `region_to_copy`. Returns a Wait (see
+    cloudtools.aws.waiter) for the copy, which is tagged like the source as
+    soon as it is visible. Its result() raises if tagging failed"""
     log.info("Copying %s to %s", source_ami, region_to_copy)
     conn = get_aws_connection(region_to_copy)
     ami_copy = conn.copy_image(source_ami.region.name, source_ami.id,
                                source_ami.name, source_ami.description)
-    while True:
-        try:
-            new_ami = conn.get_image(ami_copy.image_id)
-            for tag, value in source_ami.tags.iteritems():
-                new_ami.add_tag(tag, value)
-            new_ami.update()
-            log.info('AMI created')
-            log.info('ID: {id}, name: {name}'.format(id=new_ami.id,
-                                                     name=new_ami.name))
-            break
-        except:
-            log.info('Wating for AMI')
-            time.sleep(10)
-    return new_ami
+    new_ami = Image(conn)
+    new_ami.id = ami_copy.image_id
+    visible = waiter.wait_for(new_ami, "state", ("pending", "available"))
+    visible.add_done_callback(
+        lambda w: _tag_copy(source_ami, w.obj, region_to_copy))
+    return visible
+
+
+def copy_ami(source_ami, region_to_copy):
+    return start_ami_copy(source_ami, region_to_copy).result()
+
+
+def copy_amis(source_amis, regions):
+    """Copies every AMI of `source_amis` to every region of `regions`. All
+    copies are started at once and share one waiter. Returns a dictionary of
+    new AMIs keyed by (source AMI id, region). If any copy fails, the first
+    error is re-raised once the other copies are done"""
+    errors = []
+
+    def start(region):
+        started = []
+        for ami in source_amis:
+            try:
+                started.append((ami, start_ami_copy(ami, region)))
+            except Exception, e:
+                log.error("Cannot copy %s to %s", ami.id, region,
+                          exc_info=True)
+                errors.append(e)
+        return started
+
+    copies = {}
+    for region, started in region_map(start, regions).iteritems():
+        for ami, copy in started:
+            try:
+                copies[(ami.id, region)] = copy.result()
+            except Exception, e:
+                log.error("Copying %s to %s failed", ami.id, region,
+                          exc_info=True)
+                errors.append(e)
+    if errors:
+        raise errors[0]
+    return copies
+
+
+def ami_created(ami):
+    """Creation time of an AMI according to its moz-created tag"""
+    try:
+        return int(ami.tags.get("moz-created"))
+    except (TypeError, ValueError):
+        return 0
+
+
+class AmiCatalog(object):
+    """Spot AMIs of a region, indexed by (moz-type, root device type) and
+    sorted by creation time, oldest first"""
+
+    def __init__(self, amis):
+        self._index = defaultdict(list)
+        for ami in sorted(amis, key=ami_created):
+            moz_type = ami.tags.get("moz-type")
+            self._index[(moz_type, None)].append(ami)
+            self._index[(moz_type, ami.root_device_type)].append(ami)
+
+    def __len__(self):
+        return sum(len(amis) for (_, root_device_type), amis in
+                   self._index.iteritems() if root_device_type is None)
+
+    def find(self, tags, root_device_type=None):
+        """Returns the AMIs with the given tags, which must include
+        moz-type"""
+        amis = self._index.get((tags["moz-type"], root_device_type), [])
+        return [a for a in amis if
+                all(a.tags.get(k) == v for k, v in tags.iteritems())]
+
+
+@cache.cached("ami_catalog", maxsize=20)
+def get_ami_catalog(region):
+    """Describes the available spot AMIs of `region` once"""
+    conn = get_aws_connection(region)
+    amis = conn.get_all_images(owners=["self"], filters={
+        "state": "available", "tag:Name": "spot-*"})
+    catalog = AmiCatalog(amis)
+    log.debug("%i spot AMIs in %s", len(catalog), region)
+    return catalog
 
 
 def get_spot_amis(region, tags, name_glob="spot-*", root_device_type=None):
+    """Returns the available AMIs with the given tags, oldest first. Spot
+    AMIs of a moz-type come from the region's AMI catalog"""
+    if name_glob == "spot-*" and "moz-type" in tags:
+        return get_ami_catalog(region).find(tags, root_device_type)
     conn = get_aws_connection(region)
     filters = {"state": "available"}
     for tag, value in tags.iteritems():
@@ -107,7 +195,7 @@ def get_spot_amis(region, tags, name_glob="spot-*", root_device_type=None):
     if root_device_type:
         filters["root-device-type"] = root_device_type
     avail_amis = conn.get_all_images(owners=["self"], filters=filters)
-    return sorted(avail_amis, key=lambda ami: ami.tags.get("moz-created"))
+    return sorted(avail_amis, key=ami_created)
 
 
 def delete_ebs_ami(ami):
@@ -157,6 +245,8 @@ def delete_old_amis(region, tags, keep_last, root_device_type="ebs",
 
         for a in amis_to_delete:
             delete_ami(a, dry_run)
+        if not dry_run:
+            get_ami_catalog.cache.invalidate((region,))
     else:
         log.info("Nothing to delete")
 
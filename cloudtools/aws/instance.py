@@ -14,7 +14,7 @@ from ..dns import get_ip
 from . import wait_for_status, AMI_CONFIGS_DIR, get_aws_connection, \
     get_user_data_tmpl
 from .vpc import get_subnet_id, ip_available, get_vpc
-from boto.exception import BotoServerError, EC2ResponseError
+from .tags import add_tags
 
 log = logging.getLogger(__name__)
 
@@ -271,33 +271,9 @@ def user_data_from_template(moz_instance_type, tokens):
 
 
 def tag_ondemand_instance(instance, name, fqdn, moz_instance_type):
+    """Tags a new on-demand instance in the background. See
+    cloudtools.aws.tags"""
     tags = {"Name": name, "FQDN": fqdn, "moz-type": moz_instance_type,
             "moz-state": "ready"}
-    # Sleep for a little bit to prevent us hitting
-    # InvalidInstanceID.NotFound right away
-    time.sleep(0.5)
-    max_tries = 10
-    sleep_time = 5
-    for i in range(max_tries):
-        try:
-            for tag, value in tags.iteritems():
-                instance.add_tag(tag, value)
-            return instance
-        except EC2ResponseError, e:
-            if e.code == "InvalidInstanceID.NotFound":
-                if i < max_tries - 1:
-                    # Try again
-                    log.debug("waiting for instance")
-                    time.sleep(sleep_time)
-                    sleep_time = min(30, sleep_time * 1.5)
-                    continue
-        except BotoServerError, e:
-            if e.code == "RequestLimitExceeded":
-                if i < max_tries - 1:
-                    # Try again
-                    log.debug("request limit exceeded; sleeping and "
-                              "trying again")
-                    time.sleep(sleep_time)
-                    sleep_time = min(30, sleep_time * 1.5)
-                    continue
-            raise
+    add_tags(instance.region.name, [instance.id], tags)
+    return instance
@@ -0,0 +1,55 @@
+import logging
+from collections import defaultdict
+
+log = logging.getLogger(__name__)
+
+
+def instance_lifecycle(instance):
+    """Returns "spot" or "ondemand" """
+    if instance.spot_instance_request_id:
+        return "spot"
+    return "ondemand"
+
+
+class InstanceInventory(object):
+    """Indexes instances by (moz-type, lifecycle, state, moz-state), image id
+    and instance id, so the scheduler doesn't have to rescan the instance list
+    for every moz-type. Build a new one for every scheduling run."""
+
+    def __init__(self, instances):
+        self.instances = list(instances)
+        self.by_id = {}
+        self.image_counts = defaultdict(int)
+        self._index = defaultdict(list)
+        for i in self.instances:
+            self.by_id[i.id] = i
+            self.image_counts[i.image_id] += 1
+            key = (i.tags.get("moz-type"), instance_lifecycle(i), i.state,
+                   i.tags.get("moz-state"))
+            self._index[key].append(i)
+        log.debug("indexed %i instances", len(self.instances))
+
+    def __contains__(self, instance_id):
+        return instance_id in self.by_id
+
+    def __len__(self):
+        return len(self.instances)
+
+    def select(self, moz_instance_type, lifecycle, state, moz_state):
+        return self._index.get(
+            (moz_instance_type, lifecycle, state, moz_state), [])
+
+    def running(self, moz_instance_type, lifecycle=None):
+        """Returns running instances with moz-state=ready, optionally of a
+        single lifecycle ("spot" or "ondemand")"""
+        if lifecycle:
+            return self.select(moz_instance_type, lifecycle, "running",
+                               "ready")
+        return self.running(moz_instance_type, "spot") + \
+            self.running(moz_instance_type, "ondemand")
+
+    def count_running(self, moz_instance_type, lifecycle=None):
+        return len(self.running(moz_instance_type, lifecycle))
+
+    def count_by_image(self, image_id):
+        return self.image_counts.get(image_id, 0)
@@ -0,0 +1,161 @@
+"""Client side rate limiting and retries of AWS API calls.
+
+AWS throttles API calls per account and region, and answers calls over the
+limit with RequestLimitExceeded. All connections handed out by
+cloudtools.aws go through a RateLimiter shared by everything talking to the
+same region, which:
+
+ - spaces calls out with a token bucket,
+ - halves the bucket's rate when a call is throttled anyway, and raises it
+   again by a hundredth of the initial rate with every call that goes
+   through (AIMD), so it takes a hundred calls to recover from a halving of
+   the full rate,
+ - retries throttled calls after a jittered, exponentially growing delay,
+ - counts calls, throttled calls and retries (see stats()).
+"""
+import logging
+import random
+import threading
+import time
+
+from boto.exception import BotoServerError
+
+log = logging.getLogger(__name__)
+# Calls per second and burst size per region
+DEFAULT_RATE = 20.0
+DEFAULT_BURST = 100
+# Every call that goes through raises the rate by this share of the initial
+# rate
+RATE_INCREASE = 0.01
+THROTTLE_CODES = ("RequestLimitExceeded", "Throttling")
+# Connection methods every query API call goes through
+CONNECTION_METHODS = ("get_list", "get_object", "get_status")
+
+
+class TokenBucket(object):
+    """Hands out up to `rate` tokens per second, and up to `burst` at
+    once"""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, min_rate=0.1,
+                 increase=RATE_INCREASE):
+        self.max_rate = self.rate = float(rate)
+        self.min_rate = min_rate
+        self.increase = self.max_rate * increase
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Waits for a token and takes it"""
+        while True:
+            with self._lock:
+                self._refill(time.time())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        """Slows down after a call was rejected"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            log.debug("throttled, slowing down to %.2f calls/s", self.rate)
+
+    def succeeded(self):
+        """Speeds up again, a little"""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+def backoff(attempt, base_delay=0.5, max_delay=30):
+    """Seconds to wait before retry number `attempt`, with full jitter"""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class RateLimiter(object):
+    """Rate limits and retries the calls of one region"""
+
+    def __init__(self, bucket=None, max_tries=8):
+        self.bucket = bucket or TokenBucket()
+        self.max_tries = max_tries
+        self.calls = 0
+        self.throttled = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, n in counts.iteritems():
+                setattr(self, name, getattr(self, name) + n)
+
+    def call(self, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) once a token is available, retrying
+        throttled calls up to `max_tries` times in total"""
+        attempt = 1
+        while True:
+            self.bucket.acquire()
+            self._count(calls=1)
+            try:
+                rv = func(*args, **kwargs)
+            except BotoServerError, e:
+                if e.code not in THROTTLE_CODES:
+                    raise
+                self._count(throttled=1)
+                self.bucket.throttled()
+                if attempt >= self.max_tries:
+                    raise
+                delay = backoff(attempt)
+                log.debug("Got %s; retrying in %.1fs", e.code, delay)
+                self._count(retries=1)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.bucket.succeeded()
+            return rv
+
+    def wrap(self, func):
+        def wrapper(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+        wrapper.__name__ = getattr(func, "__name__", "wrapper")
+        return wrapper
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "throttled": self.throttled,
+                    "retries": self.retries, "rate": self.bucket.rate}
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(region):
+    """Returns the limiter shared by all calls to `region`"""
+    with _limiters_lock:
+        if region not in _limiters:
+            _limiters[region] = RateLimiter()
+        return _limiters[region]
+
+
+def install(conn, region):
+    """Routes the API calls of boto connection `conn` through the limiter of
+    `region`. Returns `conn`"""
+    limiter = get_rate_limiter(region)
+    for name in CONNECTION_METHODS:
+        setattr(conn, name, limiter.wrap(getattr(conn, name)))
+    return conn
+
+
+def stats():
+    """Returns a mapping of regions to the counters of their limiter"""
+    with _limiters_lock:
+        limiters = _limiters.items()
+    return dict((region, limiter.stats()) for region, limiter in limiters)
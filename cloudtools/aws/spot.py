@@ -1,8 +1,18 @@
+import calendar
 import logging
+import threading
+import time
 import boto
+import iso8601
+from bisect import bisect_right
+from collections import defaultdict, OrderedDict
+from itertools import izip
 from datetime import datetime, timedelta
-from repoze.lru import lru_cache
-from . import get_aws_connection, aws_time_to_datetime, retry_aws_request
+from . import get_aws_connection, aws_time_to_datetime, \
+    region_map
+from .spot_failures import get_failure_tracker
+from .spot_prices import get_spot_price_store, price_time
+from .. import cache
 from ..slavealloc import get_classified_slaves
 
 CANCEL_STATUS_CODES = ["capacity-oversubscribed", "price-too-low",
@@ -15,10 +25,12 @@ IGNORABLE_STATUS_CODES = CANCEL_STATUS_CODES + TERMINATED_BY_AWS_STATUS_CODES \
     + ["bad-parameters", "canceled-before-fulfillment", "fulfilled",
        "instance-terminated-by-user", "pending-evaluation",
        "pending-fulfillment"]
+# Tags which differ from instance to instance
+PER_INSTANCE_TAGS = ("Name", "FQDN")
 
 log = logging.getLogger(__name__)
-_spot_cache = {}
-_spot_requests = {}
+_spot_cache = cache.namespace("spot_prices", maxsize=1000)
+_spot_requests = cache.namespace("spot_requests_by_id", maxsize=10000)
 
 
 def populate_spot_requests_cache(region, request_ids=None):
@@ -33,12 +45,13 @@ def populate_spot_requests_cache(region, request_ids=None):
         log.debug("Some of the requests not found, requesting all")
         reqs = conn.get_all_spot_instance_requests()
     for req in reqs:
-        _spot_requests[region, req.id] = req
+        _spot_requests.put((region, req.id), req)
 
 
 def get_spot_request(region, request_id):
-    if (region, request_id) in _spot_requests:
-        return _spot_requests[region, request_id]
+    req = _spot_requests.get((region, request_id))
+    if req is not None:
+        return req
     populate_spot_requests_cache(region)
     return _spot_requests.get((region, request_id))
 
@@ -71,12 +84,13 @@ def get_instances_to_tag(region):
     return rv
 
 
-def copy_spot_request_tags(i):
-    log.debug("Tagging %s", i)
+def get_spot_request_tags(i):
+    """Returns the tags instance `i` needs to get from its spot request, or
+    None if the request can't be found"""
     req = get_spot_request(i.region.name, i.spot_instance_request_id)
     if not req:
         log.debug("Cannot find spot request for %s", i)
-        return
+        return None
     tags = {}
     for tag_name, tag_value in sorted(req.tags.iteritems()):
         if tag_name not in i.tags:
@@ -84,10 +98,44 @@ def copy_spot_request_tags(i):
                      tag_value, i)
             tags[tag_name] = tag_value
     tags["moz-state"] = "ready"
-    retry_aws_request(i.connection.create_tags, [i.id], tags)
+    return tags
 
 
-@lru_cache(10)
+def copy_spot_request_tags(i):
+    log.debug("Tagging %s", i)
+    tags = get_spot_request_tags(i)
+    if tags is None:
+        return
+    i.connection.create_tags([i.id], tags)
+
+
+def group_spot_request_tags(instances, max_group_size=100):
+    """Groups the tags instances need from their spot requests into
+    create_tags calls. Tags shared by several instances (e.g. moz-type) are
+    applied to all of them with one call, and PER_INSTANCE_TAGS with one call
+    per instance. Returns a list of (instances, tags) tuples, none of them
+    longer than max_group_size"""
+    groups = OrderedDict()
+    own = []
+    for i in instances:
+        tags = get_spot_request_tags(i)
+        if tags is None:
+            continue
+        own_tags = dict((name, tags.pop(name)) for name in PER_INSTANCE_TAGS
+                        if name in tags)
+        if own_tags:
+            own.append(([i], own_tags))
+        if tags:
+            key = (i.region.name, tuple(sorted(tags.iteritems())))
+            groups.setdefault(key, []).append(i)
+    rv = []
+    for (_, tags), group in groups.iteritems():
+        for n in range(0, len(group), max_group_size):
+            rv.append((group[n:n + max_group_size], dict(tags)))
+    return rv + own
+
+
+@cache.cached("active_spot_requests", maxsize=10)
 def get_active_spot_requests(region):
     """Gets open and active spot requests"""
     log.debug("getting all spot requests for %s", region)
@@ -97,22 +145,117 @@ def get_active_spot_requests(region):
     return spot_requests
 
 
-@lru_cache(100)
-def get_spot_requests(region, instance_type, availability_zone):
-    log.debug("getting filtered spot requests for %s (%s)", availability_zone,
-              instance_type)
-    all_requests = get_active_spot_requests(region)
-    retval = []
-    if not all_requests:
-        return retval
-
-    for r in all_requests:
-        if r.launch_specification.instance_type != instance_type:
-            continue
-        if r.launched_availability_zone != availability_zone:
+def get_ended_spot_requests(region):
+    """Gets closed and cancelled spot requests, which EC2 keeps around for a
+    few hours after they end"""
+    log.debug("getting ended spot requests for %s", region)
+    conn = get_aws_connection(region)
+    return conn.get_all_spot_instance_requests(
+        filters={'state': ['closed', 'cancelled']})
+
+
+def request_update_time(r):
+    """Returns when the status of spot request `r` was last updated, in
+    seconds since the epoch, or None if that's unknown"""
+    try:
+        t = aws_time_to_datetime(r.status.update_time)
+    except iso8601.ParseError:
+        log.debug("Cannot parse the update time of %s", r)
+        return None
+    return calendar.timegm(t.utctimetuple())
+
+
+def is_failed_request(r):
+    """Spot requests which were cancelled or terminated by AWS"""
+    bad_statuses = CANCEL_STATUS_CODES + TERMINATED_BY_AWS_STATUS_CODES
+    return r.status.code in bad_statuses or \
+        r.tags.get("moz-cancel-reason") in bad_statuses
+
+
+class SpotRequestIndex(object):
+    """Spot requests of a region grouped by (instance type, availability
+    zone).
+
+    Update times are parsed once and kept sorted, along with a running count
+    of failed requests, so counting the (failed) requests updated in the last
+    N minutes takes a bisect.
+    """
+
+    def __init__(self, requests):
+        self._requests = defaultdict(list)
+        updates = defaultdict(list)
+        for r in requests or []:
+            key = (r.launch_specification.instance_type,
+                   r.launched_availability_zone)
+            self._requests[key].append(r)
+            t = request_update_time(r)
+            if t is not None:
+                updates[key].append((t, is_failed_request(r)))
+
+        self._times = {}
+        self._failures = {}
+        for key, events in updates.iteritems():
+            events.sort()
+            self._times[key] = [update for update, _ in events]
+            # _failures[key][n] is the number of failures in the first n
+            failures = [0]
+            for _, failed in events:
+                failures.append(failures[-1] + failed)
+            self._failures[key] = failures
+
+    def requests(self, instance_type, availability_zone):
+        return self._requests.get((instance_type, availability_zone), [])
+
+    def recent(self, instance_type, availability_zone, minutes, now=None):
+        """Returns the number of requests updated in the last `minutes`
+        minutes, and how many of them failed"""
+        key = (instance_type, availability_zone)
+        times = self._times.get(key)
+        if not times:
+            return 0, 0
+        if now is None:
+            now = time.time()
+        start = bisect_right(times, now - minutes * 60)
+        failures = self._failures[key]
+        return len(times) - start, failures[-1] - failures[start]
+
+
+def record_spot_request_outcomes(region, requests):
+    """Feeds failed and fulfilled spot requests to the failure tracker, as of
+    their last status update"""
+    tracker = get_failure_tracker()
+    outcomes = []
+    for r in requests or []:
+        if is_failed_request(r):
+            failed = True
+        elif r.status.code == "fulfilled":
+            failed = False
+        else:
             continue
-        retval.append(r)
-    return retval
+        outcomes.append((request_update_time(r), r, failed))
+    # Oldest first; requests without an update time count as of now
+    now = time.time()
+    outcomes.sort(key=lambda o: now if o[0] is None else o[0])
+    for update_time, r, failed in outcomes:
+        tracker.record_request(r.id, region,
+                               r.launch_specification.instance_type,
+                               r.launched_availability_zone, failed,
+                               now=update_time)
+    tracker.prune()
+
+
+@cache.cached("spot_request_index", maxsize=10)
+def get_spot_request_index(region):
+    requests = get_active_spot_requests(region)
+    # Most failed requests have been closed or cancelled by now
+    record_spot_request_outcomes(
+        region, list(requests or []) + list(get_ended_spot_requests(region)))
+    return SpotRequestIndex(requests)
+
+
+def get_spot_requests(region, instance_type, availability_zone):
+    return get_spot_request_index(region).requests(instance_type,
+                                                   availability_zone)
 
 
 def get_spot_requests_for_moztype(region, moz_instance_type):
@@ -121,7 +264,7 @@ def get_spot_requests_for_moztype(region, moz_instance_type):
     return [r for r in req if r.tags.get('moz-type') == moz_instance_type]
 
 
-@lru_cache(100)
+@cache.cached("usable_spot_choice", maxsize=100)
 def usable_spot_choice(choice, minutes=15):
     """Sanity check recent spot requests"""
     region = choice.region
@@ -136,33 +279,17 @@ def usable_spot_choice(choice, minutes=15):
         log.debug("Price is higher than 80%% of ours, %s", choice)
         return False
 
-    spot_requests = get_spot_requests(region, instance_type, az)
-    if not spot_requests:
+    index = get_spot_request_index(region)
+    if not index.requests(instance_type, az):
         log.debug("No available spot requests in last %sm", minutes)
         return True
-    # filter out requests older than 15 min
-    # first, get the tzinfo of one of the requests
-    delta = timedelta(minutes=minutes)
-    recent_spot_requests = []
-    for r in spot_requests:
-        t = aws_time_to_datetime(r.status.update_time)
-        tz = t.tzinfo
-        now = datetime.now(tz)
-        if t > now - delta:
-            recent_spot_requests.append(r)
-
-    if not recent_spot_requests:
+    total, total_bad = index.recent(instance_type, az, minutes)
+    if not total:
         log.debug("No recent spot requests in last %sm", minutes)
         return True
-    bad_statuses = CANCEL_STATUS_CODES + TERMINATED_BY_AWS_STATUS_CODES
-    bad_req = [r for r in spot_requests
-               if r.status.code in bad_statuses or
-               r.tags.get("moz-cancel-reason") in bad_statuses]
     # Do not try if bad ratio is higher than 10%
-    total = len(spot_requests)
-    total_bad = len(bad_req)
     log.debug("Found %s recent, %s bad", total, total_bad)
-    if float(total_bad / total) > 0.10:
+    if total_bad / float(total) > 0.10:
         log.debug("Skipping %s, too many failures (%s out of %s)", choice,
                   total_bad, total)
         return False
@@ -171,36 +298,102 @@ def usable_spot_choice(choice, minutes=15):
     return True
 
 
-_avail_slave_names = {}
+def invalidate_spot_requests_cache(region=None):
+    """Forget cached spot requests and the spot choice checks based on them,
+    either for `region` or for all regions"""
+    if region is None:
+        cache.invalidate("active_spot_requests", "spot_request_index",
+                         "usable_spot_choice", "spot_requests_by_id")
+        return
+    log.debug("invalidating cached spot requests for %s", region)
+    get_active_spot_requests.cache.invalidate((region,))
+    get_spot_request_index.cache.invalidate((region,))
+    usable_spot_choice.cache.invalidate_where(
+        lambda key: key[0].region == region)
+    _spot_requests.invalidate_where(lambda key: key[0] == region)
+
+
+class SlaveNameAllocator(object):
+    """Hands out the free slave names of one (region, moz-type, lifecycle).
+    Free names are kept in a sorted list and handed out lowest first; a name
+    is taken the moment it is handed out, so it can't be handed out twice"""
+
+    def __init__(self, names, used_names):
+        # Sorted in reverse, so the lowest name is at the end
+        self._free = sorted(set(names) - set(used_names), reverse=True)
+        # Names handed out by allocate(); only these can be released
+        self._handed_out = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._free)
+
+    def allocate(self):
+        """Returns a free name and marks it as taken, or None"""
+        with self._lock:
+            if not self._free:
+                return None
+            name = self._free.pop()
+            self._handed_out.add(name)
+            return name
+
+    def release(self, name):
+        """Returns a name that was handed out but not used"""
+        with self._lock:
+            if name in self._handed_out:
+                self._handed_out.discard(name)
+                self._free.append(name)
+                self._free.sort(reverse=True)
+
+
+_slave_name_allocators = {}
+_slave_name_allocators_lock = threading.Lock()
+
+
+def reset_available_slave_names():
+    """Forget slave names handed out by get_available_slave_name"""
+    with _slave_name_allocators_lock:
+        _slave_name_allocators.clear()
+
+
+def get_slave_name_allocator(region, moz_instance_type, is_spot,
+                             all_instances):
+    """Returns the name allocator for (region, moz_instance_type, is_spot),
+    building it from slavealloc, `all_instances` and the active spot requests
+    on first use. Concurrent launches share the same allocator"""
+    key = (region, moz_instance_type, is_spot)
+    with _slave_name_allocators_lock:
+        allocator = _slave_name_allocators.get(key)
+        if allocator is not None:
+            return allocator
+        all_slave_names = get_classified_slaves(is_spot)
+        used_names = set(i.tags.get("Name") for i in all_instances if
+                         i.state != 'terminated')
+        # active spot requests contain pending too
+        used_names.update(r.tags.get("Name") for r in
+                          get_active_spot_requests(region))
+        allocator = SlaveNameAllocator(
+            all_slave_names[moz_instance_type][region], used_names)
+        log.debug("%i slave names available for %s in %s (%s)",
+                  len(allocator), moz_instance_type, region,
+                  "spot" if is_spot else "ondemand")
+        _slave_name_allocators[key] = allocator
+        return allocator
 
 
 def get_available_slave_name(region, moz_instance_type, is_spot,
                              all_instances):
-    key = (region, moz_instance_type, is_spot)
-    if key in _avail_slave_names:
-        # cached entry
-        if not _avail_slave_names[key]:
-            return None
-
-        usable = _avail_slave_names[key]
-        if not usable:
-            return None
-        name = usable.pop()
-        _avail_slave_names[key].discard(name)
-        return name
-    else:
-        # populate cache and call again
-        all_slave_names = get_classified_slaves(is_spot)
-        all_used_names = set(i.tags.get("Name") for i in all_instances if
-                             i.state != 'terminated')
-        # used_spot_names contains pending too
-        used_spot_names = set(r.tags.get("Name") for r in
-                              get_active_spot_requests(region))
-        used_names = all_used_names.union(used_spot_names)
-        _avail_slave_names[key] = all_slave_names[moz_instance_type][region] -\
-            used_names
-        return get_available_slave_name(region, moz_instance_type,
-                                        is_spot, all_instances)
+    return get_slave_name_allocator(region, moz_instance_type, is_spot,
+                                    all_instances).allocate()
+
+
+def release_slave_name(region, moz_instance_type, is_spot, name):
+    """Makes a name returned by get_available_slave_name available again"""
+    with _slave_name_allocators_lock:
+        allocator = _slave_name_allocators.get(
+            (region, moz_instance_type, is_spot))
+    if allocator is not None:
+        allocator.release(name)
 
 
 def get_current_spot_prices(connection, product_description, start_time=None,
@@ -208,8 +401,10 @@ def get_current_spot_prices(connection, product_description, start_time=None,
                             ignore_cache=False):
     """
     Get the current spot prices for the region associated with the given
-    connection. This may return cached results. Pass ignore_cache=True to
-    bypass the cache
+    connection. Prices are kept in the spot price store (see
+    cloudtools.aws.spot_prices), so only changes since the last call are
+    fetched. This may return cached results. Pass ignore_cache=True to bypass
+    the cache
 
     Args:
         connection (boto.ec2.Connection): connection to a region
@@ -228,13 +423,18 @@ def get_current_spot_prices(connection, product_description, start_time=None,
             {'us-east-1': {'m1.medium': {'us-east-1a': 0.01}}}
 
     """
-    next_token = None
     region = connection.region.name
-    current_prices = {}
-    cache_key = (region, product_description, start_time, instance_type)
-    if not ignore_cache and cache_key in _spot_cache:
-        log.debug("using cached pricing for %s in %s", instance_type, region)
-        return _spot_cache[cache_key]
+    if ignored_availability_zones is None:
+        ignored_availability_zones = []
+    # Results only include the zones which aren't ignored
+    cache_key = (region, product_description, start_time, instance_type,
+                 tuple(sorted(ignored_availability_zones)))
+    if not ignore_cache:
+        retval = _spot_cache.get(cache_key)
+        if retval is not None:
+            log.debug("using cached pricing for %s in %s", instance_type,
+                      region)
+            return retval
 
     if not start_time:
         # Default to 24 hours
@@ -242,58 +442,91 @@ def get_current_spot_prices(connection, product_description, start_time=None,
         yesterday = now - timedelta(hours=24)
         start_time = yesterday.isoformat() + "Z"
 
-    if ignored_availability_zones is None:
-        ignored_availability_zones = []
     all_zones = set([az.name for az in connection.get_all_zones()])
     useful_zones = all_zones - set(ignored_availability_zones)
-    remaining = useful_zones
-    log.debug("getting spot prices for instance_type %s in %s, from %s",
-              instance_type, sorted(remaining), start_time)
-    while remaining:
-        all_prices = connection.get_spot_price_history(
+
+    store = get_spot_price_store()
+    fetched_until = store.fetched_until(region, product_description,
+                                        instance_type, useful_zones)
+    if fetched_until and fetched_until > price_time(start_time):
+        # We have the latest price for every zone already, only fetch what
+        # changed since
+        log.debug("getting spot price changes for instance_type %s in %s, "
+                  "from %s", instance_type, region, fetched_until)
+        prices = fetch_spot_prices(connection, product_description,
+                                   instance_type, fetched_until)
+        store.add(region, product_description, instance_type, prices,
+                  fetched_until)
+    else:
+        log.debug("getting spot prices for instance_type %s in %s, from %s",
+                  instance_type, sorted(useful_zones), start_time)
+        prices = fetch_spot_prices(connection, product_description,
+                                   instance_type, start_time, useful_zones)
+        store.add(region, product_description, instance_type, prices)
+
+    retval = {region: store.latest(region, product_description,
+                                   instance_type, useful_zones)}
+    _spot_cache.put(cache_key, retval)
+    return retval
+
+
+def fetch_spot_prices(connection, product_description, instance_type,
+                      start_time, zones=None):
+    """Returns the spot price history since `start_time`. If `zones` is
+    given, stops as soon as there is a price for each of them"""
+    next_token = None
+    remaining = set(zones or [])
+    rv = []
+    while True:
+        prices = connection.get_spot_price_history(
             product_description=product_description,
             instance_type=instance_type,
             start_time=start_time,
             max_results=50,
             next_token=next_token,
         )
-        next_token = all_prices.next_token
-        # make sure to sort them by the timestamp, so we don't process the same
-        # entry twice
-        all_prices = sorted(all_prices, key=lambda x: x.timestamp,
-                            reverse=True)
-        for price in all_prices:
-            az = price.availability_zone
-            if az not in remaining:
-                continue
-            inst_type = price.instance_type
-            if not current_prices.get(inst_type):
-                current_prices[inst_type] = {}
-            if not current_prices[inst_type].get(az):
-                current_prices[inst_type][az] = price.price
-                remaining.remove(az)
-
-        if remaining:
+        next_token = prices.next_token
+        rv.extend(prices)
+        if zones is not None:
+            remaining -= set(p.availability_zone for p in prices)
+            if not remaining:
+                break
             log.debug("getting more prices for %s", sorted(remaining))
         if not next_token:
-            log.debug("ran out of prices, need an earlier start time than %s",
-                      start_time)
+            if remaining:
+                log.debug("ran out of prices, need an earlier start time "
+                          "than %s", start_time)
             break
+    return rv
 
-    retval = {region: current_prices}
-    _spot_cache[cache_key] = retval
-    return retval
 
+class Spot(object):
+    """An immutable spot choice. Its value (price per unit of performance,
+    times a penalty for failing markets) is computed once, and hashing and
+    equality use a tuple of its fields"""
+    __slots__ = ("instance_type", "region", "availability_zone",
+                 "current_price", "bid_price", "performance_constant",
+                 "penalty", "value", "_key")
 
-class Spot:
     def __init__(self, instance_type, region, availability_zone, current_price,
-                 bid_price, performance_constant):
-        self.instance_type = instance_type
-        self.region = region
-        self.availability_zone = availability_zone
-        self.current_price = current_price
-        self.bid_price = bid_price
-        self.performance_constant = performance_constant
+                 bid_price, performance_constant, penalty=1.0):
+        init = super(Spot, self).__setattr__
+        init("instance_type", instance_type)
+        init("region", region)
+        init("availability_zone", availability_zone)
+        init("current_price", current_price)
+        init("bid_price", bid_price)
+        init("performance_constant", performance_constant)
+        init("penalty", penalty)
+        init("value", current_price / float(performance_constant) * penalty)
+        init("_key", (instance_type, region, availability_zone, current_price,
+                      bid_price, performance_constant, penalty))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Spot is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Spot is immutable")
 
     def __repr__(self):
         return "%s (%s, %s) %g (value: %g) < %g" % (
@@ -304,45 +537,114 @@ class Spot:
         return self.__repr__()
 
     def __hash__(self):
-        return hash(self.__repr__())
+        return hash(self._key)
+
+    def __eq__(self, other):
+        return isinstance(other, Spot) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    # Choices are ordered by value
+    def __lt__(self, other):
+        return self.value < other.value
 
-    @property
-    def value(self):
-        return self.current_price / float(self.performance_constant)
+    def __le__(self, other):
+        return self.value <= other.value
 
-    def __cmp__(self, other):
-        return cmp(self.value, other.value)
+    def __gt__(self, other):
+        return self.value > other.value
+
+    def __ge__(self, other):
+        return self.value >= other.value
+
+
+class SpotPriceTable(object):
+    """Candidate spot prices, one row per (rule, region, availability zone).
+
+    Rows are kept in columns so they can be scored, filtered and ranked in
+    one pass, and Spot objects are only built for the usable ones.
+    """
+
+    def __init__(self):
+        self.instance_types = []
+        self.regions = []
+        self.availability_zones = []
+        self.prices = []
+        self.bid_prices = []
+        self.performance_constants = []
+        self.penalties = []
+
+    def add(self, instance_type, region, availability_zone, price, bid_price,
+            performance_constant, penalty=1.0):
+        self.instance_types.append(instance_type)
+        self.regions.append(region)
+        self.availability_zones.append(availability_zone)
+        self.prices.append(price)
+        self.bid_prices.append(bid_price)
+        self.performance_constants.append(performance_constant)
+        self.penalties.append(penalty)
+
+    def __len__(self):
+        return len(self.prices)
+
+    def values(self):
+        """Price per unit of performance times the penalty, per row"""
+        return [price / float(pc) * penalty for price, pc, penalty in
+                izip(self.prices, self.performance_constants, self.penalties)]
+
+    def ranked(self, max_bid_ratio=0.8):
+        """Returns Spot choices for the rows priced at most max_bid_ratio of
+        their bid, best value first"""
+        values = self.values()
+        rows = [n for n, (price, bid_price) in
+                enumerate(izip(self.prices, self.bid_prices))
+                if price <= bid_price * max_bid_ratio]
+        log.debug("%i of %i spot prices too expensive", len(self) - len(rows),
+                  len(self))
+        rows.sort(key=values.__getitem__)
+        return [Spot(instance_type=self.instance_types[n],
+                     region=self.regions[n],
+                     availability_zone=self.availability_zones[n],
+                     current_price=self.prices[n],
+                     bid_price=self.bid_prices[n],
+                     performance_constant=self.performance_constants[n],
+                     penalty=self.penalties[n])
+                for n in rows]
 
 
 def get_spot_choices(connections, rules, product_description, start_time=None):
-    choices = []
-    prices = {}
-    for rule in rules:
+    connections_by_region = OrderedDict((c.region.name, c)
+                                        for c in connections)
+
+    def get_region_prices(region):
+        # One lookup per rule, all in this region's thread
+        return [get_current_spot_prices(
+                connections_by_region[region], product_description,
+                start_time, rule["instance_type"],
+                rule.get("ignored_azs", []))[region]
+                for rule in rules]
+
+    # Regions we cannot get prices for are skipped
+    prices = region_map(get_region_prices, connections_by_region,
+                        ignore_errors=True)
+
+    tracker = get_failure_tracker()
+    table = SpotPriceTable()
+    for n, rule in enumerate(rules):
         instance_type = rule["instance_type"]
-        bid_price = rule["bid_price"]
-        performance_constant = rule["performance_constant"]
         ignored_availability_zones = rule.get("ignored_azs", [])
-        for connection in connections:
-            prices.update(get_current_spot_prices(connection, product_description,
-                                                  start_time, instance_type,
-                                                  ignored_availability_zones))
-
-        for region, region_prices in prices.iteritems():
-            for az, price in region_prices.get(instance_type, {}).iteritems():
+        for region in connections_by_region:
+            if region not in prices:
+                continue
+            region_prices = prices[region][n].get(instance_type, {})
+            for az, price in sorted(region_prices.iteritems()):
                 if az in ignored_availability_zones:
                     log.debug("Ignoring AZ %s for %s because it is listed in "
                               " ignored_azs: %s", az, instance_type,
                               ignored_availability_zones)
                     continue
-                if price > bid_price * 0.8:
-                    log.debug("%s (in %s) too expensive for %s", price, az,
-                              instance_type)
-                else:
-                    choices.append(
-                        Spot(instance_type=instance_type, region=region,
-                             availability_zone=az, current_price=price,
-                             bid_price=bid_price,
-                             performance_constant=performance_constant))
-    # sort by self.value
-    choices.sort()
-    return choices
+                table.add(instance_type, region, az, price,
+                          rule["bid_price"], rule["performance_constant"],
+                          tracker.penalty(region, instance_type, az))
+    return table.ranked()
@@ -0,0 +1,146 @@
+"""Tracks how often spot requests fail per market.
+
+A market is a (region, instance type, availability zone). Every outcome
+(failed or fulfilled) of every spot request is counted once, and the counts
+decay exponentially so the tracker follows the market as it changes. The
+resulting penalty is folded into Spot.value, so markets which keep failing
+look more expensive than they are.
+"""
+import logging
+import os
+import threading
+import time
+
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+log = logging.getLogger(__name__)
+# Outcomes lose half of their weight every HALF_LIFE seconds
+HALF_LIFE = 30 * 60
+# A market where every request fails looks (1 + PENALTY_WEIGHT) times as
+# expensive
+PENALTY_WEIGHT = 1.0
+# Forget which requests were counted after this long
+SEEN_TTL = 24 * 3600
+
+
+class SpotFailureTracker(object):
+    """Decayed failure counts per spot market"""
+
+    def __init__(self, half_life=HALF_LIFE, penalty_weight=PENALTY_WEIGHT):
+        self.half_life = half_life
+        self.penalty_weight = penalty_weight
+        # market -> (failures, total, updated)
+        self._markets = {}
+        # (request id, outcome) -> when it was counted
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def _decayed(self, market, now):
+        failures, total, updated = self._markets.get(market, (0.0, 0.0, now))
+        decay = 0.5 ** (max(0, now - updated) / float(self.half_life))
+        return failures * decay, total * decay
+
+    def record(self, region, instance_type, availability_zone, failed,
+               now=None):
+        """Counts one outcome in a market, which happened at `now`"""
+        if now is None:
+            now = time.time()
+        market = (region, instance_type, availability_zone)
+        with self._lock:
+            updated = self._markets.get(market, (0, 0, now))[2]
+            if now >= updated:
+                failures, total = self._decayed(market, now)
+                self._markets[market] = (failures + bool(failed), total + 1,
+                                         now)
+                return
+            # Older than the last outcome: count it with the weight it has
+            # left by then
+            failures, total, _ = self._markets[market]
+            weight = 0.5 ** ((updated - now) / float(self.half_life))
+            self._markets[market] = (failures + bool(failed) * weight,
+                                     total + weight, updated)
+
+    def record_request(self, request_id, region, instance_type,
+                       availability_zone, failed, now=None):
+        """Counts the outcome of a spot request, unless it has been counted
+        before"""
+        if now is None:
+            now = time.time()
+        key = (request_id, bool(failed))
+        with self._lock:
+            if key in self._seen:
+                return
+            self._seen[key] = now
+        self.record(region, instance_type, availability_zone, failed, now)
+
+    def prune(self, now=None):
+        """Forgets requests counted more than SEEN_TTL ago"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            for key, counted in self._seen.items():
+                if counted < now - SEEN_TTL:
+                    del self._seen[key]
+
+    def failure_rate(self, region, instance_type, availability_zone,
+                     now=None):
+        if now is None:
+            now = time.time()
+        market = (region, instance_type, availability_zone)
+        with self._lock:
+            failures, total = self._decayed(market, now)
+        # An imaginary success keeps a single failure from counting as 100%
+        return failures / (total + 1)
+
+    def penalty(self, region, instance_type, availability_zone, now=None):
+        """Factor to multiply a market's value with"""
+        return 1 + self.penalty_weight * self.failure_rate(
+            region, instance_type, availability_zone, now)
+
+    def dump(self, f):
+        with self._lock:
+            json.dump({
+                "markets": [list(m) + list(v)
+                            for m, v in self._markets.iteritems()],
+                "seen": [list(k) + [v] for k, v in self._seen.iteritems()],
+            }, f)
+
+    def load(self, f):
+        data = json.load(f)
+        with self._lock:
+            for region, instance_type, az, failures, total, updated in \
+                    data["markets"]:
+                self._markets[(region, instance_type, az)] = (
+                    failures, total, updated)
+            for request_id, failed, counted in data["seen"]:
+                self._seen[(request_id, failed)] = counted
+
+
+_tracker = SpotFailureTracker()
+
+
+def get_failure_tracker():
+    return _tracker
+
+
+def load_failures(path):
+    """Loads the tracker state saved by save_failures(), if there is any"""
+    try:
+        with open(path) as f:
+            _tracker.load(f)
+    except IOError:
+        log.debug("No spot failure history in %s", path)
+    except (ValueError, KeyError):
+        log.warn("Ignoring corrupt spot failure history in %s", path,
+                 exc_info=True)
+
+
+def save_failures(path):
+    tmp = "%s.tmp" % path
+    with open(tmp, "w") as f:
+        _tracker.dump(f)
+    os.rename(tmp, path)
@@ -0,0 +1,177 @@
+"""Local store of spot price history.
+
+Spot prices are kept in SQLite, so callers only need to ask EC2 for records
+newer than the last ones they have seen, and the latest price per
+availability zone is answered from an index instead of by paging through the
+history again. How far the history has been fetched is tracked per
+availability zone, since a fetch may stop before every zone had a price.
+Old records are pruned as new ones come in.
+"""
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+from . import aws_time_to_datetime
+
+log = logging.getLogger(__name__)
+# Records older than this are dropped, unless they are still the latest price
+# for their availability zone
+HISTORY_DAYS = 7
+# Seconds between prunes
+PRUNE_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS spot_prices (
+    region TEXT NOT NULL,
+    product_description TEXT NOT NULL,
+    instance_type TEXT NOT NULL,
+    availability_zone TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    price REAL NOT NULL,
+    PRIMARY KEY (region, product_description, instance_type,
+                 availability_zone, timestamp)
+);
+DROP TABLE IF EXISTS spot_price_fetches;
+CREATE TABLE IF NOT EXISTS spot_price_zone_fetches (
+    region TEXT NOT NULL,
+    product_description TEXT NOT NULL,
+    instance_type TEXT NOT NULL,
+    availability_zone TEXT NOT NULL,
+    fetched_until TEXT NOT NULL,
+    PRIMARY KEY (region, product_description, instance_type,
+                 availability_zone)
+);
+"""
+
+
+def price_time(t):
+    """Normalizes AWS timestamps so they sort as strings"""
+    return aws_time_to_datetime(t).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class SpotPriceStore(object):
+    """Spot price history, kept in the SQLite database at `path`"""
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self.prune()
+
+    def fetched_until(self, region, product_description, instance_type,
+                      availability_zones):
+        """Returns the timestamp up to which prices have been fetched for all
+        of `availability_zones`, or None if some of them haven't been
+        fetched yet"""
+        if not availability_zones:
+            return None
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT availability_zone, fetched_until FROM "
+                "spot_price_zone_fetches WHERE region=? AND "
+                "product_description=? AND instance_type=?",
+                (region, product_description, instance_type or "")
+            ).fetchall()
+        fetched = dict(rows)
+        if not set(availability_zones) <= set(fetched):
+            return None
+        return min(fetched[az] for az in availability_zones)
+
+    def add(self, region, product_description, instance_type, prices,
+            start_time=None):
+        """Stores `prices` (boto SpotPriceHistory objects, newest first)
+        fetched for `instance_type` (None for all types). They're complete up
+        to the newest one for the zones they include, and, if they cover
+        everything since `start_time`, for the zones fetched up to
+        `start_time` before"""
+        rows = [(region, product_description, p.instance_type,
+                 p.availability_zone, price_time(p.timestamp), p.price)
+                for p in prices]
+        if not rows:
+            return
+        newest = max(r[4] for r in rows)
+        fetch_key = (region, product_description, instance_type or "")
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO spot_prices VALUES (?, ?, ?, ?, ?, ?)",
+                rows)
+            fetched = dict(self._db.execute(
+                "SELECT availability_zone, fetched_until FROM "
+                "spot_price_zone_fetches WHERE region=? AND "
+                "product_description=? AND instance_type=?",
+                fetch_key).fetchall())
+            zones = set(r[3] for r in rows)
+            if start_time:
+                start_time = price_time(start_time)
+                zones.update(az for az, until in fetched.iteritems()
+                             if until >= start_time)
+            self._db.executemany(
+                "INSERT OR REPLACE INTO spot_price_zone_fetches VALUES "
+                "(?, ?, ?, ?, ?)",
+                [fetch_key + (az, newest) for az in zones
+                 if fetched.get(az, "") < newest])
+        if time.time() - self._pruned > PRUNE_INTERVAL:
+            self.prune()
+
+    def latest(self, region, product_description, instance_type=None,
+               availability_zones=None):
+        """Returns the latest known prices as a mapping of instance type to a
+        mapping of availability zone to price"""
+        query = """
+            SELECT instance_type, availability_zone, price, max(timestamp)
+            FROM spot_prices
+            WHERE region=? AND product_description=?"""
+        params = [region, product_description]
+        if instance_type:
+            query += " AND instance_type=?"
+            params.append(instance_type)
+        query += " GROUP BY instance_type, availability_zone"
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        rv = {}
+        for inst_type, az, price, _ in rows:
+            if availability_zones is not None and \
+                    az not in availability_zones:
+                continue
+            rv.setdefault(inst_type, {})[az] = price
+        return rv
+
+    def prune(self, days=HISTORY_DAYS):
+        """Drops old records which have been superseded"""
+        self._pruned = time.time()
+        cutoff = (datetime.utcnow() - timedelta(days=days)).strftime(
+            "%Y-%m-%dT%H:%M:%SZ")
+        with self._lock, self._db:
+            self._db.execute("""
+                DELETE FROM spot_prices
+                WHERE timestamp < ? AND timestamp < (
+                    SELECT max(p.timestamp) FROM spot_prices p
+                    WHERE p.region=spot_prices.region AND
+                          p.product_description=spot_prices.product_description
+                          AND p.instance_type=spot_prices.instance_type AND
+                          p.availability_zone=spot_prices.availability_zone)
+                """, (cutoff,))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def set_spot_price_db(path):
+    """Keeps spot prices in the SQLite database at `path` from now on"""
+    global _store
+    with _store_lock:
+        _store = SpotPriceStore(path)
+
+
+def get_spot_price_store():
+    """Returns the process wide store. It lives in memory unless
+    set_spot_price_db() was called"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SpotPriceStore()
+        return _store
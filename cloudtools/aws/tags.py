@@ -0,0 +1,178 @@
+"""Applies tags to new EC2 resources in the background.
+
+Freshly created spot requests and instances often aren't visible to
+CreateTags for a while. Rather than blocking the caller until they are, tag
+writes are queued and applied by a worker thread, which batches writes with
+the same tags in the same region into one create_tags call and retries them
+until EC2 catches up. Call flush() before relying on the tags being there,
+or result() on the write returned by add_tags().
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from boto.exception import BotoServerError
+
+from . import get_aws_connection
+
+log = logging.getLogger(__name__)
+# Errors which go away if we wait a bit
+RETRY_CODES = ("InvalidSpotInstanceRequestID.NotFound",
+               "InvalidInstanceID.NotFound", "InvalidAMIID.NotFound",
+               "RequestLimitExceeded")
+
+
+class TagWrite(object):
+    """Tags to apply to some resources in a region"""
+
+    def __init__(self, region, resource_ids, tags, not_before):
+        self.region = region
+        self.resource_ids = list(resource_ids)
+        self.tags = dict(tags)
+        self.not_before = not_before
+        self.tries = 0
+        self.error = None
+        self._done = threading.Event()
+
+    def batch_key(self):
+        return self.region, tuple(sorted(self.tags.items()))
+
+    def finish(self, error=None):
+        """Marks the write as applied, or given up on because of `error`"""
+        if self._done.is_set():
+            return
+        self.error = error
+        self._done.set()
+
+    def result(self):
+        """Waits until the tags are applied. Raises the last error if they
+        couldn't be"""
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class TagQueue(object):
+    """Queue of tag writes, applied by a background thread"""
+
+    def __init__(self, initial_delay=0.5, max_tries=10, max_sleep=30):
+        self.initial_delay = initial_delay
+        self.max_tries = max_tries
+        self.max_sleep = max_sleep
+        self._pending = []
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, region, resource_ids, tags):
+        """Queues `tags` to be applied to `resource_ids`. Returns the
+        TagWrite"""
+        write = TagWrite(region, resource_ids, tags,
+                         time.time() + self.initial_delay)
+        with self._cond:
+            self._pending.append(write)
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name="tag-queue")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+        return write
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending) + self._in_flight
+
+    def flush(self, timeout=None):
+        """Waits until all queued writes are applied or given up on. Returns
+        False if some are still pending after `timeout` seconds"""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                if deadline is None:
+                    self._cond.wait(1)
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _next_due(self):
+        """Waits for and returns the writes which are due"""
+        with self._cond:
+            while True:
+                now = time.time()
+                due = [w for w in self._pending if w.not_before <= now]
+                if due:
+                    self._pending = [w for w in self._pending
+                                     if w.not_before > now]
+                    self._in_flight += len(due)
+                    return due
+                if self._pending:
+                    self._cond.wait(min(w.not_before for w in self._pending)
+                                    - now)
+                else:
+                    self._cond.wait()
+
+    def _run(self):
+        while True:
+            due = self._next_due()
+            try:
+                retry = self.apply(due)
+            except Exception, e:
+                log.error("Cannot apply tags", exc_info=True)
+                for w in due:
+                    w.finish(e)
+                retry = []
+            with self._cond:
+                self._pending.extend(retry)
+                self._in_flight -= len(due)
+                self._cond.notify_all()
+
+    def apply(self, writes):
+        """Applies `writes`, batching them by region and tags. Returns the
+        writes which should be retried later"""
+        batches = defaultdict(list)
+        for w in writes:
+            batches[w.batch_key()].append(w)
+
+        retry = []
+        for (region, tags), batch in batches.iteritems():
+            resource_ids = [r for w in batch for r in w.resource_ids]
+            try:
+                get_aws_connection(region).create_tags(resource_ids,
+                                                       dict(tags))
+                log.debug("tagged %s with %s", resource_ids, tags)
+                for w in batch:
+                    w.finish()
+            except BotoServerError, e:
+                log.debug("%s while tagging %s", e.code, resource_ids)
+                for w in batch:
+                    w.tries += 1
+                    if e.code in RETRY_CODES and w.tries < self.max_tries:
+                        w.not_before = time.time() + min(
+                            self.max_sleep, 5 * 1.5 ** (w.tries - 1))
+                        retry.append(w)
+                    else:
+                        log.error("Cannot tag %s with %s", w.resource_ids,
+                                  w.tags, exc_info=True)
+                        w.finish(e)
+        return retry
+
+
+_tag_queue = TagQueue()
+
+
+def add_tags(region, resource_ids, tags):
+    """Tags `resource_ids` in the background. Returns a TagWrite; call its
+    result() to wait for the tags"""
+    return _tag_queue.add(region, resource_ids, tags)
+
+
+def flush_tags(timeout=None):
+    """Waits for the queued tags to be applied"""
+    return _tag_queue.flush(timeout)
@@ -1,8 +1,10 @@
+import heapq
 import logging
-from collections import namedtuple
+import threading
+from collections import defaultdict
 from IPy import IP
-from repoze.lru import lru_cache
-from . import get_vpc, get_aws_connection
+from . import get_vpc, get_aws_connection, iter_instances
+from .. import cache
 from .spot import get_active_spot_requests
 
 log = logging.getLogger(__name__)
@@ -16,46 +18,122 @@ def get_subnet_id(vpc, ip):
     return None
 
 
-def ip_available(region, ip):
+@cache.cached("used_ips", maxsize=10)
+def get_used_ips(region):
+    """Returns the private IPs of all instances and network interfaces in
+    `region`. The result is cached; see ip_available for refreshing it"""
+    used = set(i.private_ip_address for i in iter_instances(region))
     conn = get_aws_connection(region)
-    instances = conn.get_only_instances()
-    ips = [i.private_ip_address for i in instances]
-    interfaces = conn.get_all_network_interfaces()
-    ips.extend(i.private_ip_address for i in interfaces)
-    if ip in ips:
-        return False
-    else:
-        return True
+    for interface in conn.get_all_network_interfaces():
+        used.add(interface.private_ip_address)
+        used.update(a.private_ip_address
+                    for a in interface.private_ip_addresses)
+    used.discard(None)
+    log.debug("%i private IPs used in %s", len(used), region)
+    return frozenset(used)
 
 
-@lru_cache(100)
+def ip_available(region, ip, refresh=False):
+    """Checks `ip` against the used IPs of `region`, which are fetched once
+    and shared by all checks. Pass refresh=True to fetch them again"""
+    if refresh:
+        get_used_ips.cache.invalidate((region,))
+    return ip not in get_used_ips(region)
+
+
+@cache.cached("subnets", maxsize=100)
 def get_all_subnets(region, subnet_ids):
     vpc = get_vpc(region)
     return vpc.get_all_subnets(subnet_ids=subnet_ids)
 
 
-def get_avail_subnet(region, subnet_ids, availability_zone):
+class SubnetCapacity(object):
+    """Free IPs of a set of subnets, less the IPs open spot requests will
+    take. Subnets are kept in a heap per availability zone, ordered by free
+    IPs, and every subnet handed out by pick() loses an IP right away. Build
+    a new one for every scheduling run."""
     # Minimum IPs in a subnet to qualify it as usable
     min_ips = 2
-    subnets = [s for s in get_all_subnets(region, tuple(subnet_ids))
-               if s.available_ip_address_count > min_ips and
-               s.availability_zone == availability_zone]
-    pending_spot_req = [sr for sr in get_active_spot_requests(region) if
-                        sr.state == 'open']
-    usable_subnets = []
-    UsableSubnet = namedtuple("UsableSubnet", ["subnet", "usable_ips"])
-    for s in subnets:
-        # Subtract pending requests from available IP count
-        pending_req = [sr for sr in pending_spot_req if
-                       sr.launch_specification.subnet_id == s.id]
-        usable_ips = s.available_ip_address_count - len(pending_req)
-        if usable_ips > min_ips:
-            usable_subnets.append(UsableSubnet(s, usable_ips))
-
-    if not usable_subnets:
+
+    def __init__(self, subnets, spot_requests):
+        pending = defaultdict(int)
+        for sr in spot_requests:
+            if sr.state == 'open':
+                pending[sr.launch_specification.subnet_id] += 1
+        # availability zone -> [(-usable IPs, n, subnet id)]
+        self._heaps = defaultdict(list)
+        # subnet id -> (availability zone, n)
+        self._subnets = {}
+        for n, s in enumerate(subnets):
+            # Subtract pending requests from available IP count
+            usable_ips = s.available_ip_address_count - pending[s.id]
+            if usable_ips > self.min_ips:
+                self._heaps[s.availability_zone].append(
+                    (-usable_ips, n, s.id))
+                self._subnets[s.id] = (s.availability_zone, n)
+        for heap in self._heaps.itervalues():
+            heapq.heapify(heap)
+        self._lock = threading.Lock()
+
+    def pick(self, availability_zone):
+        """Returns the id of the subnet in `availability_zone` with the most
+        usable IPs and takes one of them, or None"""
+        with self._lock:
+            heap = self._heaps.get(availability_zone)
+            if not heap:
+                return None
+            usable_ips, n, subnet_id = heap[0]
+            if -usable_ips - 1 > self.min_ips:
+                heapq.heapreplace(heap, (usable_ips + 1, n, subnet_id))
+            else:
+                heapq.heappop(heap)
+            return subnet_id
+
+    def release(self, subnet_id):
+        """Gives back an IP of `subnet_id` taken by pick() but not used"""
+        with self._lock:
+            if subnet_id not in self._subnets:
+                return
+            availability_zone, n = self._subnets[subnet_id]
+            heap = self._heaps[availability_zone]
+            for i, (usable_ips, _, s) in enumerate(heap):
+                if s == subnet_id:
+                    heap[i] = (usable_ips - 1, n, subnet_id)
+                    heapq.heapify(heap)
+                    return
+            # pick() dropped it when it got down to the minimum
+            heapq.heappush(heap, (-(self.min_ips + 1), n, subnet_id))
+
+
+_subnet_capacity = cache.namespace("subnet_capacity", maxsize=100)
+_subnet_capacity_lock = threading.Lock()
+
+
+def get_subnet_capacity(region, subnet_ids):
+    """Returns the capacity model of `subnet_ids`. Concurrent launches share
+    the same one"""
+    key = (region, subnet_ids)
+    with _subnet_capacity_lock:
+        capacity = _subnet_capacity.get(key)
+        if capacity is None:
+            capacity = SubnetCapacity(get_all_subnets(region, subnet_ids),
+                                      get_active_spot_requests(region))
+            _subnet_capacity.put(key, capacity)
+        return capacity
+
+
+def get_avail_subnet(region, subnet_ids, availability_zone):
+    subnet_id = get_subnet_capacity(region, tuple(subnet_ids)).pick(
+        availability_zone)
+    if not subnet_id:
         log.debug("No free IP available in %s for subnets %s",
                   availability_zone, subnet_ids)
-        return None
-    # sort by usable IP address count
-    usable_subnets.sort(key=lambda x: x.usable_ips, reverse=True)
-    return usable_subnets[0].subnet.id
+    return subnet_id
+
+
+def release_subnet(region, subnet_ids, subnet_id):
+    """Gives back an IP of a subnet returned by get_avail_subnet which won't
+    be used after all"""
+    capacity = _subnet_capacity.get((region, tuple(subnet_ids)))
+    if capacity is not None:
+        capacity.release(subnet_id)
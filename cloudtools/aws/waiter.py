@@ -0,0 +1,232 @@
+"""Waits for EC2 resources to reach a state.
+
+A single background thread polls every resource somebody is waiting for.
+Resources of the same type on the same connection (instances, volumes,
+snapshots or images) are refreshed with one describe call per poll. Each
+group of resources is polled every MIN_INTERVAL seconds at first. The
+interval grows up to MAX_INTERVAL while nothing in the group reaches its
+state, and drops back once something does. Waits are returned as Wait
+objects; block on result() or register a callback with
+add_done_callback(). Callbacks run in a thread of their own, so they can't
+hold up polling.
+"""
+import logging
+import threading
+import time
+
+from boto.ec2.image import Image
+from boto.ec2.instance import Instance
+from boto.ec2.snapshot import Snapshot
+from boto.ec2.volume import Volume
+
+log = logging.getLogger(__name__)
+MIN_INTERVAL = 1
+MAX_INTERVAL = 15
+# Resource type -> (connection method, its keyword for resource ids)
+DESCRIBE = {
+    Instance: ("get_only_instances", "instance_ids"),
+    Volume: ("get_all_volumes", "volume_ids"),
+    Snapshot: ("get_all_snapshots", "snapshot_ids"),
+    Image: ("get_all_images", "image_ids"),
+}
+
+
+class WaitTimeout(Exception):
+    pass
+
+
+class Wait(object):
+    """A pending wait for `obj`.`attr_name` to become `attr_value` (or one of
+    them, if a tuple is given)"""
+
+    def __init__(self, obj, attr_name, attr_value, update_method="update"):
+        self.obj = obj
+        self.attr_name = attr_name
+        if not isinstance(attr_value, tuple):
+            attr_value = (attr_value,)
+        self.attr_values = attr_value
+        self.update_method = update_method
+        self._event = threading.Event()
+        self._finished = False
+        self._callbacks = []
+        self._error = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Wait for %s.%s in %s>" % (self.obj, self.attr_name,
+                                           self.attr_values)
+
+    def matches(self):
+        return getattr(self.obj, self.attr_name, None) in self.attr_values
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the resource and returns it. Callbacks registered
+        before the resource was ready have run by then; if one of them
+        failed, its error is raised"""
+        if not self._event.wait(timeout):
+            raise WaitTimeout("Timed out: %r" % self)
+        if self._error is not None:
+            raise self._error
+        return self.obj
+
+    def add_done_callback(self, callback):
+        """Calls callback(wait) once the resource is ready"""
+        with self._lock:
+            if not self._finished:
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception, e:
+            log.exception("%r callback failed", self)
+            if self._error is None:
+                self._error = e
+
+    def update(self):
+        """Refreshes the resource on its own"""
+        getattr(self.obj, self.update_method)()
+
+    def finish(self):
+        """Marks the resource as ready and runs the callbacks in the
+        background"""
+        with self._lock:
+            self._finished = True
+            callbacks, self._callbacks = self._callbacks, []
+        if not callbacks:
+            self._event.set()
+            return
+        t = threading.Thread(target=self._run_callbacks, args=(callbacks,),
+                             name="waiter-callbacks")
+        t.daemon = True
+        t.start()
+
+    def _run_callbacks(self, callbacks):
+        for callback in callbacks:
+            self._call(callback)
+        self._event.set()
+
+
+class WaitGroup(object):
+    """Pending waits for resources of one type on one connection"""
+
+    def __init__(self, connection, resource_type):
+        self.connection = connection
+        self.resource_type = resource_type
+        self.waits = []
+        self.interval = MIN_INTERVAL
+        self.next_poll = 0
+
+    def refresh(self, waits):
+        """Updates the resources of `waits`, with a single describe call if
+        possible"""
+        if self.resource_type in DESCRIBE and len(waits) > 1:
+            method, ids_arg = DESCRIBE[self.resource_type]
+            ids = sorted(set(w.obj.id for w in waits))
+            try:
+                fetched = getattr(self.connection, method)(**{ids_arg: ids})
+            except Exception:
+                # e.g. one of them doesn't exist yet
+                log.debug("cannot describe %s; updating them one by one",
+                          ids, exc_info=True)
+            else:
+                by_id = dict((r.id, r) for r in fetched)
+                for w in waits:
+                    if w.obj.id in by_id:
+                        w.obj._update(by_id[w.obj.id])
+                return
+        for w in waits:
+            try:
+                w.update()
+            except Exception:
+                log.debug("hit error waiting for %s", w.obj, exc_info=True)
+
+
+class Waiter(object):
+    """Polls the resources of all pending waits from a background thread"""
+
+    def __init__(self):
+        self._groups = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def wait_for(self, obj, attr_name, attr_value, update_method="update"):
+        """Returns a Wait for `obj`.`attr_name` to become `attr_value`"""
+        w = Wait(obj, attr_name, attr_value, update_method)
+        resource_type = type(obj) if type(obj) in DESCRIBE else None
+        key = (id(getattr(obj, "connection", None)), resource_type)
+        with self._cond:
+            group = self._groups.get(key)
+            if group is None:
+                group = WaitGroup(getattr(obj, "connection", None),
+                                  resource_type)
+                self._groups[key] = group
+            group.waits.append(w)
+            # New resources are polled right away
+            group.interval = MIN_INTERVAL
+            group.next_poll = 0
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name="waiter")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+        return w
+
+    def _next_due(self):
+        """Waits for and returns the groups which are due"""
+        with self._cond:
+            while True:
+                for key, group in self._groups.items():
+                    if not group.waits:
+                        del self._groups[key]
+                now = time.time()
+                due = [g for g in self._groups.itervalues()
+                       if g.next_poll <= now]
+                if due:
+                    # Polls can take a while; don't poll these again
+                    # meanwhile
+                    for g in due:
+                        g.next_poll = now + MAX_INTERVAL
+                    return due
+                if self._groups:
+                    self._cond.wait(min(g.next_poll for g in
+                                        self._groups.itervalues()) - now)
+                else:
+                    self._cond.wait()
+
+    def _run(self):
+        while True:
+            for group in self._next_due():
+                with self._cond:
+                    waits = list(group.waits)
+                group.refresh(waits)
+                done = [w for w in waits if w.matches()]
+                for w in done:
+                    w.finish()
+                with self._cond:
+                    # Their callbacks may still be running
+                    group.waits = [w for w in group.waits if w not in done]
+                    if group.next_poll == 0:
+                        # New waits came in meanwhile
+                        continue
+                    if done:
+                        group.interval = MIN_INTERVAL
+                    else:
+                        group.interval = min(MAX_INTERVAL,
+                                             group.interval * 1.5)
+                    group.next_poll = time.time() + group.interval
+
+
+_waiter = Waiter()
+
+
+def wait_for(obj, attr_name, attr_value, update_method="update"):
+    """Returns a Wait for `obj`.`attr_name` to become `attr_value`. Pass a
+    tuple to accept any of several values"""
+    return _waiter.wait_for(obj, attr_name, attr_value, update_method)
@@ -1,4 +1,5 @@
 import time
+import threading
 import sqlalchemy as sa
 import re
 import logging
@@ -6,51 +7,120 @@ import requests
 from sqlalchemy.engine.reflection import Inspector
 from collections import defaultdict
 
+from .cache import cached
+
 log = logging.getLogger(__name__)
 ACTIVITY_BOOTING, ACTIVITY_STOPPED = ("booting", "stopped")
 
 
+# Engines are kept around so long running processes reuse their connection
+# pool instead of reconnecting for every query
+_engines = {}
+_engines_lock = threading.Lock()
+
+PENDING_QUERY_CLAIMS = """
+    SELECT buildername, count(*) FROM buildrequests
+    WHERE complete=0 AND
+          submitted_at > :yesterday AND
+          submitted_at < :toonew AND
+          NOT EXISTS (SELECT 1 FROM buildrequest_claims
+                      WHERE buildrequest_claims.brid=buildrequests.id)
+    GROUP BY buildername"""
+PENDING_QUERY = """
+    SELECT buildername, count(*) FROM buildrequests
+    WHERE complete=0 AND
+          claimed_at=0 AND
+          submitted_at > :yesterday AND
+          submitted_at < :toonew
+    GROUP BY buildername"""
+
+
+def get_db_engine(dburl):
+    """Returns a pooled engine for `dburl`, shared across calls"""
+    with _engines_lock:
+        if dburl not in _engines:
+            # Recycle connections before MySQL's wait_timeout drops them
+            _engines[dburl] = sa.create_engine(dburl, pool_recycle=3600)
+        return _engines[dburl]
+
+
+@cached("buildbot_schema", maxsize=10)
+def has_buildrequest_claims(dburl):
+    """Newer buildbot has a "buildrequest_claims" table, older doesn't"""
+    inspector = Inspector(get_db_engine(dburl))
+    return "buildrequest_claims" in inspector.get_table_names()
+
+
 def find_pending(dburl):
-    db = sa.create_engine(dburl)
-    inspector = Inspector(db)
-    # Newer buildbot has a "buildrequest_claims" table
-    if "buildrequest_claims" in inspector.get_table_names():
-        query = sa.text("""
-        SELECT buildername, id FROM
-               buildrequests WHERE
-               complete=0 AND
-               submitted_at > :yesterday AND
-               submitted_at < :toonew AND
-               (select count(brid) from buildrequest_claims
-                       where brid=id) = 0""")
-    # Older buildbot doesn't
+    """Returns (buildername, count) pairs of the unclaimed build requests
+    submitted in the last day"""
+    if has_buildrequest_claims(dburl):
+        query = sa.text(PENDING_QUERY_CLAIMS)
     else:
-        query = sa.text("""
-        SELECT buildername, id FROM
-               buildrequests WHERE
-               complete=0 AND
-               claimed_at=0 AND
-               submitted_at > :yesterday AND
-               submitted_at < :toonew""")
-
-    result = db.execute(
+        query = sa.text(PENDING_QUERY)
+
+    result = get_db_engine(dburl).execute(
         query,
         yesterday=time.time() - 86400,
         toonew=time.time() - 10
     )
-    retval = result.fetchall()
-    return retval
+    return [(buildername, count) for buildername, count in result]
+
+
+class BuilderMatcher(object):
+    """Maps builder names to moz instance types.
+
+    `builder_map` maps regular expressions to instance types. They are
+    compiled once and tried in the order of builder_map (use an OrderedDict
+    to keep the config file order); the first match wins. Results are
+    remembered per builder name, since the same builders are pending over
+    and over again.
+    """
+    # Forget remembered builder names after this many
+    MAX_MEMO_SIZE = 50000
+
+    def __init__(self, builder_map):
+        self.patterns = [(re.compile(exp), exp, moz_instance_type)
+                         for exp, moz_instance_type in builder_map.items()]
+        self.matched_patterns = set()
+        self._memo = {}
+
+    def match(self, buildername):
+        """Returns the instance type for `buildername`, or None"""
+        try:
+            return self._memo[buildername]
+        except KeyError:
+            pass
+        moz_instance_type = None
+        for regex, exp, instance_type in self.patterns:
+            if regex.match(buildername):
+                moz_instance_type = instance_type
+                self.matched_patterns.add(exp)
+                break
+        if len(self._memo) >= self.MAX_MEMO_SIZE:
+            self._memo.clear()
+        self._memo[buildername] = moz_instance_type
+        return moz_instance_type
+
+    def unused_patterns(self):
+        """Returns the patterns which haven't matched any builder so far"""
+        return [exp for _, exp, _ in self.patterns
+                if exp not in self.matched_patterns]
 
 
 def map_builders(pending, builder_map):
-    """Map pending builder names to instance types"""
+    """Map (buildername, count) pairs to pending counts per instance type.
+    `builder_map` can be a BuilderMatcher or a dictionary to build one
+    from."""
+    if not isinstance(builder_map, BuilderMatcher):
+        builder_map = BuilderMatcher(builder_map)
     type_map = defaultdict(int)
-    for pending_buildername, _ in pending:
-        for buildername_exp, moz_instance_type in builder_map.items():
-            if re.match(buildername_exp, pending_buildername):
-                log.debug("%s instance type %s", pending_buildername, moz_instance_type)
-                type_map[moz_instance_type] += 1
-                break
+    for pending_buildername, count in pending:
+        moz_instance_type = builder_map.match(pending_buildername)
+        if moz_instance_type:
+            log.debug("%s instance type %s", pending_buildername,
+                      moz_instance_type)
+            type_map[moz_instance_type] += count
         else:
             log.debug("%s has pending jobs, but no instance types defined",
                       pending_buildername)
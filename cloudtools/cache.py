@@ -0,0 +1,117 @@
+"""Process wide caches.
+
+Every cache lives in a named namespace with its own size bound and TTL, so
+long running processes (e.g. aws_watch_pending --daemon) can expire or
+invalidate data selectively. A TTL of None means that entries never expire,
+which is what one-shot scripts want.
+"""
+import logging
+import threading
+from functools import wraps
+from repoze.lru import ExpiringLRUCache
+
+log = logging.getLogger(__name__)
+# Close enough to "never" for ExpiringLRUCache
+NO_EXPIRY = 2 ** 60
+_MARKER = object()
+_namespaces = {}
+_lock = threading.Lock()
+
+
+class Namespace(object):
+    """A size bounded cache with optional expiry and hit/miss counters"""
+
+    def __init__(self, name, maxsize, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache = ExpiringLRUCache(maxsize)
+
+    def get(self, key, default=None):
+        value = self._cache.get(key, _MARKER)
+        if value is _MARKER:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.ttl is None:
+            timeout = NO_EXPIRY
+        else:
+            timeout = self.ttl
+        self._cache.put(key, value, timeout=timeout)
+
+    def __contains__(self, key):
+        return self._cache.get(key, _MARKER) is not _MARKER
+
+    def keys(self):
+        return self._cache.data.keys()
+
+    def invalidate(self, key):
+        self._cache.invalidate(key)
+
+    def invalidate_where(self, predicate):
+        """Drops all entries whose key matches `predicate`"""
+        for key in self.keys():
+            if predicate(key):
+                self._cache.invalidate(key)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._cache.data), "maxsize": self.maxsize,
+                "ttl": self.ttl}
+
+
+def namespace(name, maxsize=100, ttl=None):
+    """Returns the namespace called `name`, creating it if needed"""
+    with _lock:
+        if name not in _namespaces:
+            _namespaces[name] = Namespace(name, maxsize, ttl)
+        return _namespaces[name]
+
+
+def cached(name, maxsize=100, ttl=None):
+    """Decorator caching function results in the `name` namespace, keyed by
+    the call arguments"""
+    ns = namespace(name, maxsize, ttl)
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = args
+            if kwargs:
+                key += tuple(sorted(kwargs.items()))
+            value = ns.get(key, _MARKER)
+            if value is _MARKER:
+                value = f(*args, **kwargs)
+                ns.put(key, value)
+            return value
+        wrapper.cache = ns
+        return wrapper
+    return decorator
+
+
+def set_ttl(name, ttl):
+    """Changes the TTL of a namespace. Applies to entries stored from now on"""
+    namespace(name).ttl = ttl
+
+
+def invalidate(*names):
+    """Clears the given namespaces, or all of them if none are given"""
+    if not names:
+        names = _namespaces.keys()
+    for name in names:
+        if name in _namespaces:
+            log.debug("invalidating %s cache", name)
+            _namespaces[name].clear()
+
+
+def stats():
+    """Returns a mapping of namespace names to their counters"""
+    return dict((name, ns.stats()) for name, ns in _namespaces.items())
@@ -8,10 +8,11 @@ import logging
 import os
 
 from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
+from boto.ec2.image import Image
 from fabric.api import run, put, lcd
 from fabric.context_managers import hide
 from cloudtools.aws import AMI_CONFIGS_DIR, wait_for_status
-from cloudtools.aws.ami import ami_cleanup, copy_ami
+from cloudtools.aws.ami import ami_cleanup, copy_amis
 from cloudtools.aws.instance import run_instance, assimilate_instance
 from cloudtools.fabric import setup_fabric_env
 
@@ -68,14 +69,8 @@ def partition_ebs_volume(int_dev_name):
 
 def attach_and_wait(host_instance, size, aws_dev_name, int_dev_name):
     v = host_instance.connection.create_volume(size, host_instance.placement)
-    while True:
-        try:
-            v.attach(host_instance.id, aws_dev_name)
-            break
-        except:
-            log.debug('waiting for volume to be attached')
-            time.sleep(10)
-
+    wait_for_status(v, "status", "available", "update")
+    v.attach(host_instance.id, aws_dev_name)
     wait_for_status(v, "status", "in-use", "update")
     while True:
         try:
@@ -394,21 +389,17 @@ def create_ami(host_instance, args, config, instance_config, ssh_key,
             block_device_map=block_map,
             virtualization_type=virtualization_type,
         )
-    while True:
-        try:
-            ami = connection.get_image(ami_id)
-            ami.add_tag('Name', dated_target_name)
-            ami.add_tag('moz-created', str(int(time.mktime(time.gmtime()))))
-            if config["target"].get("tags"):
-                for tag, value in config["target"]["tags"].items():
-                    log.info("Tagging %s: %s", tag, value)
-                    ami.add_tag(tag, value)
-            log.info('AMI created')
-            log.info('ID: {id}, name: {name}'.format(id=ami.id, name=ami.name))
-            break
-        except:
-            log.info('Wating for AMI')
-            time.sleep(10)
+    log.info('Waiting for AMI')
+    ami = Image(connection)
+    ami.id = ami_id
+    wait_for_status(ami, "state", "available", "update")
+    tags = {"Name": dated_target_name,
+            "moz-created": str(int(time.mktime(time.gmtime())))}
+    tags.update(config["target"].get("tags") or {})
+    connection.create_tags([ami.id], tags)
+    ami.tags.update(tags)
+    log.info('AMI created')
+    log.info('ID: {id}, name: {name}'.format(id=ami.id, name=ami.name))
 
     # Step 7: Cleanup
     if not args.keep_volume:
@@ -508,10 +499,12 @@ def main():
                      ami_name_prefix=args.ami_name_prefix,
                      key_filename=args.ssh_key)
 
-    for r in args.copy_to_regions:
-        log.info("Copying %s (%s) to %s", ami.id, ami.tags.get("Name"), r)
-        new_ami = copy_ami(ami, r)
-        log.info("New AMI created. AMI ID: %s", new_ami.id)
+    if args.copy_to_regions:
+        log.info("Copying %s (%s) to %s", ami.id, ami.tags.get("Name"),
+                 ", ".join(args.copy_to_regions))
+        copies = copy_amis([ami], args.copy_to_regions)
+        for (_, r), new_ami in sorted(copies.iteritems()):
+            log.info("New AMI created in %s. AMI ID: %s", r, new_ami.id)
 
 
 if __name__ == '__main__':
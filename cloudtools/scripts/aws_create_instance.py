@@ -18,7 +18,7 @@ from cloudtools.aws.instance import assimilate_instance, \
     make_instance_interfaces, user_data_from_template, \
     pick_puppet_master
 from cloudtools.aws.vpc import get_subnet_id, ip_available
-from cloudtools.aws.ami import ami_cleanup, volume_to_ami, copy_ami, \
+from cloudtools.aws.ami import ami_cleanup, volume_to_ami, copy_amis, \
     get_ami
 
 from fabric.network import NetworkError
@@ -309,11 +309,13 @@ def main():
                    create_ami=args.create_ami,
                    ignore_subnet_check=args.ignore_subnet_check,
                    max_attempts=args.max_attempts)
-    for r in args.copy_to_regions:
+    if args.copy_to_regions:
         ami = get_ami(region=args.region, moz_instance_type=config["type"])
-        log.info("Copying %s (%s) to %s", ami.id, ami.tags.get("Name"), r)
-        new_ami = copy_ami(ami, r)
-        log.info("New AMI created. AMI ID: %s", new_ami.id)
+        log.info("Copying %s (%s) to %s", ami.id, ami.tags.get("Name"),
+                 ", ".join(args.copy_to_regions))
+        copies = copy_amis([ami], args.copy_to_regions)
+        for (_, r), new_ami in sorted(copies.iteritems()):
+            log.info("New AMI created in %s. AMI ID: %s", r, new_ami.id)
 
 
 if __name__ == '__main__':
@@ -11,9 +11,9 @@ import json
 import uuid
 import time
 import logging
-import boto
 
 from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
+from boto.ec2.image import Image
 from boto.ec2.networkinterface import NetworkInterfaceSpecification, \
     NetworkInterfaceCollection
 from cloudtools.aws import AMI_CONFIGS_DIR, wait_for_status, get_aws_connection
@@ -84,20 +84,14 @@ def create_ami(host_instance, config_name, config):
     ami_id = connection.create_image(host_instance.id, name=dated_target_name,
                                      description='%s EBS AMI' %
                                      dated_target_name,)
-    while True:
-        try:
-            ami = connection.get_image(ami_id)
-            ami.add_tag('Name', dated_target_name)
-            log.info('AMI created')
-            log.info('ID: {id}, name: {name}'.format(id=ami.id, name=ami.name))
-            break
-        except boto.exception.EC2ResponseError:
-            log.info('Wating for AMI')
-            time.sleep(10)
     log.info("Waiting for AMI")
-    while ami.state != 'available':
-        ami.update()
-        time.sleep(10)
+    ami = Image(connection)
+    ami.id = ami_id
+    wait_for_status(ami, "state", "available", "update")
+    connection.create_tags([ami.id], {"Name": dated_target_name})
+    ami.tags["Name"] = dated_target_name
+    log.info('AMI created')
+    log.info('ID: {id}, name: {name}'.format(id=ami.id, name=ami.name))
     return ami
 
 
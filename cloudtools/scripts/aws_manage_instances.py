@@ -3,7 +3,8 @@
 import argparse
 import logging
 
-from cloudtools.aws import get_aws_connection, DEFAULT_REGIONS
+from cloudtools.aws import DEFAULT_REGIONS, query_instances, \
+    LIVE_INSTANCE_STATES
 from time import gmtime, strftime
 
 log = logging.getLogger(__name__)
@@ -127,34 +128,40 @@ def main():
     if not args.regions:
         args.regions = DEFAULT_REGIONS
 
-    for region in args.regions:
-        conn = get_aws_connection(region)
-        instances = conn.get_only_instances()
-        for i in instances:
-            name = i.tags.get('Name', '')
-            instance_id = i.id
-            if not i.private_ip_address:
-                # Terminated instances has no IP address assinged
-                log.debug("Skipping (terminated?) %s (%s)..." % (name,
-                                                                 instance_id))
-                continue
-            if name in args.hosts or instance_id in args.hosts:
-                log.info("Found %s (%s)..." % (name, instance_id))
-
-                if args.action == "start":
-                    start(i, args.dry_run)
-                elif args.action == "stop":
-                    stop(i, args.dry_run)
-                elif args.action == "restart":
-                    restart(i, args.dry_run)
-                elif args.action == "enable":
-                    enable(i, args.dry_run)
-                elif args.action == "disable":
-                    disable(i, args.dry_run, args.comments)
-                elif args.action == "terminate":
-                    terminate(i, args.dry_run, args.force)
-                elif args.action == "status":
-                    status(i)
+    # Hosts can be given by name or by instance ID
+    instances = []
+    seen_ids = set()
+    for filters in ({"tag:Name": args.hosts}, {"instance-id": args.hosts}):
+        for i in query_instances(args.regions, state=LIVE_INSTANCE_STATES,
+                                 filters=filters):
+            if i.id not in seen_ids:
+                seen_ids.add(i.id)
+                instances.append(i)
+    for i in instances:
+        name = i.tags.get('Name', '')
+        instance_id = i.id
+        if not i.private_ip_address:
+            # Terminated instances has no IP address assinged
+            log.debug("Skipping (terminated?) %s (%s)..." % (name,
+                                                             instance_id))
+            continue
+        if name in args.hosts or instance_id in args.hosts:
+            log.info("Found %s (%s)..." % (name, instance_id))
+
+            if args.action == "start":
+                start(i, args.dry_run)
+            elif args.action == "stop":
+                stop(i, args.dry_run)
+            elif args.action == "restart":
+                restart(i, args.dry_run)
+            elif args.action == "enable":
+                enable(i, args.dry_run)
+            elif args.action == "disable":
+                disable(i, args.dry_run, args.comments)
+            elif args.action == "terminate":
+                terminate(i, args.dry_run, args.force)
+            elif args.action == "status":
+                status(i)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-import boto.vpc
 import yaml
 import dns.resolver
 import logging
@@ -8,12 +7,14 @@ import json
 import urllib
 from IPy import IP
 
+from cloudtools.aws import get_vpc
+
 log = logging.getLogger(__name__)
 _dns_cache = {}
 
 
 def get_connection(region):
-    return boto.vpc.connect_to_region(region)
+    return get_vpc(region)
 
 
 def load_config(filename):
@@ -2,11 +2,11 @@
 import re
 import logging
 import yaml
-import boto.ec2
 import dns.resolver
 import sys
 import time
 
+from cloudtools.aws import get_aws_connection
 from cloudtools.yaml import process_includes
 
 
@@ -19,7 +19,7 @@ port_re = re.compile(r'^(\d+)-(\d+)$')
 
 
 def get_connection(region):
-    return boto.ec2.connect_to_region(region)
+    return get_aws_connection(region)
 
 
 def load_config(filename):
@@ -6,7 +6,7 @@ import json
 import boto
 
 from collections import defaultdict
-from cloudtools.aws import get_aws_connection, DEFAULT_REGIONS
+from cloudtools.aws import get_aws_connection, DEFAULT_REGIONS, region_map
 
 log = logging.getLogger(__name__)
 BUCKET = "mozilla-releng-amis"
@@ -65,11 +65,17 @@ def main():
 
     if not args.regions:
         args.regions = DEFAULT_REGIONS
+
+    def get_region_images(region):
+        conn = get_aws_connection(region)
+        return conn.get_all_images(owners=["self"],
+                                   filters={"state": "available"})
+
+    # Don't publish a partial list if any of the regions fails
+    images_by_region = region_map(get_region_images, args.regions)
     images = []
     for region in args.regions:
-        conn = get_aws_connection(region)
-        images.extend(conn.get_all_images(owners=["self"],
-                                          filters={"state": "available"}))
+        images.extend(images_by_region[region])
     update_ami_status(amis_to_dict(images))
 
 
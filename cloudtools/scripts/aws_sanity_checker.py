@@ -7,7 +7,7 @@ import collections
 import re
 
 from cloudtools.aws.sanity import AWSInstance, aws_instance_factory, SLAVE_TAGS
-from cloudtools.aws import get_aws_connection, DEFAULT_REGIONS
+from cloudtools.aws import get_aws_connection, DEFAULT_REGIONS, region_map
 
 log = logging.getLogger(__name__)
 
@@ -258,12 +258,22 @@ def main():
 
     if not args.regions:
         args.regions = DEFAULT_REGIONS
+
+    def get_region_resources(region):
+        conn = get_aws_connection(region)
+        return get_all_instances(conn), conn.get_all_volumes()
+
+    # Regions we cannot query are logged and left out of the report
+    resources = region_map(get_region_resources, args.regions,
+                           ignore_errors=True)
     all_instances = []
     all_volumes = []
     for region in args.regions:
-        conn = get_aws_connection(region)
-        all_instances.extend(get_all_instances(conn))
-        all_volumes.extend(conn.get_all_volumes())
+        if region in resources:
+            instances, volumes = resources[region]
+            all_instances.extend(instances)
+            all_volumes.extend(volumes)
+    conn = get_aws_connection(args.regions[-1])
 
     generate_report(connection=conn,
                     regions=args.regions,
@@ -15,7 +15,8 @@ import logging
 import json
 
 from Queue import Queue, Empty
-from cloudtools.aws import get_impaired_instance_ids, get_buildslave_instances
+from cloudtools.aws import get_impaired_instance_ids, \
+    get_buildslave_instances, region_map
 from cloudtools.buildbot import graceful_shutdown, get_last_activity, \
     ACTIVITY_STOPPED, ACTIVITY_BOOTING
 from cloudtools.ssh import SSHClient
@@ -140,12 +141,13 @@ def aws_stop_idle(user, key_filename, regions, masters_json, moz_types,
     all_instances = []
     impaired_ids = []
 
-    for r in regions:
+    def get_region_instances(r):
         log.debug("looking at region %s", r)
         instances = get_buildslave_instances(r, moz_types)
-        log.debug("Got %s buildslave instances", len(instances))
-        impaired_ids.extend(get_impaired_instance_ids(r))
-        log.debug("Got %s impaired instances", len(impaired_ids))
+        log.debug("Got %s buildslave instances in %s", len(instances), r)
+        region_impaired_ids = get_impaired_instance_ids(r)
+        log.debug("Got %s impaired instances in %s", len(region_impaired_ids),
+                  r)
         instances_by_type = {}
         for i in instances:
             # TODO: Check if launch_time is too old, and terminate the instance
@@ -162,8 +164,13 @@ def aws_stop_idle(user, key_filename, regions, masters_json, moz_types,
                           i.tags['Name'], min_running_by_type,
                           i.tags['moz-type'])
                 instances.remove(i)
+        return instances, region_impaired_ids
 
+    # Regions we cannot query are skipped until the next run
+    for instances, region_impaired_ids in region_map(
+            get_region_instances, regions, ignore_errors=True).values():
         all_instances.extend(instances)
+        impaired_ids.extend(region_impaired_ids)
 
     random.shuffle(all_instances)
 
@@ -4,8 +4,9 @@ Watches pending jobs and starts or creates EC2 instances if required
 """
 # lint_ignore=E501,C901
 import argparse
+import threading
 import time
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, namedtuple
 import logging
 
 try:
@@ -14,28 +15,62 @@ try:
 except ImportError:
     import json
 
-from boto.exception import BotoServerError, EC2ResponseError
+from boto.exception import EC2ResponseError
 from boto.ec2.networkinterface import NetworkInterfaceCollection, \
     NetworkInterfaceSpecification
 
-from cloudtools.aws import (get_aws_connection, aws_get_running_instances,
-                            aws_get_all_instances, filter_spot_instances,
-                            filter_ondemand_instances, reduce_by_freshness,
+from cloudtools.aws import (get_aws_connection, aws_get_all_instances,
+                            reduce_by_freshness,
                             distribute_in_region, load_instance_config,
-                            get_region_dns_atom)
+                            get_region_dns_atom, invalidate_instances_cache,
+                            region_map)
 from cloudtools.aws.spot import get_spot_requests_for_moztype, \
-    usable_spot_choice, get_available_slave_name, get_spot_choices
-from cloudtools.aws.ami import get_ami, get_spot_amis
-from cloudtools.aws.vpc import get_avail_subnet
-from cloudtools.buildbot import find_pending, map_builders
+    usable_spot_choice, get_available_slave_name, get_spot_choices, \
+    invalidate_spot_requests_cache, reset_available_slave_names, \
+    release_slave_name
+from cloudtools.aws.ami import get_ami, get_spot_amis, get_ami_catalog
+from cloudtools.aws.inventory import InstanceInventory
+from cloudtools.aws.spot_failures import load_failures, save_failures
+from cloudtools.aws.spot_prices import set_spot_price_db
+from cloudtools.aws.tags import add_tags, flush_tags
+from cloudtools.aws.vpc import get_avail_subnet, release_subnet
+from cloudtools.buildbot import find_pending, map_builders, BuilderMatcher
 from cloudtools.aws.instance import create_block_device_mapping, \
     user_data_from_template, tag_ondemand_instance
+import cloudtools.aws.ratelimit
+import cloudtools.cache
 import cloudtools.graphite
 from cloudtools.log import add_syslog_handler
 
 log = logging.getLogger()
 gr_log = cloudtools.graphite.get_graphite_logger()
 
+# How long (in seconds) cached data is reused in daemon mode before it is
+# fetched again
+CACHE_TTLS = {
+    "instances": 60,
+    "active_spot_requests": 60,
+    "spot_request_index": 60,
+    "spot_requests_by_id": 60,
+    "usable_spot_choice": 60,
+    "subnets": 60,
+    "subnet_capacity": 60,
+    "spot_prices": 5 * 60,
+    "classified_slaves": 10 * 60,
+    "ami_catalog": 10 * 60,
+}
+# On-demand launches in flight per region
+ONDEMAND_CONCURRENCY = 8
+# How long (in seconds) daemon mode waits for queued tags after every run
+FLUSH_TAGS_TIMEOUT = 120
+# Caches which change as soon as we start new instances
+LAUNCH_SENSITIVE_CACHES = ("instances", "active_spot_requests",
+                           "spot_request_index", "usable_spot_choice",
+                           "subnets", "subnet_capacity")
+
+LaunchSpec = namedtuple("LaunchSpec", ["name", "fqdn", "subnet_id",
+                                       "user_data"])
+
 
 def find_prev_latest_amis_needed(latest_ami_percentage, latest_ami_count,
                                  prev_ami_count, instances_to_start):
@@ -99,39 +134,86 @@ def find_prev_latest_amis_needed(latest_ami_percentage, latest_ami_count,
     return (0, instances_to_start)
 
 
-def aws_resume_instances(all_instances, moz_instance_type, start_count,
+def run_launches(count, launch, concurrency=ONDEMAND_CONCURRENCY):
+    """Calls launch() `count` times, with up to `concurrency` calls in
+    flight. Throttled calls are retried by the region's rate limiter (see
+    cloudtools.aws.ratelimit), so any EC2 error stops all launches. Returns
+    the number of launches which returned True"""
+    state = {"remaining": count, "started": 0, "stop": False}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if state["stop"] or state["remaining"] < 1:
+                    return
+                state["remaining"] -= 1
+            try:
+                started = launch()
+            except EC2ResponseError, e:
+                # TODO: Handle e.code
+                log.warn("On-demand failure: %s; giving up", e.code)
+                log.warn("Cannot start", exc_info=True)
+                with lock:
+                    state["stop"] = True
+                return
+            except Exception:
+                log.warn("Cannot start", exc_info=True)
+                continue
+            if started:
+                with lock:
+                    state["started"] += 1
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(concurrency, count))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return state["started"]
+
+
+def aws_resume_instances(inventory, moz_instance_type, start_count,
                          regions, region_priorities, dryrun):
     """Create up to `start_count` on-demand instances"""
 
     start_count_per_region = distribute_in_region(start_count, regions,
                                                   region_priorities)
 
-    started = 0
     instance_config = load_instance_config(moz_instance_type)
-    for region, count in start_count_per_region.iteritems():
+
+    def resume_region(region):
+        count = start_count_per_region[region]
+        if count < 1:
+            return 0, None
         # TODO: check region limits
         ami = get_ami(region=region, moz_instance_type=moz_instance_type)
-        for _ in range(count):
-            try:
-                r = do_request_instance(
-                    region=region,
-                    moz_instance_type=moz_instance_type,
-                    price=None, availability_zone=None,
-                    ami=ami, instance_config=instance_config,
-                    instance_type=instance_config[region]["instance_type"],
-                    is_spot=False, dryrun=dryrun,
-                    all_instances=all_instances)
-                if r:
-                    started += 1
-            except EC2ResponseError, e:
-                # TODO: Handle e.code
-                log.warn("On-demand failure: %s; giving up", e.code)
-                log.warn("Cannot start", exc_info=True)
-                break
-            except Exception:
-                log.warn("Cannot start", exc_info=True)
 
-    return started
+        def launch():
+            return do_request_instance(
+                region=region,
+                moz_instance_type=moz_instance_type,
+                price=None, availability_zone=None,
+                ami=ami, instance_config=instance_config,
+                instance_type=instance_config[region]["instance_type"],
+                dryrun=dryrun,
+                inventory=inventory)
+
+        started = run_launches(count, launch)
+        if started:
+            invalidate_instances_cache([region])
+        return started, ami
+
+    started = region_map(resume_region, start_count_per_region.keys(),
+                         ignore_errors=True)
+    # Logged from here rather than from the launch threads, which would
+    # update the graphite logger concurrently
+    for region, (count, ami) in started.iteritems():
+        if count and not dryrun:
+            log_started(region, moz_instance_type,
+                        instance_config[region]["instance_type"], False, ami,
+                        count)
+    return sum(count for count, _ in started.itervalues())
 
 
 def get_product_description(moz_instance_type):
@@ -140,7 +222,7 @@ def get_product_description(moz_instance_type):
     return "Linux/UNIX (Amazon VPC)"
 
 
-def request_spot_instances(all_instances, moz_instance_type, start_count,
+def request_spot_instances(inventory, moz_instance_type, start_count,
                            regions, region_priorities, spot_config, dryrun,
                            latest_ami_percentage):
     started = 0
@@ -160,13 +242,6 @@ def request_spot_instances(all_instances, moz_instance_type, start_count,
         return 0
 
     to_start = defaultdict(list)
-    active_instance_ids = set(i.id for i in all_instances)
-
-    # count the number of instances for each image id
-    ami_distribution = defaultdict(int)
-    for instance in all_instances:
-        ami_distribution[instance.image_id] += 1
-
     for region in regions:
         # Check if spots are enabled in this region for this type
         region_limit = spot_config.get("limits", {}).get(region, {}).get(
@@ -183,7 +258,7 @@ def request_spot_instances(all_instances, moz_instance_type, start_count,
                   region, moz_instance_type)
         # Filter out requests for instances that don't exist
         active_requests = [r for r in active_requests if r.instance_id is not
-                           None and r.instance_id in active_instance_ids]
+                           None and r.instance_id in inventory]
         log.debug("%i real active spot requests for %s %s",
                   len(active_requests), region, moz_instance_type)
         active_count = len(active_requests)
@@ -202,8 +277,8 @@ def request_spot_instances(all_instances, moz_instance_type, start_count,
             # prevous ami types, so that we can decide how many of each type to
             # launch.
             ami_prev = spot_amis[-2]
-            prev_ami_count = ami_distribution[ami_prev.id]
-            latest_ami_count = ami_distribution[ami_latest.id]
+            prev_ami_count = inventory.count_by_image(ami_prev.id)
+            latest_ami_count = inventory.count_by_image(ami_latest.id)
             ami_prev_to_start, ami_latest_to_start = find_prev_latest_amis_needed(
                 latest_ami_percentage,
                 prev_ami_count,
@@ -240,8 +315,10 @@ def request_spot_instances(all_instances, moz_instance_type, start_count,
                     ami=to_start_entry["ami"],
                     instance_config=instance_config, dryrun=dryrun,
                     spot_choice=choice,
-                    all_instances=all_instances,
+                    inventory=inventory,
                 )
+                if launched:
+                    invalidate_spot_requests_cache(region)
                 started += launched
 
         if started >= start_count:
@@ -252,66 +329,84 @@ def request_spot_instances(all_instances, moz_instance_type, start_count,
 
 def do_request_spot_instances(amount, region, moz_instance_type, ami,
                               instance_config, spot_choice,
-                              all_instances, dryrun):
-    started = 0
+                              inventory, dryrun):
+    """Requests up to `amount` spot instances, one request per slave since
+    their user data contains their host name. All requests are tagged at
+    once afterwards. Returns the number of requests made"""
+    launch_specs = []
     for _ in range(amount):
+        spec = get_launch_spec(
+            region=region, moz_instance_type=moz_instance_type,
+            instance_config=instance_config,
+            availability_zone=spot_choice.availability_zone, inventory=inventory,
+            is_spot=True)
+        if not spec:
+            break
+        log.debug("Spot request for %s (%s)", spec.fqdn, spot_choice.bid_price)
+        launch_specs.append(spec)
+
+    if dryrun:
+        log.info("Dry run. skipping")
+        return len(launch_specs)
+
+    tags_by_request = {}
+    unused = []
+    for n, spec in enumerate(launch_specs):
         try:
-            r = do_request_instance(
-                region=region,
-                moz_instance_type=moz_instance_type,
-                price=spot_choice.bid_price,
-                availability_zone=spot_choice.availability_zone,
-                ami=ami, instance_config=instance_config,
-                instance_type=spot_choice.instance_type,
-                is_spot=True, dryrun=dryrun, all_instances=all_instances)
-            if r:
-                started += 1
-            else:
-                return started
+            bdm, nc = get_launch_devices(region, ami, instance_config,
+                                         spec.subnet_id)
+            sir = do_request_spot_instance(
+                region, spot_choice.bid_price, ami.id,
+                spot_choice.instance_type, instance_config[region]["ssh_key"],
+                spec.user_data, bdm, nc,
+                instance_config[region].get("instance_profile_name"))
         except EC2ResponseError, e:
             if e.code == "MaxSpotInstanceCountExceeded":
                 log.warn("MaxSpotInstanceCountExceeded in %s; giving up", region)
-                return started
+                unused.extend(launch_specs[n:])
+                break
             log.warn("Cannot start", exc_info=True)
+            unused.append(spec)
+            continue
         except Exception:
             log.warn("Cannot start", exc_info=True)
-    return started
+            unused.append(spec)
+            continue
+        tags_by_request[sir.id] = {"Name": spec.name, "FQDN": spec.fqdn}
+
+    for spec in unused:
+        release_launch_spec(region, moz_instance_type, instance_config, True,
+                            spec)
+    if not tags_by_request:
+        return 0
+    tag_spot_requests(region, tags_by_request,
+                      {"moz-type": moz_instance_type})
+    log_started(region, moz_instance_type, spot_choice.instance_type, True,
+                ami, len(tags_by_request))
+    return len(tags_by_request)
 
 
-def do_request_instance(region, moz_instance_type, price, ami, instance_config,
-                        instance_type, availability_zone, is_spot,
-                        all_instances, dryrun):
+def get_launch_spec(region, moz_instance_type, instance_config,
+                    availability_zone, is_spot, inventory):
+    """Picks a slave name and subnet for a new instance and renders its user
+    data. Returns None if there is no name or subnet available"""
     name = get_available_slave_name(region, moz_instance_type,
                                     is_spot=is_spot,
-                                    all_instances=all_instances)
+                                    all_instances=inventory.instances)
     if not name:
         log.debug("No slave name available for %s, %s",
                   region, moz_instance_type)
-        return False
+        return None
 
     subnet_id = get_avail_subnet(region, instance_config[region]["subnet_ids"],
                                  availability_zone)
     if not subnet_id:
         log.debug("No free IP available for %s in %s", moz_instance_type,
                   availability_zone)
-        return False
+        release_slave_name(region, moz_instance_type, is_spot, name)
+        return None
 
     fqdn = "{}.{}".format(name, instance_config[region]["domain"])
-    if is_spot:
-        log.debug("Spot request for %s (%s)", fqdn, price)
-    else:
-        log.debug("Starting %s", fqdn)
-
-    if dryrun:
-        log.info("Dry run. skipping")
-        return True
-
-    spec = NetworkInterfaceSpecification(
-        associate_public_ip_address=True, subnet_id=subnet_id,
-        delete_on_termination=True,
-        groups=instance_config[region].get("security_group_ids"))
-    nc = NetworkInterfaceCollection(spec)
-
     user_data = user_data_from_template(moz_instance_type, {
         "moz_instance_type": moz_instance_type,
         "hostname": name,
@@ -321,41 +416,74 @@ def do_request_instance(region, moz_instance_type, price, ami, instance_config,
         "puppet_server": "",  # intentionally empty
         "password": ""  # intentionally empty
     })
+    return LaunchSpec(name, fqdn, subnet_id, user_data)
+
+
+def release_launch_spec(region, moz_instance_type, instance_config, is_spot,
+                        spec):
+    """Gives back the name and subnet IP of a launch spec which wasn't
+    used"""
+    release_slave_name(region, moz_instance_type, is_spot, spec.name)
+    release_subnet(region, instance_config[region]["subnet_ids"],
+                   spec.subnet_id)
 
+
+def get_launch_devices(region, ami, instance_config, subnet_id):
+    """Returns the block device mapping and network interfaces to launch
+    `ami` with"""
+    spec = NetworkInterfaceSpecification(
+        associate_public_ip_address=True, subnet_id=subnet_id,
+        delete_on_termination=True,
+        groups=instance_config[region].get("security_group_ids"))
+    nc = NetworkInterfaceCollection(spec)
     bdm = create_block_device_mapping(
         ami, instance_config[region]['device_map'])
-    if is_spot:
-        rv = do_request_spot_instance(
-            region, price, ami.id, instance_type,
-            instance_config[region]["ssh_key"], user_data, bdm, nc,
-            instance_config[region].get("instance_profile_name"),
-            moz_instance_type, name, fqdn)
-    else:
-        rv = do_request_ondemand_instance(
-            region, price, ami.id, instance_type,
-            instance_config[region]["ssh_key"], user_data, bdm, nc,
-            instance_config[region].get("instance_profile_name"),
-            moz_instance_type, name, fqdn)
-    if rv:
-        template_values = dict(
-            region=region,
-            moz_instance_type=moz_instance_type,
-            instance_type=instance_type.replace(".", "-"),
-            life_cycle_type="spot" if is_spot else "ondemand",
-            virtualization=ami.virtualization_type,
-            root_device_type=ami.root_device_type,
-        )
-        name = "started.{region}.{moz_instance_type}.{instance_type}" \
-            ".{life_cycle_type}.{virtualization}.{root_device_type}"
-        gr_log.add(name.format(**template_values), 1, collect=True)
-    return rv
+    return bdm, nc
+
+
+def log_started(region, moz_instance_type, instance_type, is_spot, ami,
+                count=1):
+    template_values = dict(
+        region=region,
+        moz_instance_type=moz_instance_type,
+        instance_type=instance_type.replace(".", "-"),
+        life_cycle_type="spot" if is_spot else "ondemand",
+        virtualization=ami.virtualization_type,
+        root_device_type=ami.root_device_type,
+    )
+    name = "started.{region}.{moz_instance_type}.{instance_type}" \
+        ".{life_cycle_type}.{virtualization}.{root_device_type}"
+    gr_log.add(name.format(**template_values), count, collect=True)
+
+
+def do_request_instance(region, moz_instance_type, price, ami, instance_config,
+                        instance_type, availability_zone, inventory, dryrun):
+    """Starts an on-demand instance. Returns True if it was started"""
+    spec = get_launch_spec(
+        region=region, moz_instance_type=moz_instance_type,
+        instance_config=instance_config, availability_zone=availability_zone,
+        is_spot=False, inventory=inventory)
+    if not spec:
+        return False
+
+    log.debug("Starting %s", spec.fqdn)
+    if dryrun:
+        log.info("Dry run. skipping")
+        return True
+
+    bdm, nc = get_launch_devices(region, ami, instance_config, spec.subnet_id)
+    return do_request_ondemand_instance(
+        region, price, ami.id, instance_type,
+        instance_config[region]["ssh_key"], spec.user_data, bdm, nc,
+        instance_config[region].get("instance_profile_name"),
+        moz_instance_type, spec.name, spec.fqdn)
 
 
 def do_request_spot_instance(region, price, ami_id, instance_type, ssh_key,
-                             user_data, bdm, nc, profile, moz_instance_type,
-                             name, fqdn):
+                             user_data, bdm, nc, profile):
+    """Requests a spot instance. Returns the spot instance request"""
     conn = get_aws_connection(region)
-    sir = conn.request_spot_instances(
+    sirs = conn.request_spot_instances(
         price=str(price),
         image_id=ami_id,
         count=1,
@@ -366,35 +494,16 @@ def do_request_spot_instance(region, price, ami_id, instance_type, ssh_key,
         network_interfaces=nc,
         instance_profile_name=profile,
     )
-    # Sleep for a little bit to prevent us hitting
-    # InvalidSpotInstanceRequestID.NotFound right away
-    time.sleep(0.5)
-    max_tries = 10
-    sleep_time = 5
-    for i in range(max_tries):
-        try:
-            sir[0].add_tag("moz-type", moz_instance_type)
-            # Name will be used to determine available slave names
-            sir[0].add_tag("Name", name)
-            sir[0].add_tag("FQDN", fqdn)
-            return True
-        except EC2ResponseError, e:
-            if e.code == "InvalidSpotInstanceRequestID.NotFound":
-                if i < max_tries - 1:
-                    # Try again
-                    log.debug("waiting for spot request")
-                    time.sleep(sleep_time)
-                    sleep_time = min(30, sleep_time * 1.5)
-                    continue
-        except BotoServerError, e:
-            if e.code == "RequestLimitExceeded":
-                if i < max_tries - 1:
-                    # Try again
-                    log.debug("request limit exceeded; sleeping and trying again")
-                    time.sleep(sleep_time)
-                    sleep_time = min(30, sleep_time * 1.5)
-                    continue
-            raise
+    return sirs[0]
+
+
+def tag_spot_requests(region, tags_by_request, common_tags):
+    """Queues tags for new spot instance requests. `common_tags` are applied
+    to all requests with a single call, `tags_by_request` maps request ids to
+    their own tags"""
+    add_tags(region, tags_by_request.keys(), common_tags)
+    for request_id, tags in tags_by_request.iteritems():
+        add_tags(region, [request_id], tags)
 
 
 def do_request_ondemand_instance(region, price, ami_id, instance_type, ssh_key,
@@ -418,16 +527,20 @@ def do_request_ondemand_instance(region, price, ami_id, instance_type, ssh_key,
 
 def aws_watch_pending(dburl, regions, builder_map, region_priorities,
                       spot_config, ondemand_config, dryrun, latest_ami_percentage):
+    """Starts instances for pending jobs. Returns the number of instances
+    started"""
     # First find pending jobs in the db
     pending = find_pending(dburl)
 
     if not pending:
         gr_log.add("pending", 0)
         log.debug("no pending jobs! all done!")
-        return
+        return 0
 
-    log.debug("processing %i pending jobs", len(pending))
-    gr_log.add("pending", len(pending))
+    num_pending = sum(count for _, count in pending)
+    log.debug("processing %i pending jobs for %i builders", num_pending,
+              len(pending))
+    gr_log.add("pending", num_pending)
 
     # Mapping of instance types to # of instances we want to
     # creates
@@ -436,8 +549,9 @@ def aws_watch_pending(dburl, regions, builder_map, region_priorities,
     gr_log.add("aws_pending", sum(pending_builder_map.values()))
     if not pending_builder_map:
         log.debug("no pending jobs we can do anything about! all done!")
-        return
+        return 0
 
+    total_started = 0
     to_create_spot = pending_builder_map
     to_create_ondemand = defaultdict(int)
 
@@ -445,12 +559,14 @@ def aws_watch_pending(dburl, regions, builder_map, region_priorities,
     # running, and scale our count accordingly
     all_instances = aws_get_all_instances(regions)
     cloudtools.graphite.generate_instance_stats(all_instances)
+    inventory = InstanceInventory(all_instances)
+    # AMIs are looked up per region and moz-type below
+    region_map(get_ami_catalog, regions, ignore_errors=True)
 
     # Reduce the requirements, pay attention to freshess and running instances
     to_delete = set()
     for moz_instance_type, count in to_create_spot.iteritems():
-        running = aws_get_running_instances(all_instances, moz_instance_type)
-        spot_running = filter_spot_instances(running)
+        spot_running = inventory.running(moz_instance_type, "spot")
         to_create_spot[moz_instance_type] = reduce_by_freshness(
             count, spot_running, moz_instance_type)
 
@@ -468,7 +584,7 @@ def aws_watch_pending(dburl, regions, builder_map, region_priorities,
         if spot_config and 'global' in spot_config.get('limits', {}):
             global_limit = spot_config['limits']['global'].get(moz_instance_type)
             # How many of this type of spot instance are running?
-            n = len(filter_spot_instances(aws_get_running_instances(all_instances, moz_instance_type)))
+            n = inventory.count_running(moz_instance_type, "spot")
             log.debug("%i %s spot instances running globally", n, moz_instance_type)
             if global_limit and n + count > global_limit:
                 new_count = max(0, global_limit - n)
@@ -478,11 +594,12 @@ def aws_watch_pending(dburl, regions, builder_map, region_priorities,
                     continue
 
         started = request_spot_instances(
-            all_instances,
+            inventory,
             moz_instance_type=moz_instance_type, start_count=count,
             regions=regions, region_priorities=region_priorities,
             spot_config=spot_config, dryrun=dryrun,
             latest_ami_percentage=latest_ami_percentage)
+        total_started += started
         count -= started
         log.debug("%s - started %i spot instances; need %i",
                   moz_instance_type, started, count)
@@ -497,7 +614,7 @@ def aws_watch_pending(dburl, regions, builder_map, region_priorities,
         if ondemand_config and 'global' in ondemand_config.get('limits', {}):
             global_limit = ondemand_config['limits']['global'].get(moz_instance_type)
             # How many of this type of ondemand instance are running?
-            n = len(filter_ondemand_instances(aws_get_running_instances(all_instances, moz_instance_type)))
+            n = inventory.count_running(moz_instance_type, "ondemand")
             log.debug("%i %s ondemand instances running globally", n, moz_instance_type)
             if global_limit and n + count > global_limit:
                 new_count = max(0, global_limit - n)
@@ -510,12 +627,64 @@ def aws_watch_pending(dburl, regions, builder_map, region_priorities,
 
         # Check for stopped instances in the given regions and start them if
         # there are any
-        started = aws_resume_instances(all_instances, moz_instance_type, count,
+        started = aws_resume_instances(inventory, moz_instance_type, count,
                                        regions, region_priorities,
                                        dryrun)
+        total_started += started
         count -= started
         log.debug("%s - started %i instances; need %i",
                   moz_instance_type, started, count)
+    return total_started
+
+
+def report_cache_stats():
+    for name, stats in sorted(cloudtools.cache.stats().iteritems()):
+        log.debug("%s cache: %i hits, %i misses, %i entries", name,
+                  stats["hits"], stats["misses"], stats["size"])
+        gr_log.add("cache.{}.hits".format(name), stats["hits"])
+        gr_log.add("cache.{}.misses".format(name), stats["misses"])
+
+
+def report_rate_limit_stats():
+    for region, stats in sorted(
+            cloudtools.aws.ratelimit.stats().iteritems()):
+        log.debug("%s API calls: %i calls, %i throttled, %i retries, "
+                  "%.1f calls/s allowed", region, stats["calls"],
+                  stats["throttled"], stats["retries"], stats["rate"])
+        for name in ("calls", "throttled", "retries"):
+            gr_log.add("api.{}.{}".format(region, name), stats[name])
+
+
+def watch_pending_forever(interval, spot_failure_db=None, **kwargs):
+    """Calls aws_watch_pending every `interval` seconds, keeping connections
+    and cached data between runs. The spot failure history is saved to
+    `spot_failure_db` after every run, if given"""
+    for name, ttl in CACHE_TTLS.iteritems():
+        cloudtools.cache.set_ttl(name, ttl)
+    while True:
+        tick_start = time.time()
+        # Slave names are handed out from a per-run pool
+        reset_available_slave_names()
+        try:
+            started = aws_watch_pending(**kwargs)
+        except Exception:
+            log.exception("Cannot process pending jobs")
+            # Don't trust anything we have cached after a failure
+            started = None
+        # The next run allocates slave names based on these tags
+        if not flush_tags(FLUSH_TAGS_TIMEOUT):
+            log.warn("Tags are still being applied after %is",
+                     FLUSH_TAGS_TIMEOUT)
+        if spot_failure_db:
+            save_failures(spot_failure_db)
+        if started != 0:
+            cloudtools.cache.invalidate(*LAUNCH_SENSITIVE_CACHES)
+        report_cache_stats()
+        report_rate_limit_stats()
+        gr_log.sendall()
+        elapsed = time.time() - tick_start
+        log.debug("tick took %.2fs", elapsed)
+        time.sleep(max(0, interval - elapsed))
 
 
 def main():
@@ -537,6 +706,18 @@ def main():
                         help="percentage instances which will be launched with"
                         " the latest ami available, remaining requests will be"
                         " made using the previous (default: 100)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running, processing pending jobs every "
+                        "--interval seconds")
+    parser.add_argument("--interval", type=int, default=60,
+                        help="seconds between runs in daemon mode "
+                        "(default: 60)")
+    parser.add_argument("--spot-price-db",
+                        help="SQLite file to keep spot price history in "
+                        "between runs (default: in memory)")
+    parser.add_argument("--spot-failure-db",
+                        help="JSON file to keep spot request failure history "
+                        "in between runs (default: in memory)")
 
     args = parser.parse_args()
 
@@ -557,20 +738,10 @@ def main():
         fhandler.setFormatter(formatter)
         logging.getLogger().addHandler(fhandler)
 
-    config = json.load(args.config)
+    # Builder patterns are matched in the order they are listed
+    config = json.load(args.config, object_pairs_hook=OrderedDict)
     secrets = json.load(args.secrets)
 
-    aws_watch_pending(
-        dburl=secrets['db'],
-        regions=args.regions,
-        builder_map=config['buildermap'],
-        region_priorities=config['region_priorities'],
-        dryrun=args.dryrun,
-        spot_config=config.get("spot"),
-        ondemand_config=config.get("ondemand"),
-        latest_ami_percentage=args.latest_ami_percentage,
-    )
-
     if all([config.get("graphite_host"), config.get("graphite_port"),
             config.get("graphite_prefix")]):
         gr_log.add_destination(
@@ -588,7 +759,35 @@ def main():
         add_syslog_handler(log, address=secrets["syslog_address"],
                            app="aws_watch_pending")
 
-    gr_log.sendall()
+    if args.spot_price_db:
+        set_spot_price_db(args.spot_price_db)
+    if args.spot_failure_db:
+        load_failures(args.spot_failure_db)
+
+    watch_kwargs = dict(
+        dburl=secrets['db'],
+        regions=args.regions,
+        builder_map=BuilderMatcher(config['buildermap']),
+        region_priorities=config['region_priorities'],
+        dryrun=args.dryrun,
+        spot_config=config.get("spot"),
+        ondemand_config=config.get("ondemand"),
+        latest_ami_percentage=args.latest_ami_percentage,
+    )
+    if args.daemon:
+        watch_pending_forever(args.interval,
+                              spot_failure_db=args.spot_failure_db,
+                              **watch_kwargs)
+    else:
+        try:
+            aws_watch_pending(**watch_kwargs)
+        finally:
+            flush_tags()
+        if args.spot_failure_db:
+            save_failures(args.spot_failure_db)
+        gr_log.sendall()
+        for exp in watch_kwargs["builder_map"].unused_patterns():
+            log.debug("builder pattern %s didn't match any pending job", exp)
     log.debug("done")
 
 
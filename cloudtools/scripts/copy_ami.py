@@ -2,7 +2,7 @@
 import argparse
 import logging
 
-from cloudtools.aws.ami import get_ami, copy_ami
+from cloudtools.aws.ami import get_ami, copy_amis
 
 log = logging.getLogger(__name__)
 
@@ -23,10 +23,12 @@ def main():
     amis_to_copy = [get_ami(region=args.from_region, moz_instance_type=t)
                     for t in args.moz_instance_types]
     for ami in amis_to_copy:
-        for r in args.to_regions:
-            log.info("Copying %s (%s) to %s", ami.id, ami.tags.get("Name"), r)
-            new_ami = copy_ami(ami, r)
-            log.info("New AMI created. AMI ID: %s", new_ami.id)
+        log.info("Copying %s (%s) to %s", ami.id, ami.tags.get("Name"),
+                 ", ".join(args.to_regions))
+    copies = copy_amis(amis_to_copy, args.to_regions)
+    for (ami_id, r), new_ami in sorted(copies.iteritems()):
+        log.info("New AMI created from %s in %s. AMI ID: %s", ami_id, r,
+                 new_ami.id)
 
 
 if __name__ == '__main__':
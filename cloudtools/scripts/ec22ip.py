@@ -2,7 +2,7 @@
 
 import re
 
-from cloudtools.aws import get_aws_connection
+from cloudtools.aws import iter_instances, LIVE_INSTANCE_STATES
 
 
 def main():
@@ -17,16 +17,12 @@ def main():
 
     hosts_re = [re.compile(x) for x in args]
 
-    conn = get_aws_connection(options.region)
-
-    res = conn.get_all_instances()
-    if res:
-        instances = reduce(lambda a, b: a + b, [r.instances for r in res])
-        for i in instances:
-            for mask in hosts_re:
-                hostname = i.tags.get('FQDN', i.tags.get('Name', ''))
-                if mask.search(hostname) and i.private_ip_address:
-                    print i.private_ip_address, hostname
+    # Terminated instances have no IP addresses
+    for i in iter_instances(options.region, state=LIVE_INSTANCE_STATES):
+        for mask in hosts_re:
+            hostname = i.tags.get('FQDN', i.tags.get('Name', ''))
+            if mask.search(hostname) and i.private_ip_address:
+                print i.private_ip_address, hostname
 
 
 if __name__ == '__main__':
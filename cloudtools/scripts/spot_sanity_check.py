@@ -5,17 +5,24 @@ import logging
 import time
 
 from cloudtools.aws import get_aws_connection, DEFAULT_REGIONS, \
-    parse_aws_time, aws_get_all_instances, retry_aws_request
+    parse_aws_time, aws_get_all_instances, region_map
 from cloudtools.aws.spot import CANCEL_STATUS_CODES, IGNORABLE_STATUS_CODES
 
 log = logging.getLogger(__name__)
 
 
+def get_all_spot_requests(region):
+    conn = get_aws_connection(region)
+    return conn.get_all_spot_instance_requests()
+
+
 def sanity_check(regions):
     spot_requests = []
+    # Requests in regions we cannot query are checked on the next run
+    spot_requests_by_region = region_map(get_all_spot_requests, regions,
+                                         ignore_errors=True)
     for r in regions:
-        conn = get_aws_connection(r)
-        region_spot_requests = conn.get_all_spot_instance_requests()
+        region_spot_requests = spot_requests_by_region.get(r)
         if region_spot_requests:
             spot_requests.extend(region_spot_requests)
     all_spot_instances = aws_get_all_instances(regions)
@@ -25,7 +32,7 @@ def sanity_check(regions):
         if req.state in ["open", "failed"]:
             if req.status.code in CANCEL_STATUS_CODES:
                 log.info("Cancelling request %s", req)
-                retry_aws_request(req.add_tag, "moz-cancel-reason", req.status.code)
+                req.add_tag("moz-cancel-reason", req.status.code)
                 req.cancel()
             elif req.status.code not in IGNORABLE_STATUS_CODES:
                 log.error("Uknown status for request %s: %s", req,
@@ -36,7 +43,7 @@ def sanity_check(regions):
                 req.instance_id not in instance_ids:
             log.info("Cancelling request %s: %s is not running", req,
                      req.instance_id)
-            retry_aws_request(req.add_tag, "moz-cancel-reason", "no-running-instances")
+            req.add_tag("moz-cancel-reason", "no-running-instances")
             req.cancel()
 
 
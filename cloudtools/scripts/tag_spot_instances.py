@@ -2,14 +2,44 @@
 
 import argparse
 import logging
+import threading
+from Queue import Queue, Empty
 
 from cloudtools.aws import DEFAULT_REGIONS
 from cloudtools.aws.spot import get_instances_to_tag, \
-    populate_spot_requests_cache, copy_spot_request_tags
+    populate_spot_requests_cache, group_spot_request_tags
 
 log = logging.getLogger(__name__)
 
 
+def tag_instances(instances, concurrency):
+    """Copies spot request tags to `instances`, using one create_tags call
+    per group of instances needing the same tags and `concurrency` workers"""
+    q = Queue()
+    for group, tags in group_spot_request_tags(instances):
+        q.put((group, tags))
+
+    def worker():
+        while True:
+            try:
+                group, tags = q.get(timeout=0.1)
+            except Empty:
+                return
+            log.debug("tagging %s with %s", group, tags)
+            try:
+                group[0].connection.create_tags([i.id for i in group], tags)
+            except Exception:
+                log.warn("Cannot tag %s", group, exc_info=True)
+
+    threads = []
+    for _ in range(concurrency):
+        t = threading.Thread(target=worker)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-r", "--region", dest="regions", action="append",
@@ -32,13 +62,12 @@ def main():
 
     instances_to_tag = []
     for r in args.regions:
-        instances_to_tag.extend(get_instances_to_tag(r))
-        if instances_to_tag:
+        region_instances = get_instances_to_tag(r)
+        if region_instances:
             populate_spot_requests_cache(
-                r, [i.spot_instance_request_id for i in instances_to_tag])
-            for i in instances_to_tag:
-                log.debug("tagging %s", i)
-                copy_spot_request_tags(i)
+                r, [i.spot_instance_request_id for i in region_instances])
+            instances_to_tag.extend(region_instances)
+    tag_instances(instances_to_tag, args.concurrency)
 
 
 if __name__ == '__main__':
@@ -1,33 +1,117 @@
 import os
 import time
 import logging
+import hashlib
 import json
 import requests
 import tempfile
 import shutil
+import threading
 from collections import defaultdict
-from repoze.lru import lru_cache
+from .cache import cached, invalidate
 
 SLAVES_JSON_URL = "http://slavealloc.pvt.build.mozilla.org/api/slaves"
 CACHE_FILE = "slaves.json"
 CACHE_TTL = 10 * 60
+MOZ_TYPE_RULES_FILE = os.path.join(os.path.dirname(__file__),
+                                   "../configs/slave_moz_types.json")
+# Attributes every moz-type rule matches on, besides the optional "speed"
+KEY_ATTRIBUTES = ("bitlength", "environment", "distro", "purpose",
+                  "trustlevel")
 
 log = logging.getLogger(__name__)
 
 
-@lru_cache(10)
+def _lifecycle(is_spot):
+    return "spot" if is_spot else "ondemand"
+
+
+def _classified_dict():
+    # 2D dict: x[moz_type][region] = set(["slave1", "slave2"])
+    return defaultdict(lambda: defaultdict(set))
+
+
+@cached("classified_slaves", maxsize=10)
 def get_classified_slaves(is_spot=True):
-    js = get_slaves_json(SLAVES_JSON_URL, CACHE_FILE)
-    slaves = [s for s in js if is_spot_slave(s) is is_spot and is_enabled(s)]
-    # 2D dict: x[moz_type][region] = ["slave1", "slave2"]
-    classified_slaves = defaultdict(lambda: defaultdict(set))
-    for s in slaves:
-        moz_type = slave_moz_type(s)
+    classified = get_all_classified_slaves(SLAVES_JSON_URL, CACHE_FILE)
+    return classified[_lifecycle(is_spot)]
+
+
+def get_all_classified_slaves(url, cache, rules_file=MOZ_TYPE_RULES_FILE):
+    """Returns the enabled slaves of slaves.json classified by lifecycle
+    ("spot" or "ondemand"), moz-type and region. The classification is kept
+    next to `cache` and only redone when the content of slaves.json or of
+    the moz-type rules in `rules_file` changes"""
+    digest = refresh_slaves_json(url, cache)
+    rules, rules_digest = read_moz_type_rules(rules_file)
+    if digest is not None:
+        digest = "%s-%s" % (digest, rules_digest)
+    classified_file = "%s.classified" % cache
+    classified = read_classified_slaves(classified_file, digest)
+    if classified is None:
+        log.debug("Classifying slaves.json")
+        classified = classify_slaves(read_slaves_json(cache),
+                                     get_slave_classifier(rules, rules_digest))
+        if digest is not None:
+            try:
+                write_classified_slaves(classified_file, digest, classified)
+            except (OSError, IOError):
+                log.warn("Cannot save classified slaves", exc_info=True)
+    return classified
+
+
+def classify_slaves(js, classifier=None):
+    if classifier is None:
+        classifier = load_slave_classifier()
+    classified = {"spot": _classified_dict(),
+                  "ondemand": _classified_dict()}
+    for s in js:
+        if not is_enabled(s):
+            continue
+        moz_type = classifier.classify(s)
         region = slave_region(s)
         name = s.get("name")
         if all([moz_type, region, name]):
-            classified_slaves[moz_type][region].add(name)
-    return classified_slaves
+            lifecycle = _lifecycle(is_spot_slave(s))
+            classified[lifecycle][moz_type][region].add(name)
+    return classified
+
+
+def read_classified_slaves(filename, digest):
+    """Returns the classification saved in `filename` if it was made with
+    the given digest (of slaves.json and the moz-type rules), otherwise
+    None"""
+    if digest is None:
+        return None
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+    except (OSError, IOError, ValueError):
+        return None
+    if data.get("digest") != digest:
+        return None
+    classified = {}
+    for lifecycle in ("spot", "ondemand"):
+        classified[lifecycle] = _classified_dict()
+        for moz_type, regions in data[lifecycle].iteritems():
+            for region, names in regions.iteritems():
+                classified[lifecycle][moz_type][region].update(names)
+    return classified
+
+
+def write_classified_slaves(filename, digest, classified):
+    data = {"digest": digest}
+    for lifecycle, by_moz_type in classified.iteritems():
+        data[lifecycle] = dict(
+            (moz_type, dict((region, sorted(names))
+                            for region, names in regions.iteritems()))
+            for moz_type, regions in by_moz_type.iteritems())
+    _write_atomically(filename, json.dumps(data))
+
+
+def invalidate_classified_slaves_cache():
+    """Forget classified slaves, so slaves.json is consulted again"""
+    invalidate("classified_slaves")
 
 
 def slave_region(slave):
@@ -42,128 +126,155 @@ def is_enabled(slave):
     return slave.get("enabled")
 
 
+class SlaveClassifier(object):
+    """Maps slaves to moz-types with an ordered list of rules, as found in
+    configs/slave_moz_types.json. A rule either matches slaves whose name
+    contains "name_contains", or slaves with the given "attributes" (all of
+    KEY_ATTRIBUTES, optionally "speed") whose name starts with
+    "name_prefix". Name rules are checked first; otherwise the first
+    matching rule wins. Attribute rules are indexed by their attribute
+    values, so a slave is classified with a dict lookup"""
+
+    def __init__(self, rules):
+        self.name_rules = []
+        # attribute values + (speed,) -> [(name prefix, moz-type)], in rule
+        # order. Rules without a speed are indexed with a speed of None and
+        # also added to the entries of the same attributes with any speed
+        self._index = {}
+        any_speed = defaultdict(list)
+        with_speed = defaultdict(list)
+        for n, rule in enumerate(rules):
+            moz_type = rule["moz_type"]
+            if "attributes" not in rule:
+                self.name_rules.append((rule["name_contains"], moz_type))
+                continue
+            attributes = rule["attributes"]
+            key = tuple(attributes[a] for a in KEY_ATTRIBUTES)
+            entry = (n, rule.get("name_prefix", ""), moz_type)
+            if "speed" in attributes:
+                with_speed[key + (attributes["speed"],)].append(entry)
+            else:
+                any_speed[key].append(entry)
+        for key, entries in any_speed.iteritems():
+            self._index[key + (None,)] = [e[1:] for e in entries]
+        for key, entries in with_speed.iteritems():
+            self._index[key] = [e[1:] for e in
+                                sorted(entries + any_speed.get(key[:-1], []))]
+
+    def classify(self, slave):
+        name = slave.get("name") or ""
+        for substring, moz_type in self.name_rules:
+            if substring in name:
+                return moz_type
+        key = tuple(slave.get(a) for a in KEY_ATTRIBUTES)
+        candidates = self._index.get(key + (slave.get("speed"),)) or \
+            self._index.get(key + (None,), [])
+        for prefix, moz_type in candidates:
+            if name.startswith(prefix):
+                return moz_type
+        return None
+
+
+def read_moz_type_rules(filename=MOZ_TYPE_RULES_FILE):
+    """Returns the content of the moz-type rules file and its digest"""
+    with open(filename) as f:
+        rules = f.read()
+    return rules, hashlib.sha1(rules).hexdigest()
+
+
+_classifier = (None, None)
+_classifier_lock = threading.Lock()
+
+
+def get_slave_classifier(rules, rules_digest):
+    """Returns the classifier for `rules`, reusing the last one if the rules
+    haven't changed"""
+    global _classifier
+    with _classifier_lock:
+        if _classifier[0] != rules_digest:
+            _classifier = (rules_digest, SlaveClassifier(json.loads(rules)))
+        return _classifier[1]
+
+
+def load_slave_classifier(filename=MOZ_TYPE_RULES_FILE):
+    return get_slave_classifier(*read_moz_type_rules(filename))
+
+
 def slave_moz_type(slave):
-    # Separate golden slaves
-    if slave.get("name") and "golden" in slave.get("name"):
-        return "golden"
-
-    # av-linux64
-    if slave.get("name", "").startswith("av-linux64-") and \
-       slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "centos6-mock" and \
-       slave.get("purpose") == "build" and \
-       slave.get("trustlevel") == "core":
-        return "av-linux64"
-
-    # bld-linux64
-    if slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "centos6-mock" and \
-       slave.get("purpose") == "build" and \
-       slave.get("trustlevel") == "core":
-        return "bld-linux64"
-
-    # try-linux64
-    if slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "centos6-mock" and \
-       slave.get("purpose") == "build" and \
-       slave.get("trustlevel") == "try":
-        return "try-linux64"
-
-    # tst-linux32
-    if slave.get("bitlength") == "32" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "ubuntu32" and \
-       slave.get("purpose") == "tests" and \
-       slave.get("trustlevel") == "try":
-        return "tst-linux32"
-
-    # tst-linux64
-    if slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "ubuntu64" and \
-       slave.get("purpose") == "tests" and \
-       slave.get("speed") == "m1.medium" and \
-       slave.get("trustlevel") == "try":
-        return "tst-linux64"
-
-    # tst-emulator64
-    if slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "ubuntu64" and \
-       slave.get("purpose") == "tests" and \
-       slave.get("speed") == "c3.xlarge" and \
-       slave.get("trustlevel") == "try":
-        return "tst-emulator64"
-
-    # b-2008
-    if slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "win2k8" and \
-       slave.get("purpose") == "build" and \
-       slave.get("trustlevel") == "core":
-        return "b-2008"
-
-    # y-2008 (try-2008)
-    if slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "win2k8" and \
-       slave.get("purpose") == "build" and \
-       slave.get("trustlevel") == "try":
-        return "y-2008"
-
-    # t-w732
-    if slave.get("bitlength") == "32" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "win7" and \
-       slave.get("purpose") == "tests" and \
-       slave.get("speed") == "c3.2xlarge" and \
-       slave.get("trustlevel") == "try":
-        return "t-w732"
-
-    # g-w732
-    if slave.get("bitlength") == "32" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "win7" and \
-       slave.get("purpose") == "tests" and \
-       slave.get("speed") == "g2.2xlarge" and \
-       slave.get("trustlevel") == "try":
-        return "g-w732"
-
-    return None
+    return load_slave_classifier().classify(slave)
 
 
 def get_slaves_json(url, cache):
+    refresh_slaves_json(url, cache)
+    return read_slaves_json(cache)
+
+
+def refresh_slaves_json(url, cache):
+    """Makes sure `cache` holds a copy of slaves.json which is at most
+    CACHE_TTL seconds old. Expired copies are revalidated with the ETag and
+    Last-Modified headers of the last download. Returns the digest of the
+    content, or None if it's unknown"""
+    meta = read_meta(cache)
     try:
         mtime = os.stat(cache).st_mtime
-        now = time.time()
-        if now - mtime < CACHE_TTL:
+        if time.time() - mtime < CACHE_TTL:
             log.debug("Using cached slaves.json")
-            return read_slaves_json(cache)
+            return meta.get("digest")
         else:
-            log.debug("File expired, fetching a new one")
-    except (OSError, IOError, KeyError):
+            log.debug("File expired, revalidating it")
+    except (OSError, IOError):
         log.warn("Error reading cache file, trying to fetch", exc_info=True)
+        meta = {}
 
     try:
-        download_file(url, cache)
+        meta = download_file(url, cache, meta)
     except:
         log.warn("Cannot fetch slaves.json, reusing the existing file",
                  exc_info=True)
-    return read_slaves_json(cache)
+    return meta.get("digest")
+
+
+def read_meta(cache):
+    try:
+        with open("%s.meta" % cache) as f:
+            return json.load(f)
+    except (OSError, IOError, ValueError):
+        return {}
 
 
 def read_slaves_json(filename):
     return json.load(open(filename))
 
 
-def download_file(url, dest):
-    req = requests.get(url, timeout=30)
+def download_file(url, dest, meta=None):
+    """Downloads `url` to `dest`, unless the server says it hasn't changed
+    since the download described by `meta`. Returns the metadata of the
+    current download, which is also saved next to `dest`"""
+    headers = {}
+    if meta and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta and meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    req = requests.get(url, timeout=30, headers=headers)
+    if req.status_code == 304:
+        log.debug("%s not modified", url)
+        # Start the next CACHE_TTL period
+        os.utime(dest, None)
+        return meta
     req.raise_for_status()
+    _write_atomically(dest, req.content)
+    meta = {
+        "etag": req.headers.get("ETag"),
+        "last_modified": req.headers.get("Last-Modified"),
+        "digest": hashlib.sha1(req.content).hexdigest(),
+    }
+    _write_atomically("%s.meta" % dest, json.dumps(meta))
+    return meta
+
+
+def _write_atomically(dest, content):
     _, tmp_fname = tempfile.mkstemp()
     with open(tmp_fname, "wb") as f:
-        f.write(req.content)
+        f.write(content)
     log.debug("moving %s to %s", tmp_fname, dest)
     shutil.move(tmp_fname, dest)
@@ -5,7 +5,9 @@ from cloudtools.aws import aws_get_fresh_instances, FRESH_INSTANCE_DELAY, \
     filter_instances_launched_since, \
     reduce_by_freshness, distribute_in_region, aws_get_running_instances, \
     aws_filter_instances, filter_spot_instances, \
-    filter_ondemand_instances, get_buildslave_instances
+    filter_ondemand_instances, get_buildslave_instances, region_map, \
+    aws_get_all_instances, invalidate_instances_cache, instance_filters, \
+    iter_instances, LIVE_INSTANCE_STATES
 
 
 @pytest.fixture
@@ -161,3 +163,81 @@ def test_get_buildslave_instances(conn, example_instances):
     conn.return_value.get_only_instances.assert_called_once_with(
         filters={'tag:moz-state': 'ready',
                  'instance-state-name': 'running'})
+
+
+def test_region_map():
+    assert region_map(lambda r: r.upper(), ["a", "b", "c"]) == \
+        {"a": "A", "b": "B", "c": "C"}
+
+
+def test_region_map_error():
+    def f(r):
+        if r == "b":
+            raise ValueError(r)
+        return r
+
+    with pytest.raises(ValueError):
+        region_map(f, ["a", "b", "c"])
+    assert region_map(f, ["a", "b", "c"], ignore_errors=True) == \
+        {"a": "a", "c": "c"}
+
+
+@mock.patch("cloudtools.aws.iter_instances")
+def test_aws_get_all_instances(m_iter_instances):
+    invalidate_instances_cache()
+    m_iter_instances.side_effect = lambda region, state: iter([region + "-i"])
+    assert aws_get_all_instances(["r1", "r2"]) == ["r1-i", "r2-i"]
+    # cached
+    assert aws_get_all_instances(["r2", "r1"]) == ["r2-i", "r1-i"]
+    assert m_iter_instances.call_count == 2
+    m_iter_instances.assert_any_call("r1", state=LIVE_INSTANCE_STATES)
+    invalidate_instances_cache()
+
+
+def test_instance_filters():
+    assert instance_filters() == {}
+    assert instance_filters(state="running", tags={"moz-type": ["t1", "t2"]},
+                            lifecycle="spot") == {
+        "instance-state-name": "running",
+        "tag:moz-type": ["t1", "t2"],
+        "instance-lifecycle": "spot"}
+    assert instance_filters(lifecycle="ondemand") == {}
+
+
+def _reservations(instances, next_token=None):
+    r = mock.Mock()
+    r.instances = instances
+    rs = mock.MagicMock()
+    rs.__iter__.return_value = iter([r])
+    rs.next_token = next_token
+    return rs
+
+
+@mock.patch("cloudtools.aws.get_aws_connection")
+def test_iter_instances_pages(conn, example_instances):
+    e = example_instances
+    pages = [_reservations(e[:2], "t1"), _reservations(e[2:])]
+    params_seen = []
+
+    def get_list(action, params, markers, verb):
+        params_seen.append(dict(params))
+        return pages.pop(0)
+
+    conn.return_value.get_list.side_effect = get_list
+    conn.return_value.build_filter_params.side_effect = \
+        lambda params, filters: params.update(filters)
+    instances = iter_instances("r1", state="running", page_size=2)
+    # nothing is fetched until the results are consumed
+    assert not params_seen
+    assert list(instances) == e
+    assert params_seen == [
+        {"MaxResults": 2, "instance-state-name": "running"},
+        {"MaxResults": 2, "instance-state-name": "running",
+         "NextToken": "t1"}]
+
+
+@mock.patch("cloudtools.aws.get_aws_connection")
+def test_iter_instances_ondemand(conn, example_instances):
+    e = example_instances
+    conn.return_value.get_list.return_value = _reservations(e)
+    assert list(iter_instances("r1", lifecycle="ondemand")) == [e[2], e[3]]
@@ -0,0 +1,103 @@
+import mock
+import pytest
+
+import cloudtools.cache
+from cloudtools.aws.ami import AmiCatalog, get_spot_amis, get_ami, \
+    copy_amis
+from cloudtools.aws.waiter import Wait
+
+
+def ami(ami_id, moz_type, created, root_device_type="ebs", **tags):
+    tags.update({"moz-type": moz_type, "moz-created": created})
+    return mock.Mock(id=ami_id, root_device_type=root_device_type, tags=tags)
+
+
+def test_ami_catalog():
+    a1 = ami("a1", "t1", "900")
+    a2 = ami("a2", "t1", "1000", "instance-store")
+    a3 = ami("a3", "t1", "1100", extra="x")
+    a4 = ami("a4", "t2", None)
+    catalog = AmiCatalog([a3, a2, a4, a1])
+    assert len(catalog) == 4
+    # sorted numerically, not as strings
+    assert catalog.find({"moz-type": "t1"}) == [a1, a2, a3]
+    assert catalog.find({"moz-type": "t1"}, "ebs") == [a1, a3]
+    assert catalog.find({"moz-type": "t1", "extra": "x"}) == [a3]
+    assert catalog.find({"moz-type": "t2"}) == [a4]
+    assert catalog.find({"moz-type": "t3"}) == []
+
+
+@mock.patch("cloudtools.aws.ami.get_aws_connection")
+def test_get_spot_amis(conn):
+    cloudtools.cache.invalidate("ami_catalog")
+    amis = [ami("a1", "t1", "2"), ami("a2", "t1", "1"), ami("a3", "t2", "3")]
+    conn.return_value.get_all_images.return_value = amis
+    assert get_spot_amis("r1", {"moz-type": "t1"}) == [amis[1], amis[0]]
+    assert get_ami("r1", "t1") == amis[0]
+    assert get_ami("r1", "t2") == amis[2]
+    # one describe call per region
+    conn.return_value.get_all_images.assert_called_once_with(
+        owners=["self"], filters={"state": "available", "tag:Name": "spot-*"})
+    cloudtools.cache.invalidate("ami_catalog")
+
+
+def finished_wait(obj, attr_name, attr_values):
+    w = Wait(obj, attr_name, attr_values)
+    obj.state = "pending"
+    w.finish()
+    return w
+
+
+@mock.patch("cloudtools.aws.ami.waiter.wait_for", finished_wait)
+@mock.patch("cloudtools.aws.tags.get_aws_connection")
+@mock.patch("cloudtools.aws.ami.get_aws_connection")
+def test_copy_amis(m_conn, m_tags_conn):
+    conns = {"r2": mock.Mock(), "r3": mock.Mock()}
+    m_conn.side_effect = m_tags_conn.side_effect = \
+        lambda region: conns[region]
+    for region, conn in conns.items():
+        conn.copy_image.side_effect = \
+            lambda src_region, ami_id, name, description, region=region: \
+            mock.Mock(image_id="%s-%s" % (ami_id, region))
+    sources = [ami("a1", "t1", "1"), ami("a2", "t2", "2")]
+    for source in sources:
+        source.region.name = "r1"
+    copies = copy_amis(sources, ["r2", "r3"])
+    assert sorted(copies) == [("a1", "r2"), ("a1", "r3"), ("a2", "r2"),
+                              ("a2", "r3")]
+    assert copies[("a2", "r3")].id == "a2-r3"
+    assert copies[("a2", "r3")].tags["moz-type"] == "t2"
+    conns["r3"].copy_image.assert_any_call("r1", "a2", sources[1].name,
+                                           sources[1].description)
+    conns["r3"].create_tags.assert_any_call(["a2-r3"], sources[1].tags)
+
+
+@mock.patch("cloudtools.aws.ami.waiter.wait_for", finished_wait)
+@mock.patch("cloudtools.aws.tags.get_aws_connection")
+@mock.patch("cloudtools.aws.ami.get_aws_connection")
+def test_copy_amis_region_fails(m_conn, m_tags_conn):
+    conns = {"r2": mock.Mock(), "r3": mock.Mock()}
+    m_conn.side_effect = m_tags_conn.side_effect = \
+        lambda region: conns[region]
+    conns["r2"].copy_image.side_effect = Exception("Unavailable")
+    conns["r3"].copy_image.return_value = mock.Mock(image_id="a1-r3")
+    source = ami("a1", "t1", "1")
+    source.region.name = "r1"
+    with pytest.raises(Exception) as e:
+        copy_amis([source], ["r2", "r3"])
+    assert "Unavailable" in str(e.value)
+    # the other region was still copied and tagged
+    conns["r3"].create_tags.assert_called_once_with(["a1-r3"], source.tags)
+
+
+@mock.patch("cloudtools.aws.ami.waiter.wait_for", finished_wait)
+@mock.patch("cloudtools.aws.ami.add_tags")
+@mock.patch("cloudtools.aws.ami.get_aws_connection")
+def test_copy_amis_tagging_fails(m_conn, m_add_tags):
+    m_conn.return_value.copy_image.return_value = mock.Mock(image_id="a1-r2")
+    m_add_tags.return_value.result.side_effect = Exception("NotFound")
+    source = ami("a1", "t1", "1")
+    source.region.name = "r1"
+    with pytest.raises(Exception):
+        copy_amis([source], ["r2"])
+    m_add_tags.assert_called_once_with("r2", ["a1-r2"], source.tags)
@@ -121,20 +121,19 @@ def test_bd_volume_type():
     assert bd.volume_type == "gp2"
 
 
-def test_tag_ondemand_instance():
+@mock.patch("cloudtools.aws.instance.add_tags")
+def test_tag_ondemand_instance(m_add_tags):
     instance = mock.MagicMock()
+    instance.id = "i-1"
+    instance.region.name = "us-east-1"
     name = "name1"
     fqdn = "FQDN1"
     moz_instance_type = "type1"
-    with mock.patch("time.sleep"):
-        tag_ondemand_instance(instance, name, fqdn, moz_instance_type)
-    expected_calls = [
-        mock.call.add_tag("Name", name),
-        mock.call.add_tag("FQDN", fqdn),
-        mock.call.add_tag("moz-type", moz_instance_type),
-        mock.call.add_tag("moz-state", "ready"),
-    ]
-    instance.assert_has_calls(expected_calls, any_order=True)
+    assert tag_ondemand_instance(instance, name, fqdn,
+                                 moz_instance_type) is instance
+    m_add_tags.assert_called_once_with("us-east-1", ["i-1"], {
+        "Name": name, "FQDN": fqdn, "moz-type": moz_instance_type,
+        "moz-state": "ready"})
 
 
 def test_pick_puppet_master():
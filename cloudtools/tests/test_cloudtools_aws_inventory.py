@@ -0,0 +1,60 @@
+import mock
+import pytest
+
+from cloudtools.aws.inventory import InstanceInventory, instance_lifecycle
+
+
+def make_instance(id_, state, moz_type, moz_state, spot, image_id="ami-1"):
+    i = mock.Mock(name=id_)
+    i.id = id_
+    i.state = state
+    i.tags = {"moz-type": moz_type, "moz-state": moz_state}
+    i.spot_instance_request_id = "r-%s" % id_ if spot else None
+    i.image_id = image_id
+    return i
+
+
+@pytest.fixture
+def inventory():
+    return InstanceInventory([
+        make_instance("i0", "running", "m1", "ready", True),
+        make_instance("i1", "running", "m1", "ready", False, "ami-2"),
+        make_instance("i2", "stopped", "m1", "ready", True),
+        make_instance("i3", "running", "m1", "not-ready", True),
+        make_instance("i4", "running", "m2", "ready", True, "ami-2"),
+        make_instance("i5", "running", "m1", "ready", True),
+    ])
+
+
+def test_instance_lifecycle():
+    assert instance_lifecycle(make_instance("i", "running", "t", "ready",
+                                            True)) == "spot"
+    assert instance_lifecycle(make_instance("i", "running", "t", "ready",
+                                            False)) == "ondemand"
+
+
+def test_running(inventory):
+    assert [i.id for i in inventory.running("m1", "spot")] == ["i0", "i5"]
+    assert [i.id for i in inventory.running("m1", "ondemand")] == ["i1"]
+    assert [i.id for i in inventory.running("m1")] == ["i0", "i5", "i1"]
+    assert inventory.running("m3", "spot") == []
+
+
+def test_count_running(inventory):
+    assert inventory.count_running("m1", "spot") == 2
+    assert inventory.count_running("m1") == 3
+    assert inventory.count_running("m2", "ondemand") == 0
+
+
+def test_select(inventory):
+    assert [i.id for i in inventory.select("m1", "spot", "stopped",
+                                           "ready")] == ["i2"]
+
+
+def test_ids_and_images(inventory):
+    assert "i3" in inventory
+    assert "i9" not in inventory
+    assert len(inventory) == 6
+    assert inventory.count_by_image("ami-1") == 4
+    assert inventory.count_by_image("ami-2") == 2
+    assert inventory.count_by_image("ami-3") == 0
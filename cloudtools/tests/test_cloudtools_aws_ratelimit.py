@@ -0,0 +1,118 @@
+import mock
+import pytest
+from boto.exception import BotoServerError
+
+from cloudtools.aws.ratelimit import TokenBucket, RateLimiter, \
+    get_rate_limiter, install, backoff
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(request):
+    clock = Clock()
+    patches = [mock.patch("time.time", clock.time),
+               mock.patch("time.sleep", clock.sleep)]
+    for p in patches:
+        p.start()
+        request.addfinalizer(p.stop)
+    return clock
+
+
+def throttle_error():
+    e = BotoServerError(503, "Throttled")
+    e.code = "RequestLimitExceeded"
+    return e
+
+
+def test_burst_then_rate(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.now == 1000
+    bucket.acquire()
+    assert clock.now == pytest.approx(1000.5)
+
+
+def test_aimd(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    bucket.throttled()
+    assert bucket.rate == 1
+    # the bucket was drained
+    bucket.acquire()
+    assert clock.now == pytest.approx(1001)
+    bucket.succeeded()
+    assert bucket.rate == pytest.approx(1.02)
+    for _ in range(100):
+        bucket.succeeded()
+    assert bucket.rate == 2
+
+
+def test_aimd_recovery(clock):
+    bucket = TokenBucket(rate=10, burst=3)
+    bucket.throttled()
+    bucket.throttled()
+    assert bucket.rate == 2.5
+    # the rate climbs back linearly, a tenth of a call/s per success
+    rates = []
+    for _ in range(100):
+        bucket.succeeded()
+        rates.append(bucket.rate)
+    assert rates[9] == pytest.approx(3.5)
+    assert rates[49] == pytest.approx(7.5)
+    assert rates[74] == pytest.approx(10)
+    assert rates[-1] == 10
+    # a single throttle undoes 50 successes at full speed
+    bucket.throttled()
+    for _ in range(49):
+        bucket.succeeded()
+    assert bucket.rate < 10
+
+
+def test_backoff():
+    for attempt in range(1, 10):
+        assert 0 <= backoff(attempt) <= min(30, 0.5 * 2 ** attempt)
+
+
+def test_rate_limiter_retries(clock):
+    limiter = RateLimiter(TokenBucket(rate=2, burst=3), max_tries=3)
+    func = mock.Mock(side_effect=[throttle_error(), "ok"])
+    assert limiter.call(func, 1, a=2) == "ok"
+    assert func.call_args_list == [mock.call(1, a=2)] * 2
+    assert limiter.stats() == {"calls": 2, "throttled": 1, "retries": 1,
+                               "rate": pytest.approx(1.02)}
+
+
+def test_rate_limiter_gives_up(clock):
+    limiter = RateLimiter(TokenBucket(rate=2, burst=3), max_tries=3)
+    func = mock.Mock(side_effect=throttle_error())
+    with pytest.raises(BotoServerError):
+        limiter.call(func)
+    assert func.call_count == 3
+    other = BotoServerError(400, "Bad")
+    other.code = "InvalidParameterValue"
+    func = mock.Mock(side_effect=other)
+    with pytest.raises(BotoServerError):
+        limiter.call(func)
+    assert func.call_count == 1
+
+
+def test_install():
+    conn = mock.Mock()
+    get_list = conn.get_list
+    get_list.return_value = ["i-1"]
+    assert install(conn, "r1") is conn
+    assert conn.get_list("DescribeInstances", {}) == ["i-1"]
+    get_list.assert_called_once_with("DescribeInstances", {})
+    assert get_rate_limiter("r1") is get_rate_limiter("r1")
+    assert get_rate_limiter("r1").stats()["calls"] >= 1
@@ -1,12 +1,23 @@
+import threading
+import time
+
 import mock
 import boto
+import boto.resultset
+from datetime import datetime, timedelta
 import pytest
 import cloudtools.aws.spot
+import cloudtools.cache
 from cloudtools.aws.spot import (
     get_spot_requests_for_moztype, populate_spot_requests_cache,
     get_spot_request, get_instances_to_tag, copy_spot_request_tags,
-    get_active_spot_requests, get_spot_instances, get_spot_requests
+    get_active_spot_requests, get_ended_spot_requests, get_spot_instances,
+    get_spot_requests, group_spot_request_tags, get_current_spot_prices,
+    get_spot_choices, Spot, SpotRequestIndex, usable_spot_choice,
+    SlaveNameAllocator, get_available_slave_name, release_slave_name,
+    reset_available_slave_names
 )
+from cloudtools.aws.spot_prices import SpotPriceStore
 
 
 @mock.patch("cloudtools.aws.spot.get_aws_connection")
@@ -24,7 +35,7 @@ def test_with_reqest_ids(conn):
 
 
 @mock.patch("cloudtools.aws.spot.get_aws_connection")
-def test_invalid_request_id(conn):
+def test_invalid_request_id(conn, setup):
     req = mock.Mock()
     req.id = "id-1"
     conn.return_value.get_all_spot_instance_requests.side_effect = \
@@ -36,13 +47,14 @@ def test_invalid_request_id(conn):
     ]
     conn.return_value.get_all_spot_instance_requests.assert_has_calls(
         expected_calls)
-    assert cloudtools.aws.spot._spot_requests == {("r-1", "id-1"): req}
+    assert cloudtools.aws.spot._spot_requests.keys() == [("r-1", "id-1")]
+    assert cloudtools.aws.spot._spot_requests.get(("r-1", "id-1")) is req
 
 
 @pytest.fixture
 def setup():
     # reset the cahches
-    reload(cloudtools.aws.spot)
+    cloudtools.cache.invalidate()
 
 
 @mock.patch("cloudtools.aws.spot.populate_spot_requests_cache")
@@ -109,6 +121,36 @@ def test_no_req(m_get_spot_request):
     i.connection.create_tags.assert_not_called()
 
 
+@mock.patch("cloudtools.aws.spot.get_spot_request")
+def test_group_spot_request_tags(m_get_spot_request):
+    def req(region, request_id):
+        if request_id == "sir-missing":
+            return None
+        moz_type, n = request_id.split("-")[1:]
+        return mock.Mock(tags={"moz-type": moz_type, "Name": "s" + n,
+                               "FQDN": "s%s.example.com" % n})
+    m_get_spot_request.side_effect = req
+    instances = []
+    for n, request_id in enumerate(["sir-a-0", "sir-b-1", "sir-a-2",
+                                    "sir-a-3", "sir-missing"]):
+        i = mock.Mock(id="i-%i" % n, tags={},
+                      spot_instance_request_id=request_id)
+        i.region.name = "us-east-1"
+        instances.append(i)
+    # i-3 has its name already
+    instances[3].tags = {"Name": "s3"}
+    groups = group_spot_request_tags(instances, max_group_size=2)
+    assert [([x.id for x in g], tags) for g, tags in groups] == [
+        (["i-0", "i-2"], {"moz-type": "a", "moz-state": "ready"}),
+        (["i-3"], {"moz-type": "a", "moz-state": "ready"}),
+        (["i-1"], {"moz-type": "b", "moz-state": "ready"}),
+        (["i-0"], {"Name": "s0", "FQDN": "s0.example.com"}),
+        (["i-1"], {"Name": "s1", "FQDN": "s1.example.com"}),
+        (["i-2"], {"Name": "s2", "FQDN": "s2.example.com"}),
+        (["i-3"], {"FQDN": "s3.example.com"}),
+    ]
+
+
 @mock.patch("cloudtools.aws.spot.get_aws_connection")
 def test_get_active_spot_requests(c):
     get_active_spot_requests("r1")
@@ -117,6 +159,13 @@ def test_get_active_spot_requests(c):
         filters={'state': ['open', 'active']})
 
 
+@mock.patch("cloudtools.aws.spot.get_aws_connection")
+def test_get_ended_spot_requests(c):
+    get_ended_spot_requests("r1")
+    c.return_value.get_all_spot_instance_requests.assert_called_once_with(
+        filters={'state': ['closed', 'cancelled']})
+
+
 @mock.patch("cloudtools.aws.spot.get_aws_connection")
 def test_get_spot_instances(conn):
     get_spot_instances("r1")
@@ -133,6 +182,8 @@ def test_state(conn):
                  "instance-state-name": "stopped"})
 
 
+@mock.patch("cloudtools.aws.spot.get_ended_spot_requests", mock.Mock(
+    return_value=[]))
 @mock.patch("cloudtools.aws.spot.get_active_spot_requests")
 def test_get_spot_requests(m):
     r1 = mock.Mock()
@@ -149,6 +200,8 @@ def test_get_spot_requests(m):
     m.assert_called_once_with("r1")
 
 
+@mock.patch("cloudtools.aws.spot.get_ended_spot_requests", mock.Mock(
+    return_value=[]))
 @mock.patch("cloudtools.aws.spot.get_active_spot_requests")
 def test_no_requests(m):
     m.return_value = None
@@ -165,3 +218,237 @@ def test_generic(m):
     r3 = mock.Mock()
     m.return_value = [r1, r2, r3]
     assert get_spot_requests_for_moztype("r11", "tt1") == [r1]
+
+
+def price_history(prices, next_token=None):
+    rv = boto.resultset.ResultSet()
+    rv.extend(mock.Mock(availability_zone=az, timestamp=timestamp,
+                        price=value, instance_type="m3.large")
+              for az, timestamp, value in prices)
+    rv.next_token = next_token
+    return rv
+
+
+@mock.patch("cloudtools.aws.spot.get_spot_price_store")
+def test_get_current_spot_prices_delta(m_store, setup):
+    store = SpotPriceStore()
+    m_store.return_value = store
+    conn = mock.Mock()
+    conn.region.name = "us-east-1"
+    conn.get_all_zones.return_value = [mock.Mock(), mock.Mock()]
+    conn.get_all_zones.return_value[0].name = "us-east-1a"
+    conn.get_all_zones.return_value[1].name = "us-east-1b"
+    now = datetime.utcnow()
+    t1 = (now - timedelta(hours=2)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    t2 = (now - timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    conn.get_spot_price_history.side_effect = [
+        price_history([("us-east-1a", t1, 0.1)], "token"),
+        price_history([("us-east-1b", t1, 0.2)], "token"),
+        price_history([("us-east-1a", t2, 0.3)]),
+    ]
+    assert get_current_spot_prices(conn, "Linux", instance_type="m3.large") \
+        == {"us-east-1": {"m3.large": {"us-east-1a": 0.1, "us-east-1b": 0.2}}}
+    # stopped paging once both zones had a price
+    assert conn.get_spot_price_history.call_count == 2
+
+    assert get_current_spot_prices(conn, "Linux", instance_type="m3.large",
+                                   ignore_cache=True) == \
+        {"us-east-1": {"m3.large": {"us-east-1a": 0.3, "us-east-1b": 0.2}}}
+    # only asked for changes since the newest price seen
+    assert conn.get_spot_price_history.call_args[1]["start_time"] == \
+        t1.replace(".000", "")
+
+
+@mock.patch("cloudtools.aws.spot.get_spot_price_store")
+def test_get_current_spot_prices_ignored_zones(m_store, setup):
+    store = SpotPriceStore()
+    m_store.return_value = store
+    conn = mock.Mock()
+    conn.region.name = "us-east-1"
+    conn.get_all_zones.return_value = [mock.Mock(), mock.Mock()]
+    conn.get_all_zones.return_value[0].name = "us-east-1a"
+    conn.get_all_zones.return_value[1].name = "us-east-1b"
+    t1 = (datetime.utcnow() - timedelta(hours=1)).strftime(
+        "%Y-%m-%dT%H:%M:%S.000Z")
+    conn.get_spot_price_history.side_effect = [
+        price_history([("us-east-1a", t1, 0.1)], "token"),
+        price_history([("us-east-1a", t1, 0.1)], "token"),
+        price_history([("us-east-1b", t1, 0.2)]),
+        price_history([]),
+    ]
+    ignoring_b = {"us-east-1": {"m3.large": {"us-east-1a": 0.1}}}
+    assert get_current_spot_prices(
+        conn, "Linux", instance_type="m3.large",
+        ignored_availability_zones=["us-east-1b"]) == ignoring_b
+    # stopped paging once the zone we need had a price
+    assert conn.get_spot_price_history.call_count == 1
+    assert store.fetched_until("us-east-1", "Linux", "m3.large",
+                               ["us-east-1b"]) is None
+    assert get_current_spot_prices(
+        conn, "Linux", instance_type="m3.large",
+        ignored_availability_zones=["us-east-1b"]) == ignoring_b
+    assert conn.get_spot_price_history.call_count == 1
+    # a rule which doesn't ignore us-east-1b fetches its price
+    assert get_current_spot_prices(conn, "Linux",
+                                   instance_type="m3.large") == \
+        {"us-east-1": {"m3.large": {"us-east-1a": 0.1, "us-east-1b": 0.2}}}
+    assert conn.get_spot_price_history.call_count == 3
+    # now both zones are known, so only changes are fetched
+    assert get_current_spot_prices(
+        conn, "Linux", instance_type="m3.large",
+        ignored_availability_zones=["us-east-1b"],
+        ignore_cache=True) == ignoring_b
+    assert conn.get_spot_price_history.call_args[1]["start_time"] == \
+        t1.replace(".000", "")
+
+
+@mock.patch("cloudtools.aws.spot.get_current_spot_prices")
+def test_get_spot_choices(m_prices):
+    prices = {
+        "us-east-1": {"m3.large": {"us-east-1a": 0.1, "us-east-1b": 0.3},
+                      "c3.xlarge": {"us-east-1a": 0.15}},
+        "us-west-2": {"m3.large": {"us-west-2a": 0.05}},
+    }
+
+    def get_prices(conn, product_description, start_time, instance_type,
+                   ignored_azs):
+        region = conn.region.name
+        return {region: {instance_type: dict(
+            (az, p) for az, p in prices[region].get(instance_type, {}).items()
+            if az not in ignored_azs)}}
+    m_prices.side_effect = get_prices
+    connections = []
+    for region in ["us-east-1", "us-west-2"]:
+        conn = mock.Mock()
+        conn.region.name = region
+        connections.append(conn)
+    rules = [
+        {"instance_type": "m3.large", "bid_price": 0.25,
+         "performance_constant": 1},
+        {"instance_type": "c3.xlarge", "bid_price": 0.5,
+         "performance_constant": 2, "ignored_azs": ["us-east-1b"]},
+    ]
+    choices = get_spot_choices(connections, rules, "Linux")
+    # us-east-1b is too expensive for its bid
+    assert [(c.instance_type, c.availability_zone, c.value)
+            for c in choices] == [
+        ("m3.large", "us-west-2a", 0.05),
+        ("c3.xlarge", "us-east-1a", 0.075),
+        ("m3.large", "us-east-1a", 0.1),
+    ]
+
+
+def test_spot():
+    s1 = Spot("m3.large", "us-east-1", "us-east-1a", 0.1, 0.25, 2)
+    s2 = Spot("m3.large", "us-east-1", "us-east-1a", 0.1, 0.25, 2)
+    s3 = Spot("c3.large", "us-east-1", "us-east-1a", 0.1, 0.25, 1)
+    assert s1.value == 0.05
+    assert s1 == s2 and hash(s1) == hash(s2)
+    assert s1 != s3
+    assert s1 < s3 and s3 > s1
+    assert sorted([s3, s1]) == [s1, s3]
+    with pytest.raises(AttributeError):
+        s1.current_price = 1
+    with pytest.raises(AttributeError):
+        s1.foo = 1
+
+
+def spot_request(instance_type, az, minutes_ago, code="fulfilled"):
+    r = mock.Mock()
+    r.launch_specification.instance_type = instance_type
+    r.launched_availability_zone = az
+    r.status.update_time = (datetime.utcnow() - timedelta(
+        minutes=minutes_ago)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    r.status.code = code
+    r.tags = {}
+    return r
+
+
+def test_spot_request_index():
+    requests = [
+        spot_request("t1", "az1", 1),
+        spot_request("t1", "az1", 5, "price-too-low"),
+        spot_request("t1", "az1", 60, "price-too-low"),
+        spot_request("t2", "az1", 1, "capacity-not-available"),
+    ]
+    index = SpotRequestIndex(requests)
+    assert index.requests("t1", "az1") == requests[:3]
+    assert index.requests("t1", "az2") == []
+    assert index.recent("t1", "az1", 15) == (2, 1)
+    assert index.recent("t1", "az1", 120) == (3, 2)
+    assert index.recent("t2", "az1", 15) == (1, 1)
+    assert index.recent("t3", "az1", 15) == (0, 0)
+
+
+@mock.patch("cloudtools.aws.spot.get_ended_spot_requests", mock.Mock(
+    return_value=[]))
+@mock.patch("cloudtools.aws.spot.get_active_spot_requests")
+def test_usable_spot_choice(m_requests, setup):
+    # 1 out of 5 recent requests failed
+    m_requests.return_value = [spot_request("t1", "az1", 1)] * 4 + [
+        spot_request("t1", "az1", 1, "price-too-low")]
+    choice = Spot("t1", "r1", "az1", 0.1, 0.5, 1)
+    assert not usable_spot_choice(choice)
+    # price too close to the bid
+    m_requests.return_value = []
+    assert not usable_spot_choice(Spot("t1", "r2", "az1", 0.45, 0.5, 1))
+    assert usable_spot_choice(Spot("t1", "r2", "az1", 0.1, 0.5, 1))
+
+
+def test_slave_name_allocator():
+    allocator = SlaveNameAllocator(["s3", "s1", "s2", "s4"], ["s2", None])
+    assert len(allocator) == 3
+    assert allocator.allocate() == "s1"
+    assert allocator.allocate() == "s3"
+    allocator.release("s1")
+    # names which weren't handed out can't be released
+    allocator.release("s2")
+    assert allocator.allocate() == "s1"
+    assert allocator.allocate() == "s4"
+    assert allocator.allocate() is None
+
+
+@mock.patch("cloudtools.aws.spot.get_active_spot_requests")
+@mock.patch("cloudtools.aws.spot.get_classified_slaves")
+def test_get_available_slave_name(m_slaves, m_requests):
+    m_slaves.return_value = {"t": {"r1": set(["s1", "s2", "s3", "s4"])}}
+    m_requests.return_value = [mock.Mock(tags={"Name": "s2"})]
+    instances = [mock.Mock(tags={"Name": "s1"}, state="running"),
+                 mock.Mock(tags={"Name": "s3"}, state="terminated")]
+    reset_available_slave_names()
+    assert get_available_slave_name("r1", "t", True, instances) == "s3"
+    release_slave_name("r1", "t", True, "s3")
+    assert get_available_slave_name("r1", "t", True, instances) == "s3"
+    assert get_available_slave_name("r1", "t", True, instances) == "s4"
+    assert get_available_slave_name("r1", "t", True, instances) is None
+    # the allocator is built once
+    assert m_slaves.call_count == 1
+    reset_available_slave_names()
+
+
+@mock.patch("cloudtools.aws.spot.get_active_spot_requests")
+@mock.patch("cloudtools.aws.spot.get_classified_slaves")
+def test_get_available_slave_name_concurrently(m_slaves, m_requests):
+    names = ["s%i" % n for n in range(20)]
+
+    def slow_slaves(is_spot):
+        # give other threads a chance to build their own allocator
+        time.sleep(0.01)
+        return {"t": {"r1": set(names)}}
+
+    m_slaves.side_effect = slow_slaves
+    m_requests.return_value = []
+    reset_available_slave_names()
+    allocated = []
+
+    def launch():
+        allocated.append(get_available_slave_name("r1", "t", False, []))
+
+    threads = [threading.Thread(target=launch) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(allocated) == sorted(names)[:8]
+    assert m_slaves.call_count == 1
+    reset_available_slave_names()
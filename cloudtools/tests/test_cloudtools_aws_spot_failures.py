@@ -0,0 +1,131 @@
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+import mock
+import pytest
+
+import cloudtools.cache
+from cloudtools.aws.spot import record_spot_request_outcomes, \
+    get_spot_request_index
+from cloudtools.aws.spot_failures import SpotFailureTracker, HALF_LIFE
+
+MARKET = ("us-east-1", "m3.large", "us-east-1a")
+
+
+@pytest.fixture
+def tracker():
+    return SpotFailureTracker()
+
+
+def test_no_history(tracker):
+    assert tracker.failure_rate(*MARKET, now=0) == 0
+    assert tracker.penalty(*MARKET, now=0) == 1
+
+
+def test_failures_raise_penalty(tracker):
+    for _ in range(3):
+        tracker.record(*MARKET, failed=True, now=0)
+    assert tracker.failure_rate(*MARKET, now=0) == 0.75
+    assert tracker.penalty(*MARKET, now=0) == 1.75
+    assert tracker.penalty("us-east-1", "m3.large", "us-east-1b", now=0) == 1
+
+
+def test_decay(tracker):
+    tracker.record(*MARKET, failed=True, now=0)
+    tracker.record(*MARKET, failed=False, now=HALF_LIFE)
+    # The failure now weighs 0.5, the success 1
+    assert tracker.failure_rate(*MARKET, now=HALF_LIFE) == 0.5 / 2.5
+    assert tracker.failure_rate(*MARKET, now=HALF_LIFE * 100) < 0.001
+
+
+def test_record_request_once(tracker):
+    tracker.record_request("sir-1", *MARKET, failed=False, now=0)
+    tracker.record_request("sir-1", *MARKET, failed=False, now=0)
+    # A fulfilled request can be terminated by AWS later
+    tracker.record_request("sir-1", *MARKET, failed=True, now=0)
+    assert tracker.failure_rate(*MARKET, now=0) == 1 / 3.0
+
+
+def test_prune(tracker):
+    tracker.record_request("sir-1", *MARKET, failed=True, now=0)
+    tracker.prune(now=HALF_LIFE)
+    tracker.record_request("sir-1", *MARKET, failed=True, now=HALF_LIFE)
+    assert tracker.failure_rate(*MARKET, now=0) == 0.5
+    tracker.prune(now=10 ** 6)
+    # the old failure has decayed away
+    assert tracker.failure_rate(*MARKET, now=10 ** 6) < 0.001
+    tracker.record_request("sir-1", *MARKET, failed=True, now=10 ** 6)
+    assert tracker.failure_rate(*MARKET, now=10 ** 6) == 0.5
+
+
+def test_dump_load(tracker):
+    tracker.record_request("sir-1", *MARKET, failed=True, now=0)
+    f = StringIO()
+    tracker.dump(f)
+    f.seek(0)
+    loaded = SpotFailureTracker()
+    loaded.load(f)
+    assert loaded.failure_rate(*MARKET, now=0) == 0.5
+    loaded.record_request("sir-1", *MARKET, failed=True, now=0)
+    assert loaded.failure_rate(*MARKET, now=0) == 0.5
+
+
+def spot_request(request_id, code, minutes_ago=0):
+    r = mock.Mock(id=request_id, tags={},
+                  launched_availability_zone="us-east-1a")
+    r.status.code = code
+    r.status.update_time = (datetime.utcnow() - timedelta(
+        minutes=minutes_ago)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    r.launch_specification.instance_type = "m3.large"
+    return r
+
+
+@mock.patch("cloudtools.aws.spot.get_failure_tracker")
+def test_record_spot_request_outcomes(m_tracker, tracker):
+    m_tracker.return_value = tracker
+    record_spot_request_outcomes("us-east-1", [
+        spot_request("sir-1", "capacity-oversubscribed"),
+        spot_request("sir-2", "instance-terminated-by-price"),
+        spot_request("sir-3", "fulfilled"),
+        spot_request("sir-4", "pending-evaluation"),
+    ])
+    rate = tracker.failure_rate(*MARKET)
+    assert 0.49 < rate <= 0.5
+
+
+def test_out_of_order(tracker):
+    tracker.record(*MARKET, failed=False, now=HALF_LIFE)
+    # an older failure only counts as much as it has left
+    tracker.record(*MARKET, failed=True, now=0)
+    assert tracker.failure_rate(*MARKET, now=HALF_LIFE) == 0.5 / 2.5
+
+
+@mock.patch("cloudtools.aws.spot.get_failure_tracker")
+def test_record_spot_request_outcomes_when_updated(m_tracker, tracker):
+    m_tracker.return_value = tracker
+    # failures from two hours ago count for little
+    record_spot_request_outcomes("us-east-1", [
+        spot_request("sir-1", "price-too-low", minutes_ago=120),
+        spot_request("sir-2", "capacity-not-available", minutes_ago=120),
+        spot_request("sir-3", "fulfilled"),
+    ])
+    assert tracker.failure_rate(*MARKET) < 0.1
+
+
+@mock.patch("cloudtools.aws.spot.get_failure_tracker")
+@mock.patch("cloudtools.aws.spot.get_ended_spot_requests")
+@mock.patch("cloudtools.aws.spot.get_active_spot_requests")
+def test_ended_requests_raise_penalty(m_active, m_ended, m_tracker, tracker):
+    cloudtools.cache.invalidate("spot_request_index")
+    m_tracker.return_value = tracker
+    active = [spot_request("sir-1", "fulfilled")]
+    # closed and cancelled requests are no longer active
+    ended = [spot_request("sir-2", "instance-terminated-by-price"),
+             spot_request("sir-3", "capacity-not-available")]
+    m_active.return_value = active
+    m_ended.return_value = ended
+    get_spot_request_index("us-east-1")
+    m_ended.assert_called_once_with("us-east-1")
+    # 2 failures out of 3, plus the imaginary success
+    assert 1.49 < tracker.penalty(*MARKET) <= 1.5
+    cloudtools.cache.invalidate("spot_request_index")
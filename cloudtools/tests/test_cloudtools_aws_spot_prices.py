@@ -0,0 +1,89 @@
+import mock
+import pytest
+
+from cloudtools.aws.spot_prices import SpotPriceStore
+
+
+def price(az, timestamp, value, instance_type="m3.large"):
+    return mock.Mock(availability_zone=az, timestamp=timestamp, price=value,
+                     instance_type=instance_type)
+
+
+@pytest.fixture
+def store():
+    return SpotPriceStore()
+
+
+def test_latest(store):
+    store.add("us-east-1", "Linux", "m3.large", [
+        price("us-east-1a", "2014-03-01T10:00:00.000Z", 0.1),
+        price("us-east-1a", "2014-03-01T12:00:00.000Z", 0.2),
+        price("us-east-1b", "2014-03-01T11:00:00.000Z", 0.3),
+        price("us-east-1c", "2014-03-01T11:00:00.000Z", 0.4),
+    ])
+    assert store.latest("us-east-1", "Linux", "m3.large") == {
+        "m3.large": {"us-east-1a": 0.2, "us-east-1b": 0.3,
+                     "us-east-1c": 0.4}}
+    assert store.latest("us-east-1", "Linux", "m3.large",
+                        ["us-east-1a"]) == {"m3.large": {"us-east-1a": 0.2}}
+    assert store.latest("us-west-2", "Linux", "m3.large") == {}
+
+
+def test_fetched_until(store):
+    zones = ["us-east-1a", "us-east-1b"]
+    assert store.fetched_until("us-east-1", "Linux", "m3.large",
+                               zones) is None
+    store.add("us-east-1", "Linux", "m3.large", [
+        price("us-east-1a", "2014-03-01T12:00:00.000Z", 0.2)])
+    # us-east-1b hasn't been fetched
+    assert store.fetched_until("us-east-1", "Linux", "m3.large",
+                               zones) is None
+    assert store.fetched_until("us-east-1", "Linux", "m3.large",
+                               ["us-east-1a"]) == "2014-03-01T12:00:00Z"
+    store.add("us-east-1", "Linux", "m3.large", [
+        price("us-east-1b", "2014-03-01T13:00:00.000Z", 0.3),
+        price("us-east-1b", "2014-03-01T11:00:00.000Z", 0.4),
+    ])
+    assert store.fetched_until("us-east-1", "Linux", "m3.large",
+                               zones) == "2014-03-01T12:00:00Z"
+    # changes since 12:00 cover us-east-1a, even though its price didn't
+    # change
+    store.add("us-east-1", "Linux", "m3.large", [
+        price("us-east-1b", "2014-03-01T14:00:00.000Z", 0.5)],
+        "2014-03-01T12:00:00Z")
+    assert store.fetched_until("us-east-1", "Linux", "m3.large",
+                               zones) == "2014-03-01T14:00:00Z"
+    # refetching an older record doesn't move the mark back
+    store.add("us-east-1", "Linux", "m3.large", [
+        price("us-east-1b", "2014-03-01T11:00:00.000Z", 0.4)])
+    assert store.fetched_until("us-east-1", "Linux", "m3.large",
+                               zones) == "2014-03-01T14:00:00Z"
+    assert store.fetched_until("us-east-1", "Linux", None, zones) is None
+
+
+@mock.patch("cloudtools.aws.spot_prices.PRUNE_INTERVAL", 0)
+def test_add_prunes(store):
+    store.add("us-east-1", "Linux", "m3.large", [
+        price("us-east-1a", "2014-03-01T10:00:00.000Z", 0.1)])
+    store.add("us-east-1", "Linux", "m3.large", [
+        price("us-east-1a", "2014-03-01T12:00:00.000Z", 0.2)])
+    rows = store._db.execute("SELECT price FROM spot_prices").fetchall()
+    assert rows == [(0.2,)]
+
+
+def test_prune_keeps_latest(store):
+    store.add("us-east-1", "Linux", "m3.large", [
+        price("us-east-1a", "2014-03-01T10:00:00.000Z", 0.1),
+        price("us-east-1a", "2014-03-01T12:00:00.000Z", 0.2),
+    ])
+    store.prune()
+    rows = store._db.execute("SELECT price FROM spot_prices").fetchall()
+    assert rows == [(0.2,)]
+
+
+def test_persistent(tmpdir):
+    path = str(tmpdir.join("prices.db"))
+    SpotPriceStore(path).add("us-east-1", "Linux", "m3.large", [
+        price("us-east-1a", "2014-03-01T10:00:00.000Z", 0.1)])
+    assert SpotPriceStore(path).latest("us-east-1", "Linux") == {
+        "m3.large": {"us-east-1a": 0.1}}
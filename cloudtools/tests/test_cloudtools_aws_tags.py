@@ -0,0 +1,76 @@
+import mock
+import pytest
+from boto.exception import EC2ResponseError
+
+from cloudtools.aws.tags import TagQueue, TagWrite
+
+
+def make_error(code):
+    e = EC2ResponseError(400, "Bad Request")
+    e.code = code
+    return e
+
+
+@mock.patch("cloudtools.aws.tags.get_aws_connection")
+def test_apply_batches_by_region_and_tags(m_conn):
+    q = TagQueue()
+    writes = [
+        TagWrite("us-east-1", ["sir-1"], {"moz-type": "t"}, 0),
+        TagWrite("us-east-1", ["sir-2"], {"moz-type": "t"}, 0),
+        TagWrite("us-east-1", ["sir-1"], {"Name": "n1"}, 0),
+        TagWrite("us-west-2", ["sir-3"], {"moz-type": "t"}, 0),
+    ]
+    assert q.apply(writes) == []
+    calls = m_conn.return_value.create_tags.call_args_list
+    assert sorted(c[0] for c in calls) == [
+        (["sir-1"], {"Name": "n1"}),
+        (["sir-1", "sir-2"], {"moz-type": "t"}),
+        (["sir-3"], {"moz-type": "t"}),
+    ]
+
+
+@mock.patch("cloudtools.aws.tags.get_aws_connection")
+def test_apply_retries(m_conn):
+    q = TagQueue(max_tries=2)
+    m_conn.return_value.create_tags.side_effect = make_error(
+        "InvalidSpotInstanceRequestID.NotFound")
+    w = TagWrite("us-east-1", ["sir-1"], {"Name": "n1"}, 0)
+    assert q.apply([w]) == [w]
+    assert w.not_before > 0
+    # gives up after max_tries
+    assert q.apply([w]) == []
+    with pytest.raises(EC2ResponseError):
+        w.result()
+
+
+@mock.patch("cloudtools.aws.tags.get_aws_connection")
+def test_apply_doesnt_retry_other_errors(m_conn):
+    q = TagQueue()
+    m_conn.return_value.create_tags.side_effect = make_error(
+        "InvalidParameterValue")
+    w = TagWrite("us-east-1", ["sir-1"], {"Name": "n1"}, 0)
+    assert q.apply([w]) == []
+    assert w.error.code == "InvalidParameterValue"
+
+
+@mock.patch("cloudtools.aws.tags.get_aws_connection")
+def test_apply_retries_new_amis(m_conn):
+    q = TagQueue()
+    m_conn.return_value.create_tags.side_effect = make_error(
+        "InvalidAMIID.NotFound")
+    w = TagWrite("us-east-1", ["ami-1"], {"moz-type": "t"}, 0)
+    assert q.apply([w]) == [w]
+    assert w.error is None
+
+
+@mock.patch("cloudtools.aws.tags.get_aws_connection")
+def test_queue_flush(m_conn):
+    q = TagQueue(initial_delay=0)
+    m_conn.return_value.create_tags.side_effect = [
+        make_error("RequestLimitExceeded"), None]
+    q.max_sleep = 0
+    w = q.add("us-east-1", ["i-1"], {"moz-state": "ready"})
+    assert q.flush(timeout=10)
+    w.result()
+    assert len(q) == 0
+    assert m_conn.return_value.create_tags.call_count == 2
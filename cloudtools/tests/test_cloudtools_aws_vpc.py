@@ -1,6 +1,8 @@
 import mock
 
-from cloudtools.aws.vpc import get_subnet_id, ip_available, get_avail_subnet
+import cloudtools.cache
+from cloudtools.aws.vpc import get_subnet_id, ip_available, \
+    get_avail_subnet, SubnetCapacity
 
 
 def test_get_subnet_id():
@@ -16,25 +18,37 @@ def test_get_subnet_id():
     assert get_subnet_id(vpc, "192.168.1.150") is None
 
 
+@mock.patch("cloudtools.aws.vpc.iter_instances")
 @mock.patch("cloudtools.aws.vpc.get_aws_connection")
-def test_ip_available(c):
-    i1 = mock.Mock()
-    i1.private_ip_address = "a1"
-    i2 = mock.Mock()
-    i2.private_ip_address = "a2"
-    e1 = mock.Mock()
-    e1.private_ip_address = "a1"
-    e2 = mock.Mock()
-    e2.private_ip_address = "a3"
-    c.return_value.get_only_instances.return_value = [i1, i2]
-    c.return_value.get_all_network_interfaces.return_value = [e1, e2]
+def test_ip_available(c, m_iter_instances):
+    cloudtools.cache.invalidate("used_ips")
+    m_iter_instances.return_value = [
+        mock.Mock(private_ip_address="a1"), mock.Mock(private_ip_address="a2"),
+        mock.Mock(private_ip_address=None)]
+    c.return_value.get_all_network_interfaces.return_value = [
+        mock.Mock(private_ip_address="a1",
+                  private_ip_addresses=[mock.Mock(private_ip_address="a1"),
+                                        mock.Mock(private_ip_address="a4")]),
+        mock.Mock(private_ip_address="a3", private_ip_addresses=[])]
     assert ip_available("r1", "a5")
     assert not ip_available("r1", "a1")
     assert not ip_available("r1", "a3")
+    assert not ip_available("r1", "a4")
+    # the used IPs are fetched once
+    m_iter_instances.assert_called_once_with("r1")
+    c.return_value.get_all_network_interfaces.return_value = [
+        mock.Mock(private_ip_address="a5", private_ip_addresses=[])]
+    assert ip_available("r1", "a5")
+    assert not ip_available("r1", "a5", refresh=True)
+    assert m_iter_instances.call_count == 2
+    cloudtools.cache.invalidate("used_ips")
 
 
+@mock.patch("cloudtools.aws.vpc.get_active_spot_requests")
 @mock.patch("cloudtools.aws.vpc.get_vpc")
-def test_get_avail_subnet(vpc):
+def test_get_avail_subnet(vpc, m_get_active_spot_requests):
+    cloudtools.cache.invalidate("subnets", "subnet_capacity")
+    m_get_active_spot_requests.return_value = []
     s1 = mock.Mock()
     s1.available_ip_address_count = 10
     s1.availability_zone = "az1"
@@ -62,3 +76,44 @@ def test_get_avail_subnet(vpc):
     vpc.return_value.get_all_subnets.assert_called_once_with(
         subnet_ids=("id1", "id2", "id3", "id4"))
     assert get_avail_subnet("r1", ["id44"], "azx") is None
+    cloudtools.cache.invalidate("subnets", "subnet_capacity")
+
+
+def subnet(subnet_id, available_ips, availability_zone="az1"):
+    return mock.Mock(id=subnet_id, available_ip_address_count=available_ips,
+                     availability_zone=availability_zone)
+
+
+def spot_request(subnet_id, state="open"):
+    sr = mock.Mock(state=state)
+    sr.launch_specification.subnet_id = subnet_id
+    return sr
+
+
+def test_subnet_capacity():
+    capacity = SubnetCapacity(
+        [subnet("id1", 5), subnet("id2", 6), subnet("id3", 9, "az2")],
+        [spot_request("id2"), spot_request("id2"),
+         spot_request("id1", "active")])
+    # id1 has 5 usable IPs, id2 has 4
+    assert [capacity.pick("az1") for _ in range(5)] == \
+        ["id1", "id1", "id2", "id1", "id2"]
+    # both are down to the minimum
+    assert capacity.pick("az1") is None
+    assert capacity.pick("az2") == "id3"
+    assert capacity.pick("az3") is None
+
+
+def test_subnet_capacity_release():
+    capacity = SubnetCapacity([subnet("id1", 5), subnet("id2", 4)], [])
+    assert capacity.pick("az1") == "id1"
+    capacity.release("id1")
+    assert [capacity.pick("az1") for _ in range(5)] == \
+        ["id1", "id1", "id2", "id1", "id2"]
+    assert capacity.pick("az1") is None
+    # subnets which ran out come back
+    capacity.release("id2")
+    assert capacity.pick("az1") == "id2"
+    # unknown subnets are ignored
+    capacity.release("id3")
+    assert capacity.pick("az1") is None
@@ -0,0 +1,100 @@
+import threading
+
+import mock
+import pytest
+from boto.ec2.volume import Volume
+
+from cloudtools.aws.waiter import Wait, WaitGroup, Waiter, WaitTimeout
+
+
+def volume(connection, volume_id, status):
+    v = Volume(connection)
+    v.id = volume_id
+    v.status = status
+    return v
+
+
+def test_refresh_batched():
+    conn = mock.Mock()
+    v1 = volume(conn, "vol-1", "creating")
+    v2 = volume(conn, "vol-2", "creating")
+    conn.get_all_volumes.return_value = [volume(conn, "vol-1", "available"),
+                                         volume(conn, "vol-2", "in-use")]
+    group = WaitGroup(conn, Volume)
+    waits = [Wait(v1, "status", "available"), Wait(v2, "status", "available")]
+    group.refresh(waits)
+    conn.get_all_volumes.assert_called_once_with(
+        volume_ids=["vol-1", "vol-2"])
+    assert v1.status == "available"
+    assert v2.status == "in-use"
+    assert [w.matches() for w in waits] == [True, False]
+
+
+def test_refresh_one_by_one():
+    conn = mock.Mock()
+    conn.get_all_volumes.side_effect = Exception("vol-2 not found")
+    v1 = volume(conn, "vol-1", "creating")
+    v2 = volume(conn, "vol-2", "creating")
+    v1.update = mock.Mock()
+    v2.update = mock.Mock(side_effect=Exception("not found"))
+    group = WaitGroup(conn, Volume)
+    group.refresh([Wait(v1, "status", "available"),
+                   Wait(v2, "status", "available")])
+    v1.update.assert_called_once_with()
+    v2.update.assert_called_once_with()
+
+
+@mock.patch("cloudtools.aws.waiter.MIN_INTERVAL", 0.01)
+def test_waiter():
+    obj = mock.Mock(state="pending")
+    updates = []
+
+    def update():
+        updates.append(1)
+        if len(updates) == 3:
+            obj.state = "running"
+    obj.update.side_effect = update
+
+    w = Waiter().wait_for(obj, "state", ("running", "stopped"))
+    callback = mock.Mock()
+    w.add_done_callback(callback)
+    assert w.result(timeout=5) is obj
+    assert len(updates) == 3
+    callback.assert_called_once_with(w)
+    # callbacks added later are called right away
+    w.add_done_callback(callback)
+    assert callback.call_count == 2
+
+
+@mock.patch("cloudtools.aws.waiter.MIN_INTERVAL", 0.01)
+def test_callback_errors():
+    obj = mock.Mock(state="running")
+    w = Waiter().wait_for(obj, "state", "running")
+    w.add_done_callback(mock.Mock(side_effect=ValueError("boom")))
+    with pytest.raises(ValueError):
+        w.result(timeout=5)
+
+
+@mock.patch("cloudtools.aws.waiter.MIN_INTERVAL", 0.01)
+def test_slow_callbacks_dont_block_polling():
+    waiter = Waiter()
+    release = threading.Event()
+    slow = waiter.wait_for(mock.Mock(state="running"), "state", "running")
+    slow.add_done_callback(lambda w: release.wait(5))
+    obj = mock.Mock(state="pending")
+
+    def update():
+        obj.state = "running"
+    obj.update.side_effect = update
+    fast = waiter.wait_for(obj, "state", "running")
+    assert fast.result(timeout=2) is obj
+    assert not slow.done()
+    release.set()
+    assert slow.result(timeout=5) is not None
+
+
+def test_timeout():
+    obj = mock.Mock(state="pending")
+    w = Wait(obj, "state", "running")
+    with pytest.raises(WaitTimeout):
+        w.result(timeout=0.01)
@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+
+import mock
+import pytest
+import sqlalchemy as sa
+
+from cloudtools.buildbot import BuilderMatcher, map_builders, find_pending
+
+
+def test_matcher_first_match_wins():
+    m = BuilderMatcher(OrderedDict([
+        ("^b2g_.*", "b-2008"),
+        (".*", "bld-linux64"),
+    ]))
+    assert m.match("b2g_try_emulator") == "b-2008"
+    assert m.match("Linux try build") == "bld-linux64"
+
+
+def test_matcher_memo():
+    m = BuilderMatcher({"^foo": "t1"})
+    assert m.match("foo bar") == "t1"
+    m.patterns = []
+    assert m.match("foo bar") == "t1"
+    assert m.match("baz") is None
+
+
+def test_unused_patterns():
+    m = BuilderMatcher(OrderedDict([("^foo", "t1"), ("^bar", "t2"),
+                                    ("^baz", "t3")]))
+    m.match("bar 1")
+    assert m.unused_patterns() == ["^foo", "^baz"]
+
+
+def test_map_builders():
+    pending = [("foo 1", 1), ("foo 2", 2), ("bar", 3), ("nomatch", 4)]
+    m = BuilderMatcher({"^foo": "t1", "^bar": "t2"})
+    assert map_builders(pending, m) == {"t1": 3, "t2": 3}
+    # plain dicts still work
+    assert map_builders(pending, {"^foo": "t1"}) == {"t1": 3}
+
+
+@pytest.fixture(params=["claims", "claimed_at"])
+def dburl(request, tmpdir):
+    """A buildbot db with pending, claimed, complete and old requests, in
+    either schema variant"""
+    url = "sqlite:///{}".format(tmpdir.join("buildbot.db"))
+    db = sa.create_engine(url)
+    db.execute("""CREATE TABLE buildrequests (
+        id INTEGER PRIMARY KEY, buildername VARCHAR(256), complete INTEGER,
+        claimed_at INTEGER, submitted_at INTEGER)""")
+    if request.param == "claims":
+        db.execute("CREATE TABLE buildrequest_claims (brid INTEGER)")
+    now = time.time()
+    rows = [
+        # id, buildername, complete, claimed, submitted_at
+        (1, "foo", 0, False, now - 100),
+        (2, "foo", 0, False, now - 200),
+        (3, "bar", 0, False, now - 100),
+        (4, "bar", 0, True, now - 100),
+        (5, "bar", 1, False, now - 100),
+        (6, "baz", 0, False, now - 2 * 86400),
+        (7, "baz", 0, False, now),
+    ]
+    for brid, buildername, complete, claimed, submitted_at in rows:
+        claimed_at = 0
+        if claimed:
+            if request.param == "claims":
+                db.execute("INSERT INTO buildrequest_claims VALUES (?)",
+                           brid)
+            else:
+                claimed_at = now
+        db.execute("INSERT INTO buildrequests VALUES (?, ?, ?, ?, ?)",
+                   brid, buildername, complete, claimed_at, submitted_at)
+    return url
+
+
+def test_find_pending(dburl):
+    assert sorted(find_pending(dburl)) == [("bar", 1), ("foo", 2)]
+
+
+def test_find_pending_reuses_engine(dburl):
+    find_pending(dburl)
+    with mock.patch("sqlalchemy.create_engine") as m_create, \
+            mock.patch("cloudtools.buildbot.Inspector") as m_inspector:
+        find_pending(dburl)
+        assert not m_create.called
+        assert not m_inspector.called
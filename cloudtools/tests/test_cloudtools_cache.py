@@ -0,0 +1,69 @@
+import mock
+
+from cloudtools import cache
+
+
+def test_namespace_is_shared():
+    assert cache.namespace("t-shared") is cache.namespace("t-shared")
+
+
+def test_cached():
+    f = mock.Mock(return_value=1)
+
+    @cache.cached("t-cached")
+    def cached_f(*args, **kwargs):
+        return f(*args, **kwargs)
+
+    assert cached_f("a", b=2) == 1
+    assert cached_f("a", b=2) == 1
+    f.assert_called_once_with("a", b=2)
+    assert cached_f("b") == 1
+    assert f.call_count == 2
+    stats = cache.stats()["t-cached"]
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["size"] == 2
+
+
+def test_size_bound():
+    ns = cache.namespace("t-bound", maxsize=2)
+    for i in range(5):
+        ns.put(i, i)
+    assert len(ns.keys()) == 2
+
+
+def test_ttl():
+    ns = cache.namespace("t-ttl", ttl=10)
+    with mock.patch("time.time") as m_time:
+        m_time.return_value = 1000
+        ns.put("k", "v")
+        m_time.return_value = 1009
+        assert ns.get("k") == "v"
+        m_time.return_value = 1011
+        assert ns.get("k") is None
+
+
+def test_no_ttl():
+    ns = cache.namespace("t-no-ttl")
+    ns.put("k", "v")
+    with mock.patch("time.time") as m_time:
+        m_time.return_value = 10 ** 12
+        assert ns.get("k") == "v"
+
+
+def test_invalidate():
+    ns1 = cache.namespace("t-inv1")
+    ns2 = cache.namespace("t-inv2")
+    ns1.put("k", "v")
+    ns2.put("k", "v")
+    cache.invalidate("t-inv1")
+    assert "k" not in ns1
+    assert "k" in ns2
+
+
+def test_invalidate_where():
+    ns = cache.namespace("t-where")
+    ns.put(("r1", "a"), 1)
+    ns.put(("r2", "a"), 2)
+    ns.invalidate_where(lambda key: key[0] == "r1")
+    assert ns.keys() == [("r2", "a")]
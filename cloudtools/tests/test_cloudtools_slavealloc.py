@@ -1,6 +1,13 @@
+import json
+import os
+import threading
+import BaseHTTPServer
+
 import pytest
 import mock
-from cloudtools.slavealloc import slave_moz_type, get_classified_slaves
+from cloudtools.slavealloc import slave_moz_type, get_classified_slaves, \
+    invalidate_classified_slaves_cache, get_all_classified_slaves, \
+    classify_slaves, SlaveClassifier
 
 
 def test_bld_linux64():
@@ -86,15 +93,39 @@ def test_golden():
     assert slave_moz_type(slave) == "golden"
 
 
-@pytest.fixture
-def example_data(request):
+def test_unknown():
+    slave = {
+        "bitlength": "64",
+        "environment": "dev",
+        "distro": "centos6-mock",
+        "purpose": "build",
+        "trustlevel": "core"
+    }
+    assert slave_moz_type(slave) is None
+
 
-    def reset_lru():
-        # A dirty hack to invalidate @lru_cache decorated function mocked in
-        # the tests below
-        get_classified_slaves.func_closure[0].cell_contents.clear()
+def test_classifier_rule_order():
+    attributes = {"bitlength": "64", "environment": "prod",
+                  "distro": "ubuntu64", "purpose": "tests",
+                  "trustlevel": "try"}
+    classifier = SlaveClassifier([
+        {"moz_type": "fast", "attributes": dict(attributes, speed="fast")},
+        {"moz_type": "any", "attributes": attributes},
+        {"moz_type": "slow", "attributes": dict(attributes, speed="slow")},
+        {"moz_type": "special", "name_contains": "special"},
+    ])
+    assert classifier.classify(dict(attributes, speed="fast")) == "fast"
+    # an earlier rule without a speed wins
+    assert classifier.classify(dict(attributes, speed="slow")) == "any"
+    assert classifier.classify(attributes) == "any"
+    assert classifier.classify(dict(attributes, name="special-1")) == \
+        "special"
+    assert classifier.classify(dict(attributes, bitlength="32")) is None
 
-    request.addfinalizer(reset_lru)
+
+@pytest.fixture
+def example_data(request):
+    request.addfinalizer(invalidate_classified_slaves_cache)
 
     j = [
         {"name": "slave-spot-1", "datacenter": "us-west-2",
@@ -132,16 +163,110 @@ def example_data(request):
     return j
 
 
-@mock.patch("cloudtools.slavealloc.get_slaves_json")
+@mock.patch("cloudtools.slavealloc.get_all_classified_slaves")
 def test_bld_spot(m, example_data):
-    m.return_value = example_data
+    m.return_value = classify_slaves(example_data)
     slaves = get_classified_slaves(True)
     assert slaves == {'bld-linux64': {'us-west-2': set(['slave-spot-1'])},
                       'tst-emulator64': {'us-west-2': set(['slave-spot-3'])}}
 
 
-@mock.patch("cloudtools.slavealloc.get_slaves_json")
+@mock.patch("cloudtools.slavealloc.get_all_classified_slaves")
 def test_bld_ondemand(m, example_data):
-    m.return_value = example_data
+    m.return_value = classify_slaves(example_data)
     slaves = get_classified_slaves(False)
     assert slaves == {'bld-linux64': {'us-west-2': set(['slave-1'])}}
+
+
+class SlaveallocHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves server.body with an ETag, honouring If-None-Match"""
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        etag = '"%i"' % hash(self.server.body)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def slavealloc(request, example_data):
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), SlaveallocHandler)
+    server.body = json.dumps(example_data)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(server.shutdown)
+    server.url = "http://127.0.0.1:%i/api/slaves" % server.server_port
+    return server
+
+
+def expire(cache):
+    os.utime(cache, (0, 0))
+
+
+def test_conditional_get(slavealloc, tmpdir, example_data):
+    cache = str(tmpdir.join("slaves.json"))
+    classified = get_all_classified_slaves(slavealloc.url, cache)
+    assert classified == classify_slaves(example_data)
+    assert len(slavealloc.requests) == 1
+    assert "if-none-match" not in slavealloc.requests[0]
+
+    # still fresh
+    get_all_classified_slaves(slavealloc.url, cache)
+    assert len(slavealloc.requests) == 1
+
+    # not modified: the saved classification is used
+    expire(cache)
+    with mock.patch("cloudtools.slavealloc.classify_slaves") as m_classify:
+        classified = get_all_classified_slaves(slavealloc.url, cache)
+    assert not m_classify.called
+    assert classified == classify_slaves(example_data)
+    assert len(slavealloc.requests) == 2
+    assert "if-none-match" in slavealloc.requests[1]
+
+    # modified: downloaded and classified again
+    expire(cache)
+    slavealloc.body = json.dumps(example_data[1:])
+    classified = get_all_classified_slaves(slavealloc.url, cache)
+    assert classified == classify_slaves(example_data[1:])
+    assert len(slavealloc.requests) == 3
+
+
+def test_server_down(slavealloc, tmpdir, example_data):
+    cache = str(tmpdir.join("slaves.json"))
+    get_all_classified_slaves(slavealloc.url, cache)
+    expire(cache)
+    slavealloc.shutdown()
+    slavealloc.server_close()
+    classified = get_all_classified_slaves(slavealloc.url, cache)
+    assert classified == classify_slaves(example_data)
+
+
+def test_rules_changed(slavealloc, tmpdir, example_data):
+    cache = str(tmpdir.join("slaves.json"))
+    rules_file = tmpdir.join("slave_moz_types.json")
+    rules_file.write(json.dumps([
+        {"moz_type": "old-type", "name_contains": ""}]))
+    classified = get_all_classified_slaves(slavealloc.url, cache,
+                                           str(rules_file))
+    assert classified["ondemand"] == {"old-type": {"us-west-2":
+                                                  set(["slave-1"])}}
+    # slaves.json didn't change, but the rules did
+    rules_file.write(json.dumps([
+        {"moz_type": "new-type", "name_contains": ""}]))
+    classified = get_all_classified_slaves(slavealloc.url, cache,
+                                           str(rules_file))
+    assert classified["ondemand"] == {"new-type": {"us-west-2":
+                                                  set(["slave-1"])}}
+    assert len(slavealloc.requests) == 1
@@ -0,0 +1,176 @@
+import threading
+
+import mock
+from boto.exception import EC2ResponseError
+
+import cloudtools.cache
+from cloudtools.scripts import aws_watch_pending
+
+
+class Tick(Exception):
+    pass
+
+
+@mock.patch("time.sleep")
+@mock.patch("cloudtools.scripts.aws_watch_pending.flush_tags")
+@mock.patch("cloudtools.scripts.aws_watch_pending.aws_watch_pending")
+@mock.patch("cloudtools.scripts.aws_watch_pending.reset_available_slave_names")
+@mock.patch("cloudtools.cache.invalidate")
+def test_watch_pending_forever(m_invalidate, m_reset, m_watch, m_flush,
+                               m_sleep):
+    # started 2 instances, then nothing, then failed
+    m_watch.side_effect = [2, 0, Exception("boom")]
+    m_sleep.side_effect = [None, None, Tick()]
+    try:
+        aws_watch_pending.watch_pending_forever(60, dryrun=True)
+    except Tick:
+        pass
+    assert m_watch.call_count == 3
+    m_watch.assert_called_with(dryrun=True)
+    assert m_reset.call_count == 3
+    assert m_flush.call_args_list == [
+        mock.call(aws_watch_pending.FLUSH_TAGS_TIMEOUT)] * 3
+    # the run which started nothing keeps the caches
+    assert m_invalidate.call_args_list == [
+        mock.call(*aws_watch_pending.LAUNCH_SENSITIVE_CACHES)] * 2
+    for name, ttl in aws_watch_pending.CACHE_TTLS.iteritems():
+        assert cloudtools.cache.namespace(name).ttl == ttl
+        cloudtools.cache.set_ttl(name, None)
+
+
+@mock.patch("cloudtools.scripts.aws_watch_pending.tag_spot_requests")
+@mock.patch("cloudtools.scripts.aws_watch_pending.get_aws_connection")
+@mock.patch("cloudtools.scripts.aws_watch_pending.get_launch_devices")
+@mock.patch("cloudtools.scripts.aws_watch_pending.get_launch_spec")
+def test_do_request_spot_instances(m_spec, m_devices, m_conn, m_tag):
+    LaunchSpec = aws_watch_pending.LaunchSpec
+    m_spec.side_effect = [
+        LaunchSpec("s1", "s1.example.com", "subnet-1", "data1"),
+        LaunchSpec("s2", "s2.example.com", "subnet-1", "data2"),
+        LaunchSpec("s3", "s3.example.com", "subnet-2", "data3"),
+        None,
+    ]
+    m_devices.return_value = ("bdm", "nc")
+    conn = m_conn.return_value
+    conn.request_spot_instances.side_effect = [
+        [mock.Mock(id="sir-1")], [mock.Mock(id="sir-2")],
+        [mock.Mock(id="sir-3")],
+    ]
+    choice = mock.Mock(availability_zone="us-east-1a", bid_price=0.1,
+                       instance_type="m3.large")
+    config = {"us-east-1": {"ssh_key": "key"}}
+    started = aws_watch_pending.do_request_spot_instances(
+        amount=5, region="us-east-1", moz_instance_type="t",
+        ami=mock.Mock(id="ami-1"), instance_config=config,
+        spot_choice=choice, inventory=None, dryrun=False)
+    assert started == 3
+    assert [c[1]["user_data"] for c in
+            conn.request_spot_instances.call_args_list] == \
+        ["data1", "data2", "data3"]
+    m_tag.assert_called_once_with("us-east-1", {
+        "sir-1": {"Name": "s1", "FQDN": "s1.example.com"},
+        "sir-2": {"Name": "s2", "FQDN": "s2.example.com"},
+        "sir-3": {"Name": "s3", "FQDN": "s3.example.com"},
+    }, {"moz-type": "t"})
+
+
+@mock.patch("cloudtools.scripts.aws_watch_pending.release_subnet")
+@mock.patch("cloudtools.scripts.aws_watch_pending.release_slave_name")
+@mock.patch("cloudtools.scripts.aws_watch_pending.tag_spot_requests")
+@mock.patch("cloudtools.scripts.aws_watch_pending.get_aws_connection")
+@mock.patch("cloudtools.scripts.aws_watch_pending.get_launch_devices")
+@mock.patch("cloudtools.scripts.aws_watch_pending.get_launch_spec")
+def test_do_request_spot_instances_releases_unused(m_spec, m_devices, m_conn,
+                                                   m_tag, m_release_name,
+                                                   m_release_subnet):
+    LaunchSpec = aws_watch_pending.LaunchSpec
+    m_spec.side_effect = [
+        LaunchSpec("s%i" % n, "s%i.example.com" % n, "subnet-%i" % n, "data")
+        for n in range(4)]
+    m_devices.return_value = ("bdm", "nc")
+    too_many = EC2ResponseError(400, "Bad")
+    too_many.code = "MaxSpotInstanceCountExceeded"
+    m_conn.return_value.request_spot_instances.side_effect = [
+        [mock.Mock(id="sir-0")], Exception("boom"), too_many]
+    choice = mock.Mock(availability_zone="us-east-1a", bid_price=0.1,
+                       instance_type="m3.large")
+    config = {"us-east-1": {"ssh_key": "key", "subnet_ids": ["subnet-x"]}}
+    started = aws_watch_pending.do_request_spot_instances(
+        amount=4, region="us-east-1", moz_instance_type="t",
+        ami=mock.Mock(id="ami-1"), instance_config=config,
+        spot_choice=choice, inventory=None, dryrun=False)
+    assert started == 1
+    # s1 failed, s2 hit the limit and s3 was never requested
+    assert m_release_name.call_args_list == [
+        mock.call("us-east-1", "t", True, "s%i" % n) for n in (1, 2, 3)]
+    assert m_release_subnet.call_args_list == [
+        mock.call("us-east-1", ["subnet-x"], "subnet-%i" % n)
+        for n in (1, 2, 3)]
+
+
+def test_run_launches():
+    results = [True, False, Exception("boom"), True, True]
+    lock = threading.Lock()
+
+    def launch():
+        with lock:
+            rv = results.pop(0)
+        if isinstance(rv, Exception):
+            raise rv
+        return rv
+
+    # failed launches are not retried
+    assert aws_watch_pending.run_launches(5, launch, concurrency=2) == 3
+    assert results == []
+
+
+def test_run_launches_throttled():
+    calls = []
+
+    def launch():
+        calls.append(1)
+        # the rate limiter has given up retrying already
+        e = EC2ResponseError(503, "Throttled")
+        e.code = "RequestLimitExceeded"
+        raise e
+
+    assert aws_watch_pending.run_launches(10, launch, concurrency=1) == 0
+    assert len(calls) == 1
+
+
+def test_run_launches_gives_up():
+    calls = []
+
+    def launch():
+        calls.append(1)
+        e = EC2ResponseError(400, "Bad")
+        e.code = "InstanceLimitExceeded"
+        raise e
+
+    assert aws_watch_pending.run_launches(10, launch, concurrency=1) == 0
+    assert len(calls) == 1
+
+
+@mock.patch("cloudtools.scripts.aws_watch_pending.log_started")
+@mock.patch("cloudtools.scripts.aws_watch_pending.invalidate_instances_cache")
+@mock.patch("cloudtools.scripts.aws_watch_pending.do_request_instance")
+@mock.patch("cloudtools.scripts.aws_watch_pending.get_ami")
+@mock.patch("cloudtools.scripts.aws_watch_pending.load_instance_config")
+def test_aws_resume_instances_logs_per_region(m_config, m_ami, m_request,
+                                              m_invalidate, m_log):
+    m_config.return_value = {"r1": {"instance_type": "m3.large"},
+                             "r2": {"instance_type": "c3.large"}}
+    m_ami.side_effect = lambda region, moz_instance_type: "ami-" + region
+    # nothing can be started in r2
+    m_request.side_effect = lambda region, **kwargs: region == "r1"
+    logged_from = []
+    m_log.side_effect = \
+        lambda *args: logged_from.append(threading.current_thread())
+    started = aws_watch_pending.aws_resume_instances(
+        inventory=None, moz_instance_type="t", start_count=6,
+        regions=["r1", "r2"], region_priorities={"r1": 1, "r2": 1},
+        dryrun=False)
+    assert started == 3
+    # once for all instances of the region, from the calling thread
+    m_log.assert_called_once_with("r1", "t", "m3.large", False, "ami-r1", 3)
+    assert logged_from == [threading.current_thread()]